@@ -0,0 +1,136 @@
+"""Cost of the CRC-16/Modbus verification of the RTU responses, per response size and per decoded frame.
+
+The responses are the FC3/FC4 responses of the register blocks of the meter definition files, synthesized
+as in synthetic_site.py. For each response size the table-driven verification (is_crc_valid) is timed
+against the bit-by-bit CRC of synthetic_site.get_crc. The frames of a synthetic site are then decoded with
+decode_fc3_fc4 with and without the verification, the difference is what the verification adds per frame.
+
+The table-driven CRC is checked against the bit-by-bit CRC, and a response with a flipped bit is checked
+to be rejected, before anything is timed.
+
+Usage:
+    python benchmarks/bench_crc.py [--devices 3] [--repeat 2000] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic_site  # noqa: E402
+from google_iot_core_gateway.modbus_gw.crc import get_crc16, is_crc_valid  # noqa: E402
+from google_iot_core_gateway.modbus_gw.modbus_to_json import (decode_fc3_fc4, decode_plan_cache,  # noqa: E402
+                                                               set_crc_verification)
+
+
+def check_crc(frames, seed):
+    rng = random.Random(seed)
+    for length in range(0, 300):
+        data = bytes(rng.getrandbits(8) for _ in range(length))
+        if get_crc16(data).to_bytes(2, "little") != synthetic_site.get_crc(data):
+            raise AssertionError(f"CRC of {data.hex()} differs from the bit-by-bit CRC")
+
+    for rtu_request, rtu_response in frames:
+        if not is_crc_valid(rtu_response):
+            raise AssertionError(f"Valid response {rtu_response.hex()} rejected")
+        corrupted = bytearray(rtu_response)
+        corrupted[rng.randrange(len(corrupted))] ^= 1 << rng.randrange(8)
+        if is_crc_valid(corrupted):
+            raise AssertionError(f"Corrupted response {corrupted.hex()} accepted")
+
+
+def time_per_call(function, arguments, repeat):
+    """
+    Returns:
+        Best time in seconds of one call with each of the arguments, out of repeat rounds
+    """
+    perf_counter = time.perf_counter
+    best = None
+    for _ in range(repeat):
+        started = perf_counter()
+        for args in arguments:
+            function(*args)
+        elapsed = (perf_counter() - started) / len(arguments)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_sizes(frames, repeat):
+    responses = {}
+    for _, rtu_response in frames:
+        responses.setdefault(len(rtu_response), rtu_response)
+
+    results = {}
+    for size, rtu_response in sorted(responses.items()):
+        table = time_per_call(is_crc_valid, [(rtu_response,)], repeat)
+        bitwise = time_per_call(synthetic_site.get_crc, [(rtu_response[:-2],)], max(repeat // 10, 1))
+        results[str(size)] = {
+            "is_crc_valid_us": table * 1e6,
+            "ns_per_byte": table * 1e9 / size,
+            "bit_by_bit_us": bitwise * 1e6,
+        }
+    return results
+
+
+def bench_decode(frames, repeat):
+    results = {}
+    for verify_crc in (False, True):
+        set_crc_verification(verify_crc)
+        results["with_crc" if verify_crc else "without_crc"] = time_per_call(decode_fc3_fc4, frames, repeat) * 1e6
+    results["crc_overhead_us"] = results["with_crc"] - results["without_crc"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=3, help="meters of the synthetic site")
+    parser.add_argument("--repeat", type=int, default=2000, help="rounds timed, the best round is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    devices = synthetic_site.get_devices(args.devices)
+    root_dir = synthetic_site.create_root_dir(devices)
+    try:
+        decode_plan_cache.set_root_dir(root_dir)
+        # one frame per register block of each meter type
+        frames = []
+        for payload in synthetic_site.build_frames(devices, args.devices * 50, args.seed):
+            message = json.loads(payload)
+            frames.append((bytes.fromhex(message["rtu_request"]), bytes.fromhex(message["rtu_response"])))
+        check_crc(frames, args.seed)
+        # the decode plans are compiled before the clock starts
+        for rtu_request, rtu_response in frames:
+            decode_fc3_fc4(rtu_request, rtu_response)
+
+        results = {
+            "sizes": bench_sizes(frames, args.repeat),
+            "decode_us_per_frame": bench_decode(frames, max(args.repeat // 100, 1)),
+            "frames": len(frames),
+            "mean_response_bytes": sum(len(rtu_response) for _, rtu_response in frames) / len(frames),
+        }
+    finally:
+        set_crc_verification(True)
+        shutil.rmtree(root_dir)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print(f"{'response bytes':>14} {'is_crc_valid us':>16} {'ns/byte':>8} {'bit-by-bit us':>14}")
+    for size, result in results["sizes"].items():
+        print(f"{size:>14} {result['is_crc_valid_us']:>16.2f} {result['ns_per_byte']:>8.1f} "
+              f"{result['bit_by_bit_us']:>14.2f}")
+    decode = results["decode_us_per_frame"]
+    print(f"decode_fc3_fc4 of {results['frames']} frames of {results['mean_response_bytes']:.0f} bytes on average: "
+          f"{decode['without_crc']:.2f}us per frame without the CRC verification, {decode['with_crc']:.2f}us with it, "
+          f"+{decode['crc_overhead_us']:.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""Frames per second decoded and applied to the UDMI device state, in the main loop and with decode workers.
+
+The frames of a synthetic site of --devices meters are decoded and applied once in the main loop
+(process_payload) and once per number of decode workers (DecodeWorkerPool), in batches of --batch-size
+frames as the main loop takes them from the queue. The throughput scales with the number of workers
+as long as there is a free core for each of them and the main loop applying the decoded frames keeps up.
+
+Usage:
+    python benchmarks/bench_decode_workers.py [--devices 300] [--frames 20000] [--workers 1,2,4] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic_site  # noqa: E402
+from google_iot_core_gateway.decode_pool import DecodeWorkerPool  # noqa: E402
+from google_iot_core_gateway.gcp_handler import process_payload, apply_decoded_frame  # noqa: E402
+from google_iot_core_gateway.modbus_gw.modbus_to_json import decode_plan_cache  # noqa: E402
+
+
+def run_main_loop(logger, udmi_handler, frames):
+    started = time.perf_counter()
+    for payload in frames:
+        process_payload(logger, payload, udmi_handler, time.time())
+    return time.perf_counter() - started
+
+
+def run_workers(logger, udmi_handler, frames, workers, batch_size, root_dir):
+    decode_pool = DecodeWorkerPool(logger, workers, batch_size=batch_size, root_dir=root_dir)
+    decode_pool.start()
+    try:
+        # the workers load the meter definition files before the clock starts
+        decode_pool.submit([(time.time(), payload) for payload in frames[:workers * batch_size]])
+        while decode_pool.is_busy():
+            decode_pool.collect(timeout=1.0)
+
+        applied = 0
+        started = time.perf_counter()
+        for index in range(0, len(frames), batch_size):
+            received_at = time.time()
+            decode_pool.submit([(received_at, payload) for payload in frames[index:index + batch_size]])
+            for received_at, frame, error in decode_pool.collect():
+                apply_decoded_frame(logger, frame, udmi_handler, received_at)
+                applied += 1
+        while decode_pool.is_busy():
+            for received_at, frame, error in decode_pool.collect(timeout=1.0):
+                apply_decoded_frame(logger, frame, udmi_handler, received_at)
+                applied += 1
+        elapsed = time.perf_counter() - started
+    finally:
+        decode_pool.close()
+
+    if applied != len(frames):
+        raise RuntimeError(f"{applied} frames applied out of {len(frames)}")
+    return elapsed
+
+
+def run(devices_count, frames_count, workers_counts, batch_size, seed):
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    devices = synthetic_site.get_devices(devices_count)
+    frames = synthetic_site.build_frames(devices, frames_count, seed)
+    root_dir = synthetic_site.create_root_dir(devices)
+    try:
+        decode_plan_cache.set_root_dir(root_dir)
+        udmi_handler = synthetic_site.get_udmi_handler(logger, devices)
+
+        # compiles the decode plans before the clock starts
+        run_main_loop(logger, udmi_handler, frames[:len(devices) * 10])
+        results = {"main_loop": len(frames) / run_main_loop(logger, udmi_handler, frames)}
+        for workers in workers_counts:
+            elapsed = run_workers(logger, udmi_handler, frames, workers, batch_size, root_dir)
+            results[f"{workers}_workers"] = len(frames) / elapsed
+    finally:
+        shutil.rmtree(root_dir)
+
+    return {
+        "devices": devices_count,
+        "frames": frames_count,
+        "batch_size": batch_size,
+        "cpu_count": os.cpu_count(),
+        "frames_per_second": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=300, help="number of meters")
+    parser.add_argument("--frames", type=int, default=20000, help="number of frames decoded per run")
+    parser.add_argument("--workers", default=",".join(str(workers) for workers in (1, 2, 4)),
+                        help="comma separated numbers of decode workers")
+    parser.add_argument("--batch-size", type=int, default=100, help="frames handed over to the workers at once")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    workers_counts = [int(workers) for workers in args.workers.split(",")]
+    results = run(args.devices, args.frames, workers_counts, args.batch_size, args.seed)
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print(f"{results['devices']} devices, {results['frames']} frames, batches of {results['batch_size']}, "
+          f"{results['cpu_count']} CPUs")
+    baseline = results["frames_per_second"]["main_loop"]
+    print(f"{'decoding':<12} {'frames/s':>10} {'speedup':>8}")
+    for name, frames_per_second in results["frames_per_second"].items():
+        print(f"{name:<12} {frames_per_second:>10.0f} {frames_per_second / baseline:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
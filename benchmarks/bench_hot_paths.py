@@ -0,0 +1,386 @@
+"""Throughput and latency of the decode, UDMI and publish hot paths, for sites of increasing size.
+
+For each number of meters in --devices a synthetic site is built (see synthetic_site.py) and valid FC3/FC4 RTU
+request/response pairs are synthesized from the register blocks of the meter definition files
+(resources/modbus_dbo_maps/*.json). A Modbus bus addresses at most 247 slaves, so on larger sites the frames
+poll the first 247 meters and the state of the other meters is filled with the decoded frames of a meter of
+the same type, the UDMI cases cover all the meters. The cases measured are:
+
+    modbus_to_json              - decoding of one frame into its JSON
+    process_payloads            - decoding and applying a batch of queued internal broker messages
+    update_device_properties    - applying one register value to the UDMI device state
+    get_state_payload           - building the 'state' payload of one device
+    get_event_point_payload     - building the full 'events/pointset' payload of one device
+    get_event_point_payload_cov - building the change-of-value 'events/pointset' payload of one device
+    publish                     - publishing the pointset payloads through the PublishPipeline and paho to a
+                                  local fake MQTT broker, until all of them are acknowledged
+
+The payload and publish cases go through the devices of small sites several times, for MIN_OPERATIONS
+operations at least.
+
+Each case reports the operations per second and the p50/p99 latency of one operation (a frame, a batch,
+a register value, a payload). The publish case reports the PUBACK latency of the payloads instead.
+
+The results can be written as JSON with --output and compared with the results of a previous run with
+--baseline, e.g. before and after an upgrade, on the same box.
+
+Usage:
+    python benchmarks/bench_hot_paths.py [--devices 3,30,300,5000] [--frames-per-device 20] [--cases ...]
+                                         [--output results.json] [--baseline previous.json] [--json]
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import logging
+import argparse
+import platform
+import datetime
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic_site  # noqa: E402
+from fake_mqtt_broker import FakeMQTTBroker  # noqa: E402
+import paho.mqtt.client as mqtt  # noqa: E402
+from google_iot_core_gateway.gcp_handler import process_payloads  # noqa: E402
+from google_iot_core_gateway.modbus_gw.modbus_to_json import (modbus_to_json, decode_payload,  # noqa: E402
+                                                               decode_plan_cache)
+from google_iot_core_gateway.publish_pipeline import PublishPipeline  # noqa: E402
+
+CASES = ("modbus_to_json", "process_payloads", "update_device_properties", "get_state_payload",
+         "get_event_point_payload", "get_event_point_payload_cov", "publish")
+DEFAULT_DEVICES = (3, 30, 300, 5000)
+# Time in seconds the publish case waits for the PUBACKs before it gives up
+PUBLISH_TIMEOUT = 120
+# Minimum number of operations of the payload cases, the devices of small sites are gone through several times
+MIN_OPERATIONS = 1000
+
+
+def get_results(durations, operations=None, elapsed=None):
+    """
+    Args:
+        durations: duration in seconds of each operation
+        operations: number of operations, len(durations) by default
+        elapsed: time in seconds all the operations took, the sum of the durations by default
+    Returns:
+        {"operations", "operations_per_second", "p50_us", "p99_us"}
+    """
+    durations = sorted(durations)
+    operations = len(durations) if operations is None else operations
+    elapsed = sum(durations) if elapsed is None else elapsed
+    return {
+        "operations": operations,
+        "operations_per_second": operations / elapsed if elapsed else None,
+        "p50_us": durations[len(durations) // 2] * 1e6 if durations else None,
+        "p99_us": durations[min(int(len(durations) * 0.99), len(durations) - 1)] * 1e6 if durations else None,
+    }
+
+
+def timed(function, arguments):
+    """
+    Call the function with each of the arguments tuples.
+    Returns:
+        Duration in seconds of each call
+    """
+    perf_counter = time.perf_counter
+    durations = []
+    append = durations.append
+    for args in arguments:
+        started = perf_counter()
+        function(*args)
+        append(perf_counter() - started)
+    return durations
+
+
+def bench_modbus_to_json(site):
+    return get_results(timed(modbus_to_json, site["rtu_frames"]))
+
+
+def bench_process_payloads(site, max_batch_size=100):
+    logger, udmi_handler = site["logger"], site["udmi_handler"]
+    frames_queue = queue.Queue()
+    received_at = time.time()
+    for payload in site["frames"]:
+        frames_queue.put((received_at, payload))
+
+    durations = []
+    processed = 0
+    while True:
+        started = time.perf_counter()
+        batch = process_payloads(logger, frames_queue, udmi_handler, max_batch_size=max_batch_size,
+                                 batch_time_budget=float("inf"))
+        if not batch:
+            break
+        durations.append(time.perf_counter() - started)
+        processed += batch
+
+    # frames per second, latency of a batch
+    return dict(get_results(durations, processed), batch_size=max_batch_size)
+
+
+def bench_update_device_properties(site):
+    udmi_handler = site["udmi_handler"]
+    timestamp = udmi_handler.get_timestamp()
+    arguments = []
+    for slave_id, (_, meter_type) in site["devices"].items():
+        for data in site["frames_data"][meter_type]:
+            for registry_number, value in data.items():
+                arguments.append((slave_id, meter_type, registry_number, value, timestamp))
+    return get_results(timed(udmi_handler.update_device_properties, arguments))
+
+
+def get_rounds(site):
+    return -(-MIN_OPERATIONS // len(site["udmi_handler"].devices))
+
+
+def bench_payload_builder(site, builder, *args):
+    """
+    Build the payload of every device after the state of every device was updated, as at the end of a
+    publish interval.
+    """
+    durations = []
+    for round_number in range(get_rounds(site)):
+        apply_frames_data(site, offset=round_number + 1)
+        durations += timed(builder, [(device,) + args for device in site["udmi_handler"].devices])
+    return get_results(durations)
+
+
+def bench_publish(site, max_inflight=20, ack_delay=0.0):
+    """
+    Publish the pointset payload of every device, through the PublishPipeline of the gateway and a paho
+    client connected to the fake broker, and wait for all the PUBACKs.
+    """
+    logger, udmi_handler = site["logger"], site["udmi_handler"]
+    payloads = [(device_details["device_id"], udmi_handler.get_event_point_payload(device))
+                for device, device_details in udmi_handler.devices.items()] * get_rounds(site)
+
+    broker = FakeMQTTBroker(ack_delay=ack_delay).start()
+    client = mqtt.Client(client_id="bench-hot-paths")
+    connected = []
+    client.on_connect = lambda client, user_data, flags, rc: connected.append(rc)
+    client.connect(*broker.address)
+    client.loop_start()
+    try:
+        deadline = time.monotonic() + 10
+        while not connected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if connected != [0]:
+            raise RuntimeError(f"Connection to the fake MQTT broker failed: {connected}")
+
+        def publish(device_id, payload, topic, qos):
+            return client.publish(f"/devices/{device_id}/{topic}", payload, qos=qos)
+
+        pipeline = PublishPipeline(logger, publish, lambda: True, max_inflight=max_inflight,
+                                   max_queued=len(payloads))
+        client.on_publish = lambda client, user_data, mid: pipeline.on_publish(mid)
+
+        started = time.perf_counter()
+        for device_id, payload in payloads:
+            pipeline.submit(device_id, payload, topic="events/pointset", supersede=False)
+        deadline = time.monotonic() + PUBLISH_TIMEOUT
+        while pipeline.acknowledged < len(payloads) and time.monotonic() < deadline:
+            pipeline.pump()
+            time.sleep(0.0005)
+        elapsed = time.perf_counter() - started
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        broker.stop()
+
+    if pipeline.acknowledged < len(payloads):
+        raise RuntimeError(f"{pipeline.acknowledged} publishes acknowledged out of {len(payloads)}")
+
+    latency = pipeline.latency
+    return {
+        "operations": len(payloads),
+        "operations_per_second": len(payloads) / elapsed,
+        "p50_us": latency.percentile(50) * 1e6,
+        "p99_us": latency.percentile(99) * 1e6,
+        "payload_bytes_per_second": broker.payload_bytes / elapsed,
+        "max_inflight": max_inflight,
+        "ack_delay_ms": ack_delay * 1000,
+    }
+
+
+def build_site(logger, devices_count, frames_per_device, seed):
+    devices = synthetic_site.get_devices(devices_count)
+    frames = synthetic_site.build_frames(devices, devices_count * frames_per_device, seed)
+    rtu_frames = []
+    for payload in frames:
+        message = json.loads(payload)
+        rtu_frames.append((bytes.fromhex(message["rtu_request"]), bytes.fromhex(message["rtu_response"])))
+
+    return {
+        "logger": logger,
+        "devices": devices,
+        "frames": frames,
+        "rtu_frames": rtu_frames,
+        "udmi_handler": synthetic_site.get_udmi_handler(logger, devices),
+    }
+
+
+def run_cases(site, cases, max_inflight, ack_delay):
+    udmi_handler = site["udmi_handler"]
+    # the decode plans are compiled and the device state filled before the clock starts
+    process_payloads(site["logger"], _get_filled_queue(site["frames"]), udmi_handler,
+                     max_batch_size=len(site["frames"]), batch_time_budget=float("inf"))
+    fill_device_state(site)
+
+    benchmarks = {
+        "modbus_to_json": lambda: bench_modbus_to_json(site),
+        "process_payloads": lambda: bench_process_payloads(site),
+        "update_device_properties": lambda: bench_update_device_properties(site),
+        "get_state_payload": lambda: bench_payload_builder(site, udmi_handler.get_state_payload),
+        "get_event_point_payload": lambda: bench_payload_builder(site, udmi_handler.get_event_point_payload),
+        "get_event_point_payload_cov": lambda: bench_payload_builder(site, udmi_handler.get_event_point_payload,
+                                                                     True),
+        "publish": lambda: bench_publish(site, max_inflight, ack_delay),
+    }
+    results = {}
+    for case in cases:
+        gc.collect()
+        results[case] = benchmarks[case]()
+    return results
+
+
+def fill_device_state(site):
+    """
+    Apply the decoded frames of the first meter of each type to all the meters of the type, so the meters
+    beyond the Modbus address range, which get no frames, have a state as well.
+    """
+    # meter type -> {first register: data} of the register blocks of the first meter of the type
+    polled = {}
+    frames_data = {}
+    for frame in map(decode_payload, site["frames"]):
+        meter_type = site["devices"][frame.slave_id][1]
+        if polled.setdefault(meter_type, frame.slave_id) == frame.slave_id and frame.data:
+            frames_data.setdefault(meter_type, {})[min(frame.data)] = frame.data
+    site["frames_data"] = {meter_type: list(blocks.values()) for meter_type, blocks in frames_data.items()}
+    apply_frames_data(site)
+
+
+def apply_frames_data(site, offset=0):
+    """
+    Args:
+        offset: added to the float values, so the points change from one round to the next
+    """
+    for slave_id, (_, meter_type) in site["devices"].items():
+        for data in site["frames_data"][meter_type]:
+            if offset:
+                data = {register: value + offset if isinstance(value, float) else value
+                        for register, value in data.items()}
+            site["udmi_handler"].apply_frame(slave_id, data)
+
+
+def _get_filled_queue(frames):
+    frames_queue = queue.Queue()
+    for payload in frames:
+        frames_queue.put((time.time(), payload))
+    return frames_queue
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=synthetic_site.ROOT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(devices_counts, frames_per_device, cases, max_inflight, ack_delay, seed):
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    results = {}
+    for devices_count in devices_counts:
+        root_dir = synthetic_site.create_root_dir(synthetic_site.get_devices(devices_count))
+        try:
+            decode_plan_cache.set_root_dir(root_dir)
+            site = build_site(logger, devices_count, frames_per_device, seed)
+            results[str(devices_count)] = run_cases(site, cases, max_inflight, ack_delay)
+        finally:
+            shutil.rmtree(root_dir)
+
+    return {
+        "benchmark": "hot_paths",
+        "created": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {
+            "frames_per_device": frames_per_device,
+            "max_inflight": max_inflight,
+            "ack_delay_ms": ack_delay * 1000,
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def print_results(results, baseline=None):
+    print(f"{results['machine']}, {results['cpu_count']} CPUs, Python {results['python']}, "
+          f"commit {results['git_commit']}")
+    header = f"{'devices':>7} {'case':<28} {'ops/s':>12} {'p50 us':>10} {'p99 us':>10}"
+    if baseline is not None:
+        header += f" {'vs baseline':>12}"
+    print(header)
+    for devices, cases in results["results"].items():
+        for case, result in cases.items():
+            line = f"{devices:>7} {case:<28} {result['operations_per_second']:>12.0f} " \
+                   f"{result['p50_us']:>10.1f} {result['p99_us']:>10.1f}"
+            if baseline is not None:
+                previous = baseline["results"].get(devices, {}).get(case)
+                if previous and previous["operations_per_second"]:
+                    line += f" {result['operations_per_second'] / previous['operations_per_second']:>11.2f}x"
+                else:
+                    line += f" {'-':>12}"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", default=",".join(str(devices) for devices in DEFAULT_DEVICES),
+                        help="comma separated numbers of meters of the synthetic sites")
+    parser.add_argument("--frames-per-device", type=int, default=20, help="frames synthesized per meter")
+    parser.add_argument("--cases", default=",".join(CASES), help="comma separated cases to run")
+    parser.add_argument("--max-inflight", type=int, default=20, help="publishes waiting for PUBACK at once")
+    parser.add_argument("--ack-delay", type=float, default=0.0, help="PUBACK delay of the fake broker in ms")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON into this file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    cases = args.cases.split(",")
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error(f"unknown cases {sorted(unknown)}, available cases: {', '.join(CASES)}")
+
+    devices_counts = [int(devices) for devices in args.devices.split(",")]
+    results = run(devices_counts, args.frames_per_device, cases, args.max_inflight, args.ack_delay / 1000,
+                  args.seed)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
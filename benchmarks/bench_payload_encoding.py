@@ -0,0 +1,140 @@
+"""Bytes on the wire per device per hour of the 'events/pointset' payloads, for each payload encoding.
+
+The devices of the site configuration are loaded with their UDMI Site Model, their points follow a random walk
+of float32 values (as read from the meters), and a pointset payload is built every publish interval.
+
+Usage:
+    python benchmarks/bench_payload_encoding.py [--interval 60] [--publish-mode full|cov] [--json]
+"""
+
+import os
+import sys
+import json
+import random
+import struct
+import logging
+import argparse
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+from google_iot_core_gateway.payload_encoding import ENCODINGS, PayloadEncoder  # noqa: E402
+from google_iot_core_gateway.udmi_handler.udmi_handler import UDMIHandler  # noqa: E402
+
+TOPIC = "events/pointset"
+
+# MQTT 3.1.1 PUBLISH QoS 1: fixed header, topic length, packet identifier. PUBACK: 4 bytes
+MQTT_PUBLISH_OVERHEAD = 1 + 2 + 2
+MQTT_PUBACK_SIZE = 4
+# TLS 1.2 AES-GCM record: header, explicit nonce, tag
+TLS_RECORD_OVERHEAD = 5 + 8 + 16
+
+FLOAT32 = struct.Struct(">f")
+
+
+def get_remaining_length_size(remaining_length):
+    size = 1
+    while remaining_length >= 128:
+        remaining_length //= 128
+        size += 1
+    return size
+
+
+def get_wire_size(device_id, payload_size):
+    """
+    Returns:
+        Bytes sent and received over TLS to publish the payload with QoS 1
+    """
+    topic_size = len(f"/devices/{device_id}/{TOPIC}")
+    remaining_length = topic_size + payload_size + MQTT_PUBLISH_OVERHEAD - 1
+    publish_size = 1 + get_remaining_length_size(remaining_length) + remaining_length
+    return publish_size + TLS_RECORD_OVERHEAD + MQTT_PUBACK_SIZE + TLS_RECORD_OVERHEAD
+
+
+def get_udmi_handler(logger):
+    with open(os.path.join(ROOT_DIR, "resources", "config-google-gateway.json")) as config_file:
+        devices = json.load(config_file)["site_details"]["proxy_ids"]
+
+    udmi_handler = UDMIHandler(logger, os.path.join(ROOT_DIR, "resources"), os.path.join(ROOT_DIR, "udmi_site_model"))
+    for device_id, device_details in devices.items():
+        udmi_handler.add_device_to_dict(device_details["modbus_slave_id"], device_id, device_details["type"])
+    return udmi_handler
+
+
+def run(interval, publish_mode, hours, seed):
+    logger = logging.getLogger(__name__)
+    random.seed(seed)
+
+    udmi_handler = get_udmi_handler(logger)
+    point_names = set()
+    for device_details in udmi_handler.devices.values():
+        point_names.update(device_details["points"])
+    encoders = {encoding: PayloadEncoder(logger, {TOPIC: encoding}, point_names) for encoding in ENCODINGS}
+
+    values = {}
+    intervals = int(hours * 3600 / interval)
+    payload_bytes = {encoding: 0 for encoding in ENCODINGS}
+    wire_bytes = {encoding: 0 for encoding in ENCODINGS}
+    messages = 0
+    for _ in range(intervals):
+        for device, device_details in udmi_handler.devices.items():
+            timestamp = udmi_handler.get_timestamp()
+            for index, (point, record) in enumerate(device_details["points"].items()):
+                value = values.get((device, point), 100.0 + index)
+                value = FLOAT32.unpack(FLOAT32.pack(value * (1 + random.gauss(0, 0.002))))[0]
+                values[(device, point)] = value
+                record.update(value, timestamp)
+
+            payload = udmi_handler.get_event_point_payload(device, changed_only=publish_mode == "cov")
+            if payload is None:
+                continue
+            messages += 1
+            for encoding, encoder in encoders.items():
+                encoded = encoder.encode(TOPIC, payload)
+                size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+                payload_bytes[encoding] += size
+                wire_bytes[encoding] += get_wire_size(device_details["device_id"], size)
+
+    device_hours = len(udmi_handler.devices) * hours
+    return {
+        "interval_seconds": interval,
+        "publish_mode": publish_mode,
+        "devices": len(udmi_handler.devices),
+        "messages": messages,
+        "zlib_dictionary_bytes": len(encoders["zlib"].json_zlib_dictionary),
+        "encodings": {
+            encoding: {
+                "payload_bytes_per_message": payload_bytes[encoding] / messages if messages else 0,
+                "payload_bytes_per_device_hour": payload_bytes[encoding] / device_hours,
+                "wire_bytes_per_device_hour": wire_bytes[encoding] / device_hours,
+                "wire_ratio_to_json": wire_bytes[encoding] / wire_bytes["json"] if wire_bytes["json"] else 0,
+            } for encoding in ENCODINGS
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--interval", type=float, default=60, help="publish interval in seconds")
+    parser.add_argument("--publish-mode", choices=("full", "cov"), default="full")
+    parser.add_argument("--hours", type=float, default=1, help="simulated time in hours")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = run(args.interval, args.publish_mode, args.hours, args.seed)
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print(f"{results['devices']} devices, {results['messages']} pointset messages, "
+          f"interval {results['interval_seconds']}s, publish mode '{results['publish_mode']}'")
+    print(f"{'encoding':<10} {'bytes/message':>14} {'payload B/device/h':>19} {'wire B/device/h':>16} {'vs json':>8}")
+    for encoding, result in results["encodings"].items():
+        print(f"{encoding:<10} {result['payload_bytes_per_message']:>14.0f} "
+              f"{result['payload_bytes_per_device_hour']:>19.0f} {result['wire_bytes_per_device_hour']:>16.0f} "
+              f"{result['wire_ratio_to_json']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Local fake MQTT 3.1.1 broker for the benchmarks.
+
+It accepts any client, acknowledges CONNECT, SUBSCRIBE, PINGREQ and the QoS 1 PUBLISH packets, and counts the
+received messages. The PUBACKs can be delayed to emulate the round trip to the Google Cloud, so the in-flight
+window of the publish pipeline comes into play. The messages are forwarded with QoS 0 to the clients subscribed
+to their topic, so the broker can also stand in for the MXcloudgate internal broker.
+"""
+
+import time
+import heapq
+import socket
+import struct
+import threading
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def read_exactly(connection, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+
+def read_packet(connection):
+    """
+    Returns:
+        (packet type, flags, variable header and payload)
+    """
+    first_byte = read_exactly(connection, 1)[0]
+    remaining_length = 0
+    multiplier = 1
+    while True:
+        byte = read_exactly(connection, 1)[0]
+        remaining_length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    return first_byte >> 4, first_byte & 0x0F, read_exactly(connection, remaining_length)
+
+
+def encode_remaining_length(remaining_length):
+    encoded = bytearray()
+    while True:
+        byte = remaining_length % 128
+        remaining_length //= 128
+        encoded.append(byte | 0x80 if remaining_length else byte)
+        if not remaining_length:
+            return bytes(encoded)
+
+
+def is_topic_matching(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels) or level not in ("+", topic_levels[index]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class Session:
+    """
+    Connection of a client, the packets are sent under a lock as they are sent by several threads.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.subscriptions = []
+        self._lock = threading.Lock()
+
+    def send(self, packet):
+        with self._lock:
+            self.connection.sendall(packet)
+
+
+class FakeMQTTBroker:
+    """
+    Args:
+        ack_delay: time in seconds the PUBACKs are delayed
+        host: address to listen on
+        port: port to listen on, any free port by default, see address
+    """
+
+    def __init__(self, ack_delay=0.0, host="127.0.0.1", port=0):
+        self.ack_delay = ack_delay
+        self._server = socket.create_server((host, port))
+        self._thread = threading.Thread(target=self._accept, name="fake-broker", daemon=True)
+        self._sessions = []
+
+        self.messages = 0
+        self.payload_bytes = 0
+        self.forwarded = 0
+
+    @property
+    def address(self):
+        return self._server.getsockname()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.close()
+
+    def has_subscriber(self, topic):
+        return any(is_topic_matching(topic_filter, topic)
+                   for session in list(self._sessions) for topic_filter in session.subscriptions)
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(Session(connection),), daemon=True).start()
+
+    def _forward(self, topic, payload):
+        topic = topic.decode()
+        packet = None
+        for session in list(self._sessions):
+            if not any(is_topic_matching(topic_filter, topic) for topic_filter in session.subscriptions):
+                continue
+            if packet is None:
+                encoded_topic = struct.pack(">H", len(topic)) + topic.encode()
+                packet = bytes((PUBLISH << 4,)) + encode_remaining_length(len(encoded_topic) + len(payload)) + \
+                    encoded_topic + payload
+            try:
+                session.send(packet)
+                self.forwarded += 1
+            except OSError:
+                pass
+
+    def _serve(self, session):
+        # (due time, sequence, packet) of the delayed PUBACKs
+        delayed = []
+        condition = threading.Condition()
+        closed = threading.Event()
+        if self.ack_delay:
+            threading.Thread(target=self._send_delayed, args=(session, delayed, condition, closed),
+                             daemon=True).start()
+
+        try:
+            sequence = 0
+            while True:
+                packet_type, flags, data = read_packet(session.connection)
+                if packet_type == CONNECT:
+                    session.send(bytes((CONNACK << 4, 2, 0, 0)))
+                    self._sessions.append(session)
+                elif packet_type == PUBLISH:
+                    topic_length = struct.unpack_from(">H", data)[0]
+                    qos = (flags >> 1) & 0x03
+                    offset = 2 + topic_length + (2 if qos else 0)
+                    self.messages += 1
+                    self.payload_bytes += len(data) - offset
+                    self._forward(data[2:2 + topic_length], data[offset:])
+                    if not qos:
+                        continue
+                    puback = bytes((PUBACK << 4, 2)) + data[2 + topic_length:offset]
+                    if not self.ack_delay:
+                        session.send(puback)
+                        continue
+                    with condition:
+                        sequence += 1
+                        heapq.heappush(delayed, (time.monotonic() + self.ack_delay, sequence, puback))
+                        condition.notify()
+                elif packet_type == SUBSCRIBE:
+                    # packet identifier, then (topic filter, requested QoS) pairs
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(data):
+                        filter_length = struct.unpack_from(">H", data, offset)[0]
+                        session.subscriptions.append(data[offset + 2:offset + 2 + filter_length].decode())
+                        offset += 2 + filter_length + 1
+                        granted.append(0)
+                    session.send(bytes((SUBACK << 4, 2 + len(granted))) + data[:2] + bytes(granted))
+                elif packet_type == PINGREQ:
+                    session.send(bytes((PINGRESP << 4, 0)))
+                elif packet_type == DISCONNECT:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if session in self._sessions:
+                self._sessions.remove(session)
+            with condition:
+                closed.set()
+                condition.notify()
+            session.connection.close()
+
+    @staticmethod
+    def _send_delayed(session, delayed, condition, closed):
+        while True:
+            with condition:
+                while not delayed and not closed.is_set():
+                    condition.wait()
+                if closed.is_set():
+                    return
+                due, _, packet = delayed[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    condition.wait(wait)
+                    continue
+                heapq.heappop(delayed)
+            try:
+                session.send(packet)
+            except OSError:
+                return
@@ -0,0 +1,380 @@
+"""Replay a capture of the internal broker messages through the gateway pipeline, at real or accelerated speed.
+
+The messages are captured on the gateway with "capture_file" in the "internal_broker" section of the
+configuration, or -internal-broker-capture-file, see capture.py. They are fed back at the pace they were
+received (--speed 1), N times faster (--speed N) or as fast as possible (--speed 0):
+
+    --via queue     put into the FrameHandoff queue, as the subscriber does
+    --via broker    published to a local stand-in of the MXcloudgate internal broker (fake_mqtt_broker.py),
+                    and received by the MosquittoMQTTSubscriber of the gateway
+
+The messages are processed as in the threaded runtime and the payloads are published every --sample-rate
+seconds of capture time through the PublishPipeline to a fake Google Cloud broker. The replay reports the
+end-to-end throughput, the messages dropped by the queue, the published payloads and the stage latencies
+of the pipeline metrics.
+
+The meters of the capture are the meters of the gateway configuration in --root-dir, or the synthetic meters
+of --devices. A synthetic capture can be written with --synthesize, e.g. to replay the same traffic before
+and after a change:
+
+Usage:
+    python benchmarks/replay_capture.py CAPTURE --synthesize 30 [--rate 200] [--duration 60]
+    python benchmarks/replay_capture.py CAPTURE [--devices 30 | --root-dir DIR] [--speed 1] [--via queue]
+                                                [--sample-rate 10] [--json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic_site  # noqa: E402
+from fake_mqtt_broker import FakeMQTTBroker  # noqa: E402
+import paho.mqtt.client as mqtt  # noqa: E402
+from google_iot_core_gateway.gcp_handler import process_payloads, publish_payloads  # noqa: E402
+from google_iot_core_gateway.metrics import metrics  # noqa: E402
+from google_iot_core_gateway.modbus_gw.decode_plan import resolve_ext_config_path, read_json_file  # noqa: E402
+from google_iot_core_gateway.modbus_gw.modbus_to_json import decode_plan_cache, frame_cache  # noqa: E402
+from google_iot_core_gateway.publish_pipeline import PublishPipeline  # noqa: E402
+from google_iot_core_gateway.internal_broker_subscriber.capture import CaptureWriter, read_capture  # noqa: E402
+from google_iot_core_gateway.internal_broker_subscriber.frame_handoff import (FrameHandoff,  # noqa: E402
+                                                                             create_frames_queue, DROP_OLDEST,
+                                                                             OVERFLOW_POLICIES, QUEUE_TYPES,
+                                                                             RING_BUFFER)
+from google_iot_core_gateway.internal_broker_subscriber.internal_broker_subscriber import (  # noqa: E402
+    MosquittoMQTTSubscriber)
+
+INTERNAL_BROKER_TOPIC = "MXcloudgate"
+# Time in seconds the last messages and PUBACKs are waited for at the end of the replay
+DRAIN_TIMEOUT = 30
+# Time in seconds the processing loop waits for a message
+PROCESS_TIMEOUT = 0.05
+
+
+def write_synthetic_capture(logger, path, devices_count, rate, duration, seed):
+    """
+    Capture of the frames of a synthetic site (see synthetic_site.py) received at rate frames per second.
+    """
+    devices = synthetic_site.get_devices(devices_count)
+    frames = synthetic_site.build_frames(devices, int(rate * duration), seed)
+    capture = CaptureWriter(logger, path)
+    started_at = time.time()
+    for index, payload in enumerate(frames):
+        capture.write(payload, started_at + index / rate)
+    capture.close()
+    return len(frames)
+
+
+def get_site_devices(root_dir):
+    """
+    Returns:
+        {modbus slave ID: (device ID, meter type)} of the meters of the gateway configuration in root_dir
+    """
+    ext_conf = read_json_file(resolve_ext_config_path(root_dir, "resources", "config-google-gateway.json"))
+    return {device["modbus_slave_id"]: (device_id, device["type"])
+            for device_id, device in ext_conf["site_details"]["proxy_ids"].items()}
+
+
+def connect_client(broker, client_id):
+    client = mqtt.Client(client_id=client_id)
+    connected = []
+    client.on_connect = lambda client, user_data, flags, rc: connected.append(rc)
+    client.connect(*broker.address)
+    client.loop_start()
+    deadline = time.monotonic() + 10
+    while not connected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    if connected != [0]:
+        client.loop_stop()
+        raise RuntimeError(f"Connection to the fake MQTT broker failed: {connected}")
+    return client
+
+
+class CloudPublisher:
+    """
+    Stand-in for GoogleIoTCorePublisher, the payloads go through the PublishPipeline and a paho client to
+    the fake Google Cloud broker.
+    """
+
+    def __init__(self, logger, broker, max_inflight, max_queued):
+        self.client = connect_client(broker, "replay-cloud")
+        self.pipeline = PublishPipeline(logger, self._publish, lambda: True, max_inflight=max_inflight,
+                                        max_queued=max_queued)
+        self.client.on_publish = lambda client, user_data, mid: self.pipeline.on_publish(mid)
+
+    def _publish(self, device_id, payload, topic, qos):
+        return self.client.publish(f"/devices/{device_id}/{topic}", payload, qos=qos)
+
+    def publish(self, device_id, payload, topic="state", qos=1, supersede=True):
+        self.pipeline.submit(device_id, payload, topic, qos, supersede)
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class Feeder(threading.Thread):
+    """
+    Feed the records of the capture at speed times their captured pace, 0 for as fast as possible.
+
+    As fast as possible, the records are fed as soon as there is room in the queue: the replay then measures
+    the throughput of the pipeline rather than the messages dropped by the queue.
+
+    Args:
+        records: [(received_at, payload)] of the capture
+        deliver: function called with each payload
+        speed: replay speed
+        has_room: function returning whether there is room in the queue
+    """
+
+    def __init__(self, records, deliver, speed, has_room):
+        super().__init__(name="replay-feeder", daemon=True)
+        self.records = records
+        self.deliver = deliver
+        self.speed = speed
+        self.has_room = has_room
+
+        # capture time of the last fed record
+        self.position = records[0][0] if records else 0.0
+        self.fed = 0
+        self.done = threading.Event()
+
+    def run(self):
+        if self.records:
+            capture_start = self.records[0][0]
+            wall_start = time.monotonic()
+            for received_at, payload in self.records:
+                if self.speed:
+                    wait = wall_start + (received_at - capture_start) / self.speed - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                else:
+                    while not self.has_room():
+                        time.sleep(0.0001)
+                self.deliver(payload)
+                self.position = received_at
+                self.fed += 1
+        self.done.set()
+
+
+class CountingHandoff:
+    """
+    Hands the messages off to the FrameHandoff and counts them, to know when the fed messages all reached it.
+    """
+
+    def __init__(self, handoff):
+        self.handoff = handoff
+        self.received = 0
+
+    def put(self, payload, received_at=None):
+        self.handoff.put(payload, received_at)
+        self.received += 1
+
+
+def replay(logger, records, udmi_handler, speed=1.0, via="queue", sample_rate=10.0, publish_mode="full",
+           queue_type=RING_BUFFER, queue_size=50, overflow_policy=DROP_OLDEST, max_batch_size=100,
+           max_inflight=20, ack_delay=0.0):
+    """
+    Returns:
+        Results of the replay
+    """
+    handoff = FrameHandoff(logger, create_frames_queue(queue_type, queue_size), overflow_policy)
+    receiver = CountingHandoff(handoff)
+    cloud_broker = FakeMQTTBroker(ack_delay=ack_delay).start()
+    publisher = CloudPublisher(logger, cloud_broker, max_inflight,
+                               max_queued=max(1000, len(udmi_handler.devices) * 4))
+
+    internal_broker = client = subscriber = None
+    if via == "broker":
+        internal_broker = FakeMQTTBroker().start()
+        host, port = internal_broker.address
+        subscriber = MosquittoMQTTSubscriber(logger, receiver, host, port)
+        subscriber.run()
+        client = connect_client(internal_broker, "replay-feeder")
+        deadline = time.monotonic() + 10
+        while not internal_broker.has_subscriber(INTERNAL_BROKER_TOPIC) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        def deliver(payload):
+            client.publish(INTERNAL_BROKER_TOPIC, payload, qos=0)
+    else:
+        def deliver(payload):
+            receiver.put(payload, time.time())
+
+    metrics.reset()
+    metrics.enable()
+    feeder = Feeder(records, deliver, speed, lambda: handoff.qsize() < queue_size)
+    processed = 0
+    publish_intervals = 0
+    next_publish_position = feeder.position + sample_rate
+    try:
+        started = time.perf_counter()
+        feeder.start()
+        drain_deadline = None
+        while True:
+            processed += process_payloads(logger, handoff, udmi_handler, PROCESS_TIMEOUT,
+                                          max_batch_size=max_batch_size)
+            while feeder.position >= next_publish_position:
+                publish_payloads(logger, publisher, udmi_handler, sample_rate, publish_mode)
+                publish_intervals += 1
+                next_publish_position += sample_rate
+            publisher.pipeline.pump()
+
+            if not feeder.done.is_set():
+                continue
+            if drain_deadline is None:
+                drain_deadline = time.monotonic() + DRAIN_TIMEOUT
+            if (receiver.received >= feeder.fed and not handoff.qsize()) or \
+                    time.monotonic() > drain_deadline:
+                break
+        processing_elapsed = time.perf_counter() - started
+
+        # payloads of the last, partial, interval
+        publish_payloads(logger, publisher, udmi_handler, sample_rate, publish_mode)
+        publish_intervals += 1
+        pipeline = publisher.pipeline
+        while (pipeline.qsize() or pipeline.acknowledged + pipeline.failed < pipeline.sent) and \
+                time.monotonic() < drain_deadline:
+            pipeline.pump()
+            time.sleep(0.0005)
+        elapsed = time.perf_counter() - started
+    finally:
+        metrics.disable()
+        publisher.stop()
+        cloud_broker.stop()
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
+            subscriber.client.loop_stop()
+            subscriber.client.disconnect()
+            internal_broker.stop()
+
+    capture_duration = records[-1][0] - records[0][0] if records else 0.0
+    counters = pipeline.get_counters()
+    snapshot = metrics.get_snapshot()
+    stages = {name[len("stage_seconds"):]: {key: value * 1e6 if key != "count" and value is not None else value
+                                            for key, value in histogram.items()}
+              for name, histogram in snapshot["histograms"].items() if name.startswith("stage_seconds")}
+    return {
+        "records": len(records),
+        "capture_duration_seconds": capture_duration,
+        "speed": speed,
+        "via": via,
+        "elapsed_seconds": elapsed,
+        "fed": feeder.fed,
+        "processed": processed,
+        "processed_per_second": processed / processing_elapsed if processing_elapsed else None,
+        "queue": {
+            "enqueued": handoff.enqueued,
+            "dropped": handoff.dropped,
+            "coalesced": handoff.coalesced,
+            "lost": feeder.fed - receiver.received,
+        },
+        "frame_cache": frame_cache.get_counters() if frame_cache.enabled else None,
+        "publish_intervals": publish_intervals,
+        "payloads": counters,
+        "payload_bytes": cloud_broker.payload_bytes,
+        "puback_p50_us": (pipeline.latency.percentile(50) or 0) * 1e6,
+        "puback_p99_us": (pipeline.latency.percentile(99) or 0) * 1e6,
+        "stages_us": stages,
+    }
+
+
+def print_results(results):
+    print(f"{results['records']} records, {results['capture_duration_seconds']:.1f}s captured, replayed via "
+          f"{results['via']} at {'max speed' if not results['speed'] else str(results['speed']) + 'x'} "
+          f"in {results['elapsed_seconds']:.1f}s")
+    print(f"  processed {results['processed']} of {results['fed']} fed messages, "
+          f"{results['processed_per_second']:.0f}/s end-to-end")
+    queue = results["queue"]
+    print(f"  queue: {queue['enqueued']} enqueued, {queue['dropped']} dropped, {queue['coalesced']} coalesced, "
+          f"{queue['lost']} lost")
+    if results["frame_cache"] is not None:
+        frame_cache_counters = results["frame_cache"]
+        print(f"  frame cache: {frame_cache_counters['hits']} unchanged frames not decoded, "
+              f"{frame_cache_counters['misses']} decoded, {frame_cache_counters['blocks']} register blocks")
+    payloads = results["payloads"]
+    print(f"  {results['publish_intervals']} publish intervals: {payloads['sent']} payloads sent, "
+          f"{payloads['acknowledged']} acknowledged, {payloads['superseded']} superseded, "
+          f"{payloads['dropped']} dropped, {results['payload_bytes']} bytes, "
+          f"PUBACK p50 {results['puback_p50_us']:.0f}us p99 {results['puback_p99_us']:.0f}us")
+    for stage, histogram in results["stages_us"].items():
+        print(f"  {stage}: {histogram['count']} samples, p50 {histogram['p50'] or 0:.0f}us, "
+              f"p99 {histogram['p99'] or 0:.0f}us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--synthesize", type=int, metavar="DEVICES",
+                        help="write a capture of the frames of a synthetic site of DEVICES meters and exit")
+    parser.add_argument("--rate", type=float, default=200, help="frames per second of the synthetic capture")
+    parser.add_argument("--duration", type=float, default=60, help="duration in seconds of the synthetic capture")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--devices", type=int, help="replay with a synthetic site of DEVICES meters")
+    parser.add_argument("--root-dir", default=synthetic_site.ROOT_DIR,
+                        help="directory of the gateway configuration of the captured site")
+    parser.add_argument("--udmi-site-model", help="UDMI Site Model of the captured site")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed: 1 as captured, N times faster, 0 as fast as possible")
+    parser.add_argument("--via", choices=("queue", "broker"), default="queue")
+    parser.add_argument("--sample-rate", type=float, default=10.0,
+                        help="seconds of capture time between the payload publishes")
+    parser.add_argument("--publish-mode", choices=("full", "cov"), default="full")
+    parser.add_argument("--queue-type", choices=QUEUE_TYPES, default=RING_BUFFER)
+    parser.add_argument("--queue-size", type=int, default=50)
+    parser.add_argument("--overflow-policy", choices=OVERFLOW_POLICIES, default=DROP_OLDEST)
+    parser.add_argument("--max-batch-size", type=int, default=100)
+    parser.add_argument("--deduplicate-frames", action="store_true",
+                        help="do not decode again the frames identical to the last frame of their register block")
+    parser.add_argument("--max-inflight", type=int, default=20, help="publishes waiting for PUBACK at once")
+    parser.add_argument("--ack-delay", type=float, default=0.0, help="PUBACK delay of the fake broker in ms")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    if args.synthesize:
+        count = write_synthetic_capture(logger, args.capture, args.synthesize, args.rate, args.duration, args.seed)
+        print(f"{count} frames of {args.synthesize} meters written into '{args.capture}'")
+        return
+
+    records = list(read_capture(args.capture))
+    if args.deduplicate_frames:
+        frame_cache.enable()
+    root_dir = None
+    try:
+        if args.devices:
+            devices = synthetic_site.get_devices(args.devices)
+            root_dir = synthetic_site.create_root_dir(devices)
+            decode_plan_cache.set_root_dir(root_dir)
+        else:
+            devices = get_site_devices(args.root_dir)
+            decode_plan_cache.set_root_dir(args.root_dir)
+        udmi_handler = synthetic_site.get_udmi_handler(logger, devices, udmi_site_model_path=args.udmi_site_model)
+
+        results = replay(logger, records, udmi_handler, speed=args.speed, via=args.via,
+                         sample_rate=args.sample_rate, publish_mode=args.publish_mode, queue_type=args.queue_type,
+                         queue_size=args.queue_size, overflow_policy=args.overflow_policy,
+                         max_batch_size=args.max_batch_size, max_inflight=args.max_inflight,
+                         ack_delay=args.ack_delay / 1000)
+    finally:
+        if root_dir is not None:
+            shutil.rmtree(root_dir)
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
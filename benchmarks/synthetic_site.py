@@ -0,0 +1,157 @@
+"""Synthetic site for the benchmarks: any number of meters built from the devices of the example site.
+
+Meter i gets the Modbus slave ID i and the meter type and UDMI Site Model device of EM-1, EM-2 or EM-3 in turn.
+The FC3/FC4 frames are built from the register blocks of the meter definition files, with float32 values
+in the registers of the points, as the internal broker would receive them. A Modbus bus addresses at most 247
+slaves, only the meters up to MAX_SLAVE_ID are polled on larger sites.
+"""
+
+import os
+import sys
+import json
+import random
+import struct
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+from google_iot_core_gateway.modbus_gw.decode_plan import (DecodePlan, get_nested_key_value_pairs,  # noqa: E402
+                                                           read_json_file)
+from google_iot_core_gateway.udmi_handler.udmi_handler import UDMIHandler  # noqa: E402
+
+# Maximum quantity of registers of an FC3/FC4 request
+MAX_QUANTITY_OF_REGISTERS = 125
+# Highest Modbus slave ID (address) of a meter
+MAX_SLAVE_ID = 247
+# struct formats of the point values written into the synthetic responses
+VALUE_FORMATS = {
+    "float32": ">f",
+    "int64": ">q",
+    "int32u": ">I",
+    "int16u": ">H",
+}
+
+
+def get_crc(frame):
+    """
+    CRC-16/Modbus of the frame, little endian as sent on the bus.
+    """
+    crc = 0xFFFF
+    for byte in frame:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack("<H", crc)
+
+
+def get_template_devices():
+    with open(os.path.join(ROOT_DIR, "resources", "config-google-gateway.json")) as config_file:
+        devices = json.load(config_file)["site_details"]["proxy_ids"]
+    return sorted(devices.items(), key=lambda device: device[1]["modbus_slave_id"])
+
+
+def get_devices(count):
+    """
+    Returns:
+        {modbus slave ID: (device ID in the UDMI Site Model, meter type)} of the synthetic meters
+    """
+    templates = get_template_devices()
+    return {slave_id: (templates[(slave_id - 1) % len(templates)][0],
+                       templates[(slave_id - 1) % len(templates)][1]["type"])
+            for slave_id in range(1, count + 1)}
+
+
+def create_root_dir(devices):
+    """
+    Directory with the configuration of the synthetic meters and the meter definition files of the repo,
+    to be read by the decoder, see DecodePlanCache.set_root_dir.
+    """
+    root_dir = tempfile.mkdtemp(prefix="synthetic_site_")
+    os.makedirs(os.path.join(root_dir, "resources"))
+    os.symlink(os.path.join(ROOT_DIR, "resources", "modbus_dbo_maps"),
+               os.path.join(root_dir, "resources", "modbus_dbo_maps"))
+    proxy_ids = {f"EM-{slave_id}": {"type": meter_type, "modbus_slave_id": slave_id}
+                 for slave_id, (_, meter_type) in devices.items()}
+    with open(os.path.join(root_dir, "resources", "config-google-gateway.json"), "w") as config_file:
+        json.dump({"site_details": {"gateway_id": "CGW-1", "proxy_ids": proxy_ids}}, config_file)
+    return root_dir
+
+
+def get_udmi_handler(logger, devices, point_timestamp="update", udmi_site_model_path=None):
+    udmi_handler = UDMIHandler(logger, os.path.join(ROOT_DIR, "resources"),
+                               udmi_site_model_path or os.path.join(ROOT_DIR, "udmi_site_model"),
+                               point_timestamp=point_timestamp)
+    for slave_id, (device_id, meter_type) in devices.items():
+        udmi_handler.add_device_to_dict(slave_id, device_id, meter_type)
+    return udmi_handler
+
+
+def get_dbo_map(meter_type):
+    path = os.path.join(ROOT_DIR, "resources", "modbus_dbo_maps", meter_type + ".json")
+    return dict(get_nested_key_value_pairs(read_json_file(path)))
+
+
+def get_register_blocks(dbo_map):
+    """
+    Register blocks (starting address, quantity) covering the decodable points of the meter definition file,
+    as a Modbus master polling the meter would request them.
+    """
+    registers = sorted((int(address), properties["number_of_registers"]) for address, properties in dbo_map.items()
+                       if address.isdigit() and properties.get("format") in VALUE_FORMATS)
+    blocks = []
+    start = end = None
+    for address, number_of_registers in registers:
+        # the decoder addresses the registers one below the meter definition file
+        if start is None or address + number_of_registers - 1 - start > MAX_QUANTITY_OF_REGISTERS:
+            if start is not None:
+                blocks.append((start, end - start))
+            start = address - 1
+        end = max(end or 0, address - 1 + number_of_registers)
+    if start is not None:
+        blocks.append((start, end - start))
+    return blocks
+
+
+def build_response(slave_id, function_code, plan, rng):
+    data = bytearray(plan.quantity_of_registers * 2)
+    for point in plan.points:
+        if point.error is not None:
+            continue
+        value_format = VALUE_FORMATS[point.data_format]
+        if point.data_format == "float32":
+            value = rng.uniform(0, 500)
+        else:
+            value = rng.randrange(0, 1 << (8 * struct.calcsize(value_format) - 1))
+        struct.pack_into(value_format, data, point.start_index, value)
+    response = struct.pack(">BBB", slave_id, function_code, len(data)) + bytes(data)
+    return response + get_crc(response)
+
+
+def build_frames(devices, count, seed=1):
+    """
+    Returns:
+        Internal broker messages (JSON bytes) of count FC3/FC4 frames polling the meters up to MAX_SLAVE_ID in turn
+    """
+    rng = random.Random(seed)
+    polls = []
+    plans = {}
+    for slave_id, (_, meter_type) in devices.items():
+        if slave_id > MAX_SLAVE_ID:
+            continue
+        if meter_type not in plans:
+            dbo_map = get_dbo_map(meter_type)
+            plans[meter_type] = [DecodePlan.compile(meter_type, dbo_map, start, quantity)
+                                 for start, quantity in get_register_blocks(dbo_map)]
+        for plan in plans[meter_type]:
+            polls.append((slave_id, plan))
+
+    frames = []
+    for index in range(count):
+        slave_id, plan = polls[index % len(polls)]
+        function_code = 3 if index % 2 else 4
+        request = struct.pack(">BBHH", slave_id, function_code, plan.starting_address, plan.quantity_of_registers)
+        request += get_crc(request)
+        response = build_response(slave_id, function_code, plan, rng)
+        frames.append(json.dumps({"rtu_request": request.hex(), "rtu_response": response.hex()}).encode())
+    return frames
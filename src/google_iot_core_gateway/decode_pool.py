@@ -0,0 +1,289 @@
+import time
+import pickle
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+
+from google_iot_core_gateway.modbus_gw.modbus_to_json import (DecodedFrame, decode_payload, decode_plan_cache,
+                                                               frame_cache, set_crc_verification)
+
+# Batches a worker can have in flight, each one has its slot in the result buffer of the worker
+RESULT_SLOTS = 4
+# Size in bytes of a result slot, larger results are sent through the pipe of the worker
+RESULT_SLOT_SIZE = 256 * 1024
+# Time in seconds a worker has to run before it stops for it to be restarted
+MIN_WORKER_UPTIME = 5.0
+
+
+def get_slave_id(payload):
+    """
+    Modbus slave ID of the internal broker message, read from the first byte of the RTU request
+    without parsing the JSON message.
+    Returns:
+        Slave ID, None if the message is malformed
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    start = payload.find(b'"rtu_request"')
+    if start < 0:
+        return None
+    start = payload.find(b'"', start + len(b'"rtu_request"'))
+    try:
+        return int(payload[start + 1:start + 3], 16)
+    except ValueError:
+        return None
+
+
+def _run_worker(connection, results_buffer, root_dir, deduplicate_frames=False, verify_crc=True):
+    """
+    Decode the batches of messages received through the connection until None is received.
+
+    The results of a batch, [(received_at, DecodedFrame fields or None, error message or None)],
+    are pickled into the slot of the batch in the results buffer shared with the pool.
+    """
+    buffer = memoryview(results_buffer).cast("B")
+    if root_dir is not None:
+        decode_plan_cache.set_root_dir(root_dir)
+    decode_plan_cache.preload()
+    # the frames of a device are always decoded by the same worker, its frame cache sees all of them
+    if deduplicate_frames:
+        frame_cache.enable()
+    set_crc_verification(verify_crc)
+
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        slot, items = request
+
+        results = []
+        for received_at, payload in items:
+            try:
+                frame = decode_payload(payload)
+            except Exception as ex:
+                results.append((received_at, None, f"Caught an Exception when processing queue item. Exception: {ex}"))
+                continue
+            if frame is not None:
+                frame = (frame.slave_id, frame.fc, frame.data, frame.error, frame.starting_address,
+                         frame.quantity_of_registers, frame.unchanged, frame.crc_error)
+            results.append((received_at, frame, None))
+
+        data = pickle.dumps(results, pickle.HIGHEST_PROTOCOL)
+        if len(data) > RESULT_SLOT_SIZE:
+            connection.send((slot, len(data), data))
+            continue
+        offset = slot * RESULT_SLOT_SIZE
+        buffer[offset:offset + len(data)] = data
+        connection.send((slot, len(data), None))
+
+    buffer.release()
+
+
+class DecodeWorkerPool:
+    """
+    Pool of worker processes decoding the Modbus frames, for sites whose frame rate exceeds what one core decodes.
+
+    The messages are partitioned by Modbus slave ID, so the frames of a device are always decoded by the same
+    worker and their results come back in order. Each worker loads the meter definition files once and keeps
+    its own decode plans. The decoded frames are pickled into a buffer shared with the worker, only the slot
+    and length go through its pipe, and are applied to the UDMI device state by the owner of the pool.
+
+    The workers are spawned, not forked, the process already runs the paho network threads.
+
+    Args:
+        logger: logger
+        workers: number of worker processes
+        batch_size: maximum number of messages sent to a worker at once
+        root_dir: directory of the configuration and meter definition files, the package ROOT_DIR by default
+        deduplicate_frames: the workers do not decode again the frames identical to the last frame of their
+                            register block, see FrameCache
+        verify_crc: the workers reject the responses whose CRC does not match
+    """
+
+    def __init__(self, logger, workers, batch_size=100, root_dir=None, deduplicate_frames=False, verify_crc=True):
+        self.logger = logger
+        self.workers = workers
+        self.batch_size = batch_size
+        self.root_dir = root_dir
+        self.deduplicate_frames = deduplicate_frames
+        self.verify_crc = verify_crc
+
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * workers
+        self._started_at = [None] * workers
+        self._connections = [None] * workers
+        self._buffers = [None] * workers
+        self._free_slots = [None] * workers
+        # slot -> batch sent to the worker, sent again if the worker stops
+        self._batches = [{} for _ in range(workers)]
+        # messages waiting for a free slot of the worker
+        self._pending = [deque() for _ in range(workers)]
+        # number of batches sent to the workers whose results were not received yet
+        self._in_flight = 0
+        # results received while waiting for a free slot, returned by the next collect
+        self._results = deque()
+
+        self.submitted = 0
+        self.decoded = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.restarts = 0
+
+    def start(self):
+        for index in range(self.workers):
+            self._start_worker(index)
+        self.logger.info(f"{self.workers} decode workers started")
+
+    def _start_worker(self, index):
+        connection, worker_connection = self._context.Pipe()
+        results_buffer = self._context.RawArray("B", RESULT_SLOTS * RESULT_SLOT_SIZE)
+        process = self._context.Process(target=_run_worker, args=(worker_connection, results_buffer, self.root_dir,
+                                                                       self.deduplicate_frames, self.verify_crc),
+                                        name=f"decode-worker-{index}", daemon=True)
+        process.start()
+        worker_connection.close()
+
+        self._processes[index] = process
+        self._started_at[index] = time.monotonic()
+        self._connections[index] = connection
+        self._buffers[index] = memoryview(results_buffer).cast("B")
+        self._free_slots[index] = deque(range(RESULT_SLOTS))
+
+    def _restart_worker(self, index):
+        if time.monotonic() - self._started_at[index] < MIN_WORKER_UPTIME:
+            raise RuntimeError(f"Decode worker {index} stopped right after it was started "
+                               f"(exit code {self._processes[index].exitcode})")
+
+        batches = self._batches[index]
+        self.logger.error(f"Decode worker {index} stopped, restarting it. {len(batches)} batches are decoded again")
+        self._in_flight -= len(batches)
+        # in the order they were sent, ahead of the pending messages
+        for batch in reversed(list(batches.values())):
+            self._pending[index].extendleft(reversed(batch))
+        batches.clear()
+        self._connections[index].close()
+        self._processes[index].join(timeout=1)
+        self.restarts += 1
+        self._start_worker(index)
+
+    def submit(self, items):
+        """
+        Send the messages to the workers of their devices.
+
+        Waits for results when a worker has all its slots in flight and more than a batch waiting.
+        Args:
+            items: [(received_at, payload)] in the order they were received
+        """
+        for item in items:
+            slave_id = get_slave_id(item[1])
+            self._pending[(slave_id or 0) % self.workers].append(item)
+        self.submitted += len(items)
+
+        for index in range(self.workers):
+            self._dispatch(index)
+            while len(self._pending[index]) >= self.batch_size and not self._free_slots[index]:
+                self._receive(index)
+                self._dispatch(index)
+
+    def _dispatch(self, index):
+        pending = self._pending[index]
+        free_slots = self._free_slots[index]
+        while pending and free_slots:
+            batch = [pending.popleft() for _ in range(min(len(pending), self.batch_size))]
+            try:
+                self._connections[index].send((free_slots[0], batch))
+            except (BrokenPipeError, OSError):
+                # the batch is sent again to the restarted worker
+                pending.extendleft(reversed(batch))
+                self._restart_worker(index)
+                return
+            self._batches[index][free_slots.popleft()] = batch
+            self._in_flight += 1
+
+    def _receive(self, index):
+        """
+        Wait for the next results of the worker, they are kept until the next collect.
+        Returns:
+            False if the worker stopped and was restarted
+        """
+        try:
+            slot, length, data = self._connections[index].recv()
+        except (EOFError, OSError):
+            self._restart_worker(index)
+            return False
+
+        if data is None:
+            offset = slot * RESULT_SLOT_SIZE
+            data = self._buffers[index][offset:offset + length]
+        results = pickle.loads(data)
+        del self._batches[index][slot]
+        self._free_slots[index].append(slot)
+        self._in_flight -= 1
+        self._results.extend(results)
+        return True
+
+    def collect(self, timeout=0.0):
+        """
+        Args:
+            timeout: time in seconds to wait for results if none are ready
+        Returns:
+            [(received_at, DecodedFrame or None, error message or None)] of the decoded messages
+        """
+        # messages put back when a worker was restarted
+        for index, pending in enumerate(self._pending):
+            if pending:
+                self._dispatch(index)
+
+        if self._in_flight:
+            ready = wait(self._connections, 0.0 if self._results else max(timeout, 0.0))
+            for index, connection in enumerate(self._connections):
+                if connection not in ready:
+                    continue
+                while self._connections[index].poll():
+                    if not self._receive(index):
+                        break
+                self._dispatch(index)
+
+        results = []
+        while self._results:
+            received_at, frame, error = self._results.popleft()
+            if frame is not None:
+                frame = DecodedFrame(*frame)
+            if error is not None:
+                self.failed += 1
+            elif frame is not None and frame.unchanged:
+                self.unchanged += 1
+            else:
+                self.decoded += 1
+            results.append((received_at, frame, error))
+        return results
+
+    def is_busy(self):
+        """
+        Returns:
+            True if submitted messages are still decoded or their results not collected yet
+        """
+        return bool(self._in_flight or self._results or any(self._pending))
+
+    def get_counters(self):
+        return {
+            "submitted": self.submitted,
+            "decoded": self.decoded,
+            "unchanged": self.unchanged,
+            "failed": self.failed,
+            "restarts": self.restarts,
+            "in_flight_batches": self._in_flight,
+        }
+
+    def close(self):
+        for index, connection in enumerate(self._connections):
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        for connection in self._connections:
+            connection.close()
@@ -0,0 +1,258 @@
+import time
+import hashlib
+import datetime
+import threading
+
+# Time in seconds between the connection checks of a shard
+SUPERVISE_INTERVAL = 1.0
+
+
+def assign_devices_to_shards(device_ids, gateway_ids):
+    """
+    Rendezvous (highest random weight) hashing of the devices to the gateways.
+
+    Each device goes to the gateway with the highest hash of (device, gateway). When a gateway is removed only
+    its devices move, spread over the remaining gateways, and they move back when the gateway is added again.
+    Args:
+        device_ids: IDs of the proxy devices
+        gateway_ids: IDs of the gateways sharing the devices
+    Returns:
+        {gateway_id: set of device IDs}
+    """
+    assignment = {gateway_id: set() for gateway_id in gateway_ids}
+    if not gateway_ids:
+        return assignment
+
+    for device_id in device_ids:
+        owner = max(gateway_ids, key=lambda gateway_id: _get_weight(device_id, gateway_id))
+        assignment[owner].add(device_id)
+    return assignment
+
+
+def _get_weight(device_id, gateway_id):
+    # stable across processes, unlike hash()
+    return hashlib.md5(f"{device_id}@{gateway_id}".encode()).digest()
+
+
+class GatewayShard:
+    """
+    One gateway identity with its own MQTT connection, JWT and publish schedule.
+
+    The publisher is created and kept connected by the supervising thread of the shard, so the connection
+    timeouts and the reconnection backoff of a shard never hold up the other shards or the decoding. The same
+    thread attaches and detaches the devices assigned to the shard.
+
+    Args:
+        logger: logger
+        gateway_id: ID of the gateway
+        create_publisher: function(gateway_id, devices) returning a GoogleIoTCoreMQTTPublisher
+        devices: {device_id: device details} of all the proxy devices
+        first_publish_time: datetime of the first payload publishing
+    """
+
+    def __init__(self, logger, gateway_id, create_publisher, devices, first_publish_time):
+        self.logger = logger
+        self.gateway_id = gateway_id
+        self.next_publish_time = first_publish_time
+        self.publisher = None
+
+        self._create_publisher = create_publisher
+        self._devices = devices
+        # Devices assigned to the shard, and devices handed to its publisher
+        self.assigned = set()
+        self._attached = set()
+
+        self.unhealthy_since = time.monotonic()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._supervise, name=f"shard-{gateway_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _supervise(self):
+        while not self._stopped.is_set():
+            try:
+                if self.publisher is None:
+                    self.publisher = self._create_publisher(self.gateway_id, {})
+                # validates the JWT and reconnects with backoff if the connection was lost
+                if self.publisher.is_connection_open():
+                    self._reconcile_devices()
+            except Exception as ex:
+                self.logger.error(f"Gateway '{self.gateway_id}' failed: {ex}")
+            self._stopped.wait(SUPERVISE_INTERVAL)
+
+    def _reconcile_devices(self):
+        assigned = self.assigned
+        removed = self._attached - assigned
+        if removed:
+            self.publisher.detach_devices(removed)
+            self._attached = self._attached - removed
+            self.logger.info(f"Gateway '{self.gateway_id}' detached {len(removed)} devices")
+
+        added = assigned - self._attached
+        if added:
+            self.publisher.attach_devices({device_id: self._devices[device_id] for device_id in added})
+            self._attached = self._attached | added
+            self.logger.info(f"Gateway '{self.gateway_id}' attached {len(added)} devices")
+
+    def is_online(self):
+        return self.publisher is not None and self.publisher.is_connected
+
+    def update_health(self):
+        """
+        Returns:
+            Time in seconds since the shard went offline, 0 if it is online
+        """
+        now = time.monotonic()
+        if self.is_online():
+            self.unhealthy_since = None
+            return 0
+        if self.unhealthy_since is None:
+            self.unhealthy_since = now
+            self.logger.warning(f"Gateway '{self.gateway_id}' is offline")
+        return now - self.unhealthy_since
+
+    def get_online_device_ids(self):
+        """
+        Returns:
+            Assigned devices the shard can publish for: the shard is online and the devices are attached
+        """
+        if not self.is_online():
+            return set()
+        return self.assigned & self._attached
+
+
+class GatewayShards:
+    """
+    Proxy devices sharded across several gateway identities, fed by one ingest and decode pipeline.
+
+    The devices are assigned to the gateways by rendezvous hashing. A gateway offline for longer than the
+    failover timeout is taken out of the assignment, its devices are attached to the other gateways until it
+    is back online. The devices must be bound to all the gateways in the registry.
+
+    The publish intervals of the shards are staggered over the sample rate, so the gateways don't publish
+    all at the same time.
+
+    Args:
+        logger: logger
+        gateway_ids: IDs of the gateways
+        devices: {device_id: device details} of the proxy devices
+        create_publisher: function(gateway_id, devices) returning a GoogleIoTCoreMQTTPublisher
+        sample_rate_set: time in seconds between the payload publishing of a shard
+        failover_timeout: time in seconds a gateway is offline before its devices move to the other gateways
+    """
+
+    def __init__(self, logger, gateway_ids, devices, create_publisher, sample_rate_set, failover_timeout=120):
+        self.logger = logger
+        self.devices = devices
+        self.sample_rate_set = sample_rate_set
+        self.failover_timeout = failover_timeout
+
+        now = datetime.datetime.utcnow()
+        self.shards = [
+            GatewayShard(logger, gateway_id, create_publisher, devices,
+                         now + datetime.timedelta(seconds=sample_rate_set * index / len(gateway_ids)))
+            for index, gateway_id in enumerate(gateway_ids)
+        ]
+        self._owners = {}
+        self._healthy = None
+        self.failovers = 0
+
+        self.rebalance()
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def rebalance(self):
+        """
+        Reassign the devices if a gateway failed or came back online.
+        Returns:
+            True if the devices were reassigned
+        """
+        healthy = [shard.gateway_id for shard in self.shards if shard.update_health() <= self.failover_timeout]
+        # with no gateway left the devices stay where they are, their payloads are spooled if enabled
+        if not healthy or healthy == self._healthy:
+            return False
+
+        if self._healthy is not None:
+            self.failovers += 1
+            self.logger.warning(f"Rebalancing {len(self.devices)} devices over the gateways {healthy}")
+        self._healthy = healthy
+
+        assignment = assign_devices_to_shards(self.devices, healthy)
+        for shard in self.shards:
+            shard.assigned = assignment.get(shard.gateway_id, set())
+            for device_id in shard.assigned:
+                self._owners[device_id] = shard
+        return True
+
+    def get_modbus_slave_ids(self, device_ids):
+        return {str(self.devices[device_id]["modbus_slave_id"]) for device_id in device_ids}
+
+    def get_due_shards(self):
+        """
+        Returns:
+            Shards whose payload publishing is due, their next publish time is moved by the sample rate
+        """
+        now = datetime.datetime.utcnow()
+        due = []
+        for shard in self.shards:
+            if shard.next_publish_time < now:
+                shard.next_publish_time = now + datetime.timedelta(seconds=self.sample_rate_set)
+                due.append(shard)
+        return due
+
+    def get_next_publish_time(self):
+        return min(shard.next_publish_time for shard in self.shards)
+
+    def all_devices_online(self):
+        """
+        Returns:
+            True if every device is attached to an online gateway
+        """
+        return all(shard.get_online_device_ids() == shard.assigned for shard in self.shards)
+
+    def replay(self, store_and_forward, max_queued_publishes):
+        """
+        Replay the spooled payloads through the gateways of their devices, once all the devices are online.
+        Args:
+            store_and_forward: StoreAndForward spool
+            max_queued_publishes: Number of payloads in the publish queue of a gateway above which nothing
+                                  is replayed
+        Returns:
+            Number of replayed payloads
+        """
+        if not store_and_forward.has_backlog() or not self.all_devices_online():
+            return 0
+
+        def publish(device_id, payload):
+            shard = self._owners.get(device_id)
+            if shard is None:
+                self.logger.debug(f"Spooled payload of unknown device '{device_id}' dropped")
+                return
+            shard.publisher.publish(device_id, payload, topic="events/pointset", supersede=False)
+
+        queued = max((shard.publisher.queued_publishes for shard in self.shards if shard.assigned), default=0)
+        return store_and_forward.replay(publish, max_queued_publishes - queued)
+
+    def get_stats(self):
+        """
+        Returns:
+            {gateway_id: state, number of assigned and online devices, publish stats}
+        """
+        return {
+            shard.gateway_id: {
+                "online": shard.is_online(),
+                "devices": len(shard.assigned),
+                "online_devices": len(shard.get_online_device_ids()),
+                "publishes": shard.publisher.get_publish_stats() if shard.publisher is not None else None,
+            } for shard in self.shards
+        }
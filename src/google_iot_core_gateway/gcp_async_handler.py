@@ -0,0 +1,186 @@
+"""asyncio runtime of the Google IoT Core gateway
+
+The gateway runs as independent tasks connected by bounded channels:
+
+    decode      - takes the Modbus frames from the internal broker subscriber queue, decodes them (or hands
+                  them over to the decode workers) and updates the UDMI device state
+    publisher   - builds the UDMI payloads every sample_rate_set seconds into the outbound channel
+    sender      - hands the outbound payloads over to the publish pipeline, which queues them while the
+                  cloud connection is down
+    supervisor  - connects to the Google IoT Core and keeps the connection open
+    replay      - replays the payloads spooled while the cloud was not reachable (store-and-forward only)
+
+The blocking parts (paho connect, device attach, reconnect backoff, waiting on the subscriber queue)
+run in the default executor, so a slow cloud connection never stops the frames from being decoded.
+"""
+
+import time
+import asyncio
+import datetime
+
+from google_iot_core_gateway.gcp_handler import (MAX_QUEUE_WAIT_TIME, MAX_DECODE_WAIT_TIME, build_payloads,
+                                                 get_internal_broker_subscriber, _get_google_iot_core_publisher,
+                                                 _get_udmi_handler, process_payload, apply_decoded_frame,
+                                                 get_store_and_forward, store_payloads, replay_payloads,
+                                                 get_payload_encoder, setup_frame_decoding, get_decode_pool,
+                                                 setup_metrics, add_metrics_collectors, get_gateway_state_payload,
+                                                 QUEUE_WAIT_LABELS, CONNECTION_CHECK_INTERVAL,
+                                                 get_received_payloads)
+from google_iot_core_gateway.metrics import metrics
+
+
+class GoogleIoTCoreGatewayAsync:
+    """
+    Tasks of the asyncio runtime and the state shared between them.
+
+    Args:
+        logger: logger
+        config: Configuration
+    """
+
+    def __init__(self, logger, config):
+        self.logger = logger
+        self.config = config
+
+        self.int_broker_subscriber, self.google_iot_core_queue = get_internal_broker_subscriber(logger, config)
+        self.udmi_handler = _get_udmi_handler(logger, config)
+        self.google_iot_core_publisher = None
+        self.store_and_forward = get_store_and_forward(logger, config)
+        setup_frame_decoding(logger, config)
+        self.decode_pool = get_decode_pool(logger, config)
+
+        # two payloads (state and events/pointset) per device
+        self.outbound = asyncio.Queue(maxsize=2 * max(len(self.udmi_handler.devices), 1))
+        self.cloud_connected = asyncio.Event()
+
+        setup_metrics(logger, config)
+        if metrics.enabled:
+            add_metrics_collectors(self.google_iot_core_queue, self._get_publishers, self.decode_pool,
+                                   self.store_and_forward)
+
+    def _get_publishers(self):
+        if self.google_iot_core_publisher is None:
+            return {}
+        return {self.config.site_details__gateway_id: self.google_iot_core_publisher}
+
+    async def decode(self):
+        # the frames are taken from the subscriber queue itself, so its overflow policy and counters apply
+        self.int_broker_subscriber.run()
+        if self.decode_pool is not None:
+            await self.decode_in_pool()
+            return
+
+        loop = asyncio.get_running_loop()
+        max_batch_size = self.config.processing__max_batch_size
+        while True:
+            # one executor round trip per batch: wait for the first frame, then take the frames already queued
+            items = await loop.run_in_executor(None, get_received_payloads, self.google_iot_core_queue,
+                                               MAX_QUEUE_WAIT_TIME, max_batch_size)
+            for received_at, payload in items:
+                process_payload(self.logger, payload, self.udmi_handler, received_at)
+            await asyncio.sleep(0)
+
+    async def decode_in_pool(self):
+        loop = asyncio.get_running_loop()
+        max_batch_size = self.config.processing__max_batch_size
+        while True:
+            # wait for frames only when nothing is being decoded
+            if self.decode_pool.is_busy():
+                items = get_received_payloads(self.google_iot_core_queue, 0.0, max_batch_size)
+            else:
+                items = await loop.run_in_executor(None, get_received_payloads, self.google_iot_core_queue,
+                                                   MAX_QUEUE_WAIT_TIME, max_batch_size)
+
+            if items:
+                if metrics.enabled:
+                    now = time.time()
+                    for received_at, _ in items:
+                        metrics.observe("stage_seconds", now - received_at, QUEUE_WAIT_LABELS)
+                # submit waits for a worker when all of them are full, never on the event loop
+                await loop.run_in_executor(None, self.decode_pool.submit, items)
+                results = self.decode_pool.collect()
+            else:
+                results = await loop.run_in_executor(None, self.decode_pool.collect, MAX_DECODE_WAIT_TIME)
+
+            for received_at, frame, error in results:
+                if error is not None:
+                    self.logger.error(error)
+                    continue
+                apply_decoded_frame(self.logger, frame, self.udmi_handler, received_at)
+            await asyncio.sleep(0)
+
+    async def publisher(self):
+        sample_rate_set = self.config.google_cloud__sample_rate_set
+        state_interval = self.config.metrics__state_interval
+        next_state_publish_time = datetime.datetime.utcnow()
+        while True:
+            if not self.cloud_connected.is_set() and self.store_and_forward is not None:
+                store_payloads(self.logger, self.store_and_forward, self.udmi_handler, sample_rate_set,
+                               self.config.google_cloud__publish_mode, self.config.google_cloud__keyframe_interval)
+                await asyncio.sleep(sample_rate_set)
+                continue
+            await self.cloud_connected.wait()
+
+            # nothing is dropped here: a partial update lost would lose its points until the next keyframe,
+            # the publish pipeline supersedes the outdated full payloads instead
+            for item in build_payloads(self.logger, self.udmi_handler, self.config.google_cloud__publish_mode,
+                                       self.config.google_cloud__keyframe_interval):
+                await self.outbound.put(item)
+            if metrics.enabled and state_interval and next_state_publish_time < datetime.datetime.utcnow():
+                await self.outbound.put((self.config.site_details__gateway_id,
+                                         get_gateway_state_payload(self.udmi_handler), "state", False))
+                next_state_publish_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=state_interval)
+            self.logger.info(f"Internal broker messages: {self.google_iot_core_queue.get_counters()}")
+            self.logger.info(f"Google Cloud publishes: {self.google_iot_core_publisher.get_publish_stats()}")
+
+            await asyncio.sleep(sample_rate_set)
+
+    async def sender(self):
+        while True:
+            device_id, payload, topic, partial_update = await self.outbound.get()
+            self.google_iot_core_publisher.publish(device_id, payload, topic=topic, supersede=not partial_update)
+
+    async def supervisor(self):
+        loop = asyncio.get_running_loop()
+        payload_encoder = get_payload_encoder(self.logger, self.config, self.udmi_handler)
+        self.google_iot_core_publisher = await loop.run_in_executor(None, _get_google_iot_core_publisher,
+                                                                    self.logger, self.config, payload_encoder)
+        while True:
+            is_connected = await loop.run_in_executor(None, self.google_iot_core_publisher.is_connection_open)
+            if is_connected:
+                self.cloud_connected.set()
+            else:
+                self.cloud_connected.clear()
+            await asyncio.sleep(CONNECTION_CHECK_INTERVAL)
+
+    async def replay(self):
+        while True:
+            await self.cloud_connected.wait()
+            replay_payloads(self.google_iot_core_publisher, self.store_and_forward,
+                            self.config.google_cloud__max_queued_publishes)
+            await asyncio.sleep(CONNECTION_CHECK_INTERVAL)
+
+    async def run(self):
+        coroutines = [self.decode, self.publisher, self.sender, self.supervisor]
+        if self.store_and_forward is not None:
+            coroutines.append(self.replay)
+        tasks = [asyncio.create_task(coroutine(), name=coroutine.__name__) for coroutine in coroutines]
+        try:
+            # a task only finishes when it fails, the remaining tasks are then cancelled
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                self.logger.error(f"Task '{task.get_name()}' stopped: {task.exception()}")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def run_google_iot_core_gateway_async(logger, config):
+    """
+    Run the Google IoT Core gateway on the asyncio runtime until one of its tasks fails.
+    Args:
+        logger: Logger
+        config: Configuration
+    """
+    logger.info("Starting Google IoT Core Gateway asyncio runtime")
+    await GoogleIoTCoreGatewayAsync(logger, config).run()
@@ -3,17 +3,33 @@ import sys
 import json
 import datetime
 import argparse
+import asyncio
 import time
-from multiprocessing import Queue
+import threading
 from queue import Empty
 
 from google_iot_core_gateway.internal_broker_subscriber.internal_broker_subscriber import MosquittoMQTTSubscriber
+from google_iot_core_gateway.internal_broker_subscriber.frame_handoff import FrameHandoff, create_frames_queue
 from google_iot_core_gateway.gcp_publisher import GoogleIoTCoreMQTTPublisher
+from google_iot_core_gateway.gateway_shards import GatewayShards
+from google_iot_core_gateway.payload_encoding import PayloadEncoder
+from google_iot_core_gateway.store_and_forward import StoreAndForward, MEGABYTE
 from google_iot_core_gateway.udmi_handler.udmi_handler import UDMIHandler
 from google_iot_core_gateway.utils.certificates_handler import get_google_root_ca, get_gateway_private_key
 from google_iot_core_gateway.utils.config_handler import ConfigHandler
 from google_iot_core_gateway.utils.log import setup_logger, update_logger_verbose_level
-from google_iot_core_gateway.modbus_gw.modbus_to_json import modbus_to_json
+from google_iot_core_gateway.modbus_gw.modbus_to_json import decode_payload, frame_cache, set_crc_verification
+from google_iot_core_gateway.decode_pool import DecodeWorkerPool
+from google_iot_core_gateway.metrics import metrics, MetricsServer, COUNTER, GAUGE, HISTOGRAM
+
+# Maximum time in seconds the main loop waits for the messages before checking the cloud connection
+MAX_QUEUE_WAIT_TIME = 1.0
+# Maximum time in seconds the main loop waits for the results of the decode workers
+MAX_DECODE_WAIT_TIME = 0.05
+# Time in seconds between two checks of the cloud connection by the connection supervisor
+CONNECTION_CHECK_INTERVAL = 1.0
+
+QUEUE_WAIT_LABELS = (("stage", "queue_wait"),)
 
 def get_google_cloud_cmd_line_parser():
     """
@@ -74,35 +90,55 @@ def parse_command_line_args(args=None, parents=None):
                         metavar="HOSTNAME", help="Overwrite Internal Broker Hostname")
     parser.add_argument("-internal-broker-port", dest="internal_broker__mqtt_bridge_port", type=int,
                         metavar="PORT", help="Overwrite Internal Broker Port")
+    parser.add_argument("-internal-broker-capture-file", dest="internal_broker__capture_file", type=str,
+                        metavar="PATH", help="Capture the internal broker messages into this file")
     parser.add_argument("-v", "--verbose", dest="verbose_level", default=None, help="Turn on console DEBUG mode [-v 2]")
 
     parsed_args, unknown_args = parser.parse_known_args(args)
     return parsed_args
 
 
-def _get_google_iot_core_publisher(logger, config):
+def _get_google_iot_core_publisher(logger, config, payload_encoder=None, gateway_id=None, devices=None):
     """
         Set up Google IoT Core publisher client.
         Args:
             logger: logger
             config: Configuration
+            payload_encoder: PayloadEncoder of the published payloads, None to publish them as JSON
+            gateway_id: ID of the gateway, site_details.gateway_id by default
+            devices: devices attached to the gateway, site_details.proxy_ids by default
         Returns:
             Google IoT Core Publisher
         """
+    if gateway_id is None:
+        gateway_id = config.site_details__gateway_id
+    if devices is None:
+        devices = config.site_details__devices
+
     private_key_file_path, encryption_algorithm = get_gateway_private_key(logger, config.udmi_site_model_path,
-                                                                          config.site_details__gateway_id)
+                                                                          gateway_id)
     ca_cert = get_google_root_ca(config.resources_path)
 
-    google_iot_core_publisher = GoogleIoTCoreMQTTPublisher(logger, config.site_details__devices,
+    google_iot_core_publisher = GoogleIoTCoreMQTTPublisher(logger, devices,
                                                            cloud_region=config.google_cloud__cloud_region,
                                                            project_id=config.google_cloud__project_id,
                                                            registry_id=config.site_details__registry_id,
-                                                           gateway_id=config.site_details__gateway_id,
+                                                           gateway_id=gateway_id,
                                                            mqtt_bridge_hostname=config.google_cloud__mqtt_bridge_hostname,
                                                            mqtt_bridge_port=config.google_cloud__mqtt_bridge_port,
                                                            private_key_file=private_key_file_path,
                                                            ca_cert=ca_cert,
-                                                           jwt_signing_algorithm=encryption_algorithm)
+                                                           jwt_signing_algorithm=encryption_algorithm,
+                                                           connect_timeout=config.google_cloud__connect_timeout,
+                                                           attach_timeout=config.google_cloud__attach_timeout,
+                                                           max_inflight_attach=config.google_cloud__max_inflight_attach,
+                                                           jwt_rotation=config.google_cloud__jwt_rotation,
+                                                           jwt_lifetime=config.google_cloud__jwt_lifetime,
+                                                           jwt_refresh_lead_time=config.google_cloud__jwt_refresh_lead_time,
+                                                           max_inflight_publishes=config.google_cloud__max_inflight_publishes,
+                                                           max_queued_publishes=config.google_cloud__max_queued_publishes,
+                                                           publish_ack_timeout=config.google_cloud__publish_ack_timeout,
+                                                           payload_encoder=payload_encoder)
 
     return google_iot_core_publisher
 
@@ -116,7 +152,8 @@ def _get_udmi_handler(logger, config):
         Returns:
             UDMI handler
         """
-    udmi_handler = UDMIHandler(logger, config.resources_path, config.udmi_site_model_path)
+    udmi_handler = UDMIHandler(logger, config.resources_path, config.udmi_site_model_path,
+                               point_timestamp=config.processing__point_timestamp)
 
     for device_id in list(config.site_details__devices.keys()):
         modbus_slave_id = config.site_details__devices[device_id]["modbus_slave_id"]
@@ -138,72 +175,385 @@ def prepare_google_cloud_environment(logger, config):
         Namespace list of args
     """
     udmi_handler = _get_udmi_handler(logger, config)
-    google_iot_core_publisher = _get_google_iot_core_publisher(logger, config)
+    payload_encoder = get_payload_encoder(logger, config, udmi_handler)
+    google_iot_core_publisher = _get_google_iot_core_publisher(logger, config, payload_encoder)
 
     return google_iot_core_publisher, udmi_handler
 
 
-def process_payloads(logger, google_iot_core_queue, udmi_handler):
+def start_connection_supervisor(logger, google_iot_core_publisher):
+    """
+    Keep the connection to the Google Cloud open from a daemon thread.
+
+    Validating the JWT, reconnecting with backoff and attaching the devices can take minutes during an outage,
+    the main loop keeps decoding the frames and spooling the payloads meanwhile, see
+    GoogleIoTCoreMQTTPublisher.is_publishing.
+    Args:
+        logger: logger
+        google_iot_core_publisher: Google IoT Core client
+    Returns:
+        Started thread
+    """
+    def supervise():
+        while True:
+            try:
+                google_iot_core_publisher.is_connection_open()
+            except Exception as ex:
+                logger.error(f"Google Cloud connection check failed: {ex}")
+            time.sleep(CONNECTION_CHECK_INTERVAL)
+
+    thread = threading.Thread(target=supervise, name="connection-supervisor", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_payload_encoder(logger, config, udmi_handler):
+    """
+    Set up the encoding of the published payloads.
+    Args:
+        logger: logger
+        config: Configuration
+        udmi_handler: UDMI handler, the point names of its devices make up the compression dictionaries
+    Returns:
+        PayloadEncoder, None if all the topics are sent as JSON
+    """
+    if not any(encoding != "json" for encoding in config.google_cloud__payload_encoding.values()):
+        return None
+
+    point_names = set()
+    for device_details in udmi_handler.devices.values():
+        point_names.update(device_details["points"])
+    return PayloadEncoder(logger, config.google_cloud__payload_encoding, point_names)
+
+
+def process_payload(logger, payload, udmi_handler, received_at=None):
     """
-    Method will process received messages and update device properties
+    Method will process received message and update device properties
 
     Sample payload:
-    {'slave_id': 2, 'fc': 3, 'data': {128: 54, 129: 920, 130: 4565}, 'error': None}
+    {"rtu_request": "01030bb70004...", "rtu_response": "0103080000..."}
 
     Args:
         logger: logger
-        google_iot_core_queue: Messages queue
+        payload: Message received from the internal broker
         udmi_handler: object with devices dictionary
-    Returns:
-        True if connected, False otherwise
+        received_at: time.time() when the message was received, used as the points timestamp if configured
     """
+    decode_time = None
+    if metrics.enabled:
+        started = time.perf_counter()
+        if received_at is not None:
+            metrics.observe("stage_seconds", time.time() - received_at, QUEUE_WAIT_LABELS)
+
     try:
-        payload = google_iot_core_queue.get_nowait()
-        payload = json.loads(payload)
-        
-        rtu_request = bytes.fromhex(payload['rtu_request'])
-        rtu_response = bytes.fromhex(payload['rtu_response'])
-       
-        logger.debug("*************************************** build modbus to JSON ******************************")
-        logger.info("Modbus To JSON Started!")        
-        payload = modbus_to_json(rtu_request, rtu_response)
-        logger.debug("*************************************** build modbus to JSON ******************************")
-  
-    except Empty:
-        return
+        frame = decode_payload(payload)
     except Exception as ex:
-        logger.error(f"Caught an Exception when getting queue item. Exception: {ex}")
+        logger.error("Caught an Exception when processing queue item. Exception: %s", ex)
+        if metrics.enabled:
+            metrics.increment("decode_errors_total")
         return
-    
-    if payload:
-        payload = json.loads(payload)
-        modbus_slave_id = str(payload["slave_id"])
+
+    if metrics.enabled:
+        decode_time = time.perf_counter() - started
+    apply_decoded_frame(logger, frame, udmi_handler, received_at, decode_time)
+
+
+def _get_device_labels(device_details):
+    return ("device", device_details["device_id"]), ("meter_type", device_details["device_type"])
+
+
+def _record_frame_metrics(device_details, frame, received_at, decode_time, update_time):
+    """
+    Record the stage latencies of the frame per meter type, and the frame counters of its device.
+    """
+    meter_type = ("meter_type", device_details["device_type"])
+    if decode_time is not None and not frame.unchanged:
+        metrics.observe("stage_seconds", decode_time, (("stage", "decode"), meter_type))
+    metrics.observe("stage_seconds", update_time, (("stage", "update"), meter_type))
+
+    device_labels = _get_device_labels(device_details)
+    metrics.increment("frames_total", device_labels)
+    if frame.error is not None:
+        metrics.increment("frame_errors_total", device_labels)
+    metrics.set_gauge("last_frame_timestamp_seconds", received_at or time.time(), device_labels)
+
+
+def apply_decoded_frame(logger, frame, udmi_handler, received_at=None, decode_time=None):
+    """
+    Update the device properties with the decoded frame
+
+    Args:
+        logger: logger
+        frame: DecodedFrame, None if the frame could not be decoded
+        udmi_handler: object with devices dictionary
+        received_at: time.time() when the message was received, used as the points timestamp if configured
+        decode_time: time in seconds the decoding of the frame took, recorded in the metrics if known
+    """
+    if frame:
+        modbus_slave_id = str(frame.slave_id)
 
         if modbus_slave_id not in udmi_handler.devices:
             logger.debug(
-                f"Modbus device '{modbus_slave_id}' is not configured to send it's telemetry to the could. Please add this device to the 'config-google-gateway.json' file and UDMI Site Model if you want to report it's state")
+                "Modbus device '%s' is not configured to send it's telemetry to the could. Please add this device to the 'config-google-gateway.json' file and UDMI Site Model if you want to report it's state", modbus_slave_id)
+            if metrics.enabled:
+                metrics.increment("unknown_device_frames_total")
             return
 
-        error = payload["error"]
-        if error is not None:
+        if frame.crc_error:
+            # a corrupted response says nothing about the device, it is only counted
+            device_details = udmi_handler.devices[modbus_slave_id]
+            device_details["rejected_frames"] += 1
+            logger.warning("Frame of Modbus device '%s' rejected, CRC error (%s rejected frames)", modbus_slave_id,
+                           device_details["rejected_frames"])
+            if metrics.enabled:
+                metrics.increment("rejected_frames_total", _get_device_labels(device_details) + (("reason", "crc"),))
+            return
+
+        if metrics.enabled:
+            started = time.perf_counter()
+
+        if frame.error is not None:
             udmi_handler.devices[modbus_slave_id]["system"]["operational"] = False
         else:
             udmi_handler.devices[modbus_slave_id]["system"]["operational"] = True
 
-            device_type = udmi_handler.devices[modbus_slave_id]["device_type"]
-
-            function_code = payload["fc"]
-            data = payload["data"]
-
-            if function_code == 3 or function_code == 4:
+            # all points of the frame share the timestamp
+            timestamp = udmi_handler.get_point_timestamp(received_at)
+
+            if frame.unchanged:
+                if not udmi_handler.refresh_block(frame.block_key, timestamp):
+                    # the last frame of the block was not applied, e.g. its data format was not correct
+                    logger.warning("Unchanged frame of Modbus device '%s' not applied, register block %s unknown",
+                                   modbus_slave_id, frame.block_key)
+            elif frame.fc == 3 or frame.fc == 4:
+                # the points of the register block are kept to refresh them when the frame is received unchanged
+                block_key = frame.block_key if frame_cache.enabled else None
                 try:
-                    for registry, value in data.items():
-                        udmi_handler.update_device_properties(modbus_slave_id, device_type, registry, value)
+                    rejected = udmi_handler.apply_frame(modbus_slave_id, frame.data, timestamp, block_key)
+                    if rejected:
+                        logger.debug("%s register values of Modbus device '%s' are not mapped to the UDMI Site Model", rejected, modbus_slave_id)
                 except (ValueError, AttributeError):
                     logger.error(
-                        f"Data format in received payload is not correct! Expected format is key-value pairs. Received data: '{data}'")
+                        "Data format in received payload is not correct! Expected format is key-value pairs. Received data: '%s'", frame.data)
+
+        if metrics.enabled:
+            _record_frame_metrics(udmi_handler.devices[modbus_slave_id], frame, received_at, decode_time,
+                                  time.perf_counter() - started)
+
+
+def process_payloads(logger, google_iot_core_queue, udmi_handler, timeout=0.0, max_batch_size=100,
+                     batch_time_budget=0.5):
+    """
+    Method will wait for the received messages and process all of them in a batch
+
+    The first message is waited for up to the timeout. The messages that are already queued are then
+    processed without waiting, until the queue is empty, the max batch size is reached or the time budget
+    of the batch is used up.
+
+    Args:
+        logger: logger
+        google_iot_core_queue: Messages queue
+        udmi_handler: object with devices dictionary
+        timeout: Time in seconds to wait for the first message
+        max_batch_size: Maximum number of messages processed in the batch
+        batch_time_budget: Time in seconds after which the batch is finished even if there are queued messages
+    Returns:
+        Number of processed messages
+    """
+    try:
+        received_at, payload = google_iot_core_queue.get(timeout=timeout) if timeout > 0 \
+            else google_iot_core_queue.get_nowait()
+    except Empty:
+        return 0
+
+    batch_deadline = time.monotonic() + batch_time_budget
+    processed = 0
+    while True:
+        process_payload(logger, payload, udmi_handler, received_at)
+        processed += 1
+
+        if processed >= max_batch_size or time.monotonic() >= batch_deadline:
+            break
+        try:
+            received_at, payload = google_iot_core_queue.get_nowait()
+        except Empty:
+            break
+
+    logger.debug("Processed %s messages", processed)
+    return processed
+
+
+
+def get_received_payloads(google_iot_core_queue, timeout=0.0, max_batch_size=100):
+    """
+    Wait up to the timeout for the first received message, then take the messages already queued.
+    Args:
+        google_iot_core_queue: Messages queue
+        timeout: Time in seconds to wait for the first message
+        max_batch_size: Maximum number of messages taken
+    Returns:
+        [(received_at, payload)] in the order they were received
+    """
+    items = []
+    try:
+        items.append(google_iot_core_queue.get(timeout=timeout) if timeout > 0
+                     else google_iot_core_queue.get_nowait())
+        while len(items) < max_batch_size:
+            items.append(google_iot_core_queue.get_nowait())
+    except Empty:
+        pass
+    return items
+
+
+def process_payloads_in_pool(logger, google_iot_core_queue, udmi_handler, decode_pool, timeout=0.0,
+                             max_batch_size=100):
+    """
+    Method will hand the received messages over to the decode workers and apply the decoded frames
+
+    While the workers decode, the messages received in the meantime are handed over, so the decoding of
+    a batch overlaps with the applying of the previous one.
+
+    Args:
+        logger: logger
+        google_iot_core_queue: Messages queue
+        udmi_handler: object with devices dictionary
+        decode_pool: DecodeWorkerPool
+        timeout: Time in seconds to wait for the first message when nothing is being decoded
+        max_batch_size: Maximum number of messages handed over in the batch
+    Returns:
+        Number of applied frames
+    """
+    if decode_pool.is_busy():
+        timeout = 0.0
+
+    items = get_received_payloads(google_iot_core_queue, timeout, max_batch_size)
+    if items:
+        if metrics.enabled:
+            now = time.time()
+            for received_at, _ in items:
+                metrics.observe("stage_seconds", now - received_at, QUEUE_WAIT_LABELS)
+        decode_pool.submit(items)
+
+    results = decode_pool.collect(timeout=0.0 if items else MAX_DECODE_WAIT_TIME)
+    for received_at, frame, error in results:
+        if error is not None:
+            logger.error(error)
+            continue
+        apply_decoded_frame(logger, frame, udmi_handler, received_at)
+
+    logger.debug("Applied %s decoded frames", len(results))
+    return len(results)
+
+
+def setup_frame_decoding(logger, config):
+    """
+    Set up the decoding of the frames by the main loop.
+    Args:
+        logger: logger
+        config: Configuration
+    """
+    # the decode workers have their own frame caches, the frame cache of the main process is enabled anyway
+    # so that the UDMI handler keeps the points of the register blocks to refresh them
+    if config.processing__deduplicate_frames:
+        frame_cache.enable()
+        logger.info("Frames identical to the last frame of their register block are not decoded again")
+    # the frames with a CRC error are rejected before they are decoded
+    set_crc_verification(config.processing__verify_crc)
+    if not config.processing__verify_crc:
+        logger.warning("CRC of the RTU responses not verified")
+
+
+def get_decode_pool(logger, config):
+    """
+    Set up the decode workers.
+    Args:
+        logger: logger
+        config: Configuration
+    Returns:
+        Started DecodeWorkerPool, None if the frames are decoded by the main loop
+    """
+    if config.processing__decode_workers <= 0:
+        return None
+
+    decode_pool = DecodeWorkerPool(logger, config.processing__decode_workers,
+                                   batch_size=config.processing__max_batch_size,
+                                   deduplicate_frames=config.processing__deduplicate_frames,
+                                   verify_crc=config.processing__verify_crc)
+    decode_pool.start()
+    return decode_pool
+
+
+def process_received_payloads(logger, google_iot_core_queue, udmi_handler, decode_pool, timeout, config):
+    """
+    Process the received messages in the main loop, or in the decode workers if they are enabled.
+    Args:
+        logger: logger
+        google_iot_core_queue: Messages queue
+        udmi_handler: object with devices dictionary
+        decode_pool: DecodeWorkerPool, None to decode the messages in the main loop
+        timeout: Time in seconds to wait for the first message
+        config: Configuration
+    Returns:
+        Number of processed messages
+    """
+    if decode_pool is not None:
+        return process_payloads_in_pool(logger, google_iot_core_queue, udmi_handler, decode_pool, timeout,
+                                        max_batch_size=config.processing__max_batch_size)
+    return process_payloads(logger, google_iot_core_queue, udmi_handler, timeout,
+                            max_batch_size=config.processing__max_batch_size,
+                            batch_time_budget=config.processing__batch_time_budget)
+
             
-def publish_payloads(logger, google_iot_core_publisher, udmi_handler, sample_rate_set):
+def build_payloads(logger, udmi_handler, publish_mode="full", keyframe_interval=10, include_state=True,
+                   modbus_slave_ids=None):
+    """
+    Build payloads of all devices for the Google IoT Core topics
+
+    In the 'cov' (change-of-value) publish mode 'events/pointset' carries only the points that changed
+    by more than their deadband, and 'state' is sent only when the system block or a point status changed.
+    Every keyframe_interval-th publish interval sends the full payloads.
+    Args:
+        logger: Logger
+        udmi_handler: Gets the devices current state
+        publish_mode: 'full' or 'cov'
+        keyframe_interval: Number of publish intervals between full payloads in the 'cov' publish mode
+        include_state: if False only the 'events/pointset' payloads are built
+        modbus_slave_ids: the payloads are built only for these devices, for all devices by default
+    Returns:
+        Generator of (device_id, payload, topic, partial_update), partial_update is True for the 'events/pointset'
+        payloads carrying only the changed points
+    """
+    change_of_value = publish_mode == "cov"
+
+    for device, device_details in udmi_handler.devices.items():
+        if modbus_slave_ids is not None and device not in modbus_slave_ids:
+            continue
+        keyframe = udmi_handler.next_publish_interval(device, keyframe_interval)
+        state_changed = include_state and change_of_value and udmi_handler.has_state_changed(device)
+
+        if include_state and (not change_of_value or keyframe or state_changed):
+            payload = udmi_handler.get_state_payload(device)
+            logger.debug("Publishing payload for device '%s' on topic 'state': %s", device_details['device_id'], payload)
+            yield device_details["device_id"], payload, "state", False
+
+        partial_update = change_of_value and not keyframe
+        payload = udmi_handler.get_event_point_payload(device, changed_only=partial_update)
+        if payload is None:
+            logger.debug("No point of device '%s' changed, 'events/pointset' skipped", device_details['device_id'])
+            continue
+
+        logger.debug("Publishing payload for device '%s' on topic 'events/pointset': %s", device_details['device_id'],
+                     payload)
+        if metrics.enabled:
+            last_frame_time = metrics.get_gauge("last_frame_timestamp_seconds", _get_device_labels(device_details))
+            if last_frame_time is not None:
+                metrics.observe("stage_seconds", time.time() - last_frame_time,
+                                (("stage", "point_age"), ("meter_type", device_details["device_type"])))
+        yield device_details["device_id"], payload, "events/pointset", partial_update
+
+
+def publish_payloads(logger, google_iot_core_publisher, udmi_handler, sample_rate_set, publish_mode="full",
+                     keyframe_interval=10, modbus_slave_ids=None):
     """
     Publish payloads to the Google IoT Core topics
     Args:
@@ -211,21 +561,17 @@ def publish_payloads(logger, google_iot_core_publisher, udmi_handler, sample_rat
         google_iot_core_publisher: Google IoT Core client
         udmi_handler: Gets the devices current state
         sample_rate_set: Time in seconds to the next payload publishing
+        publish_mode: 'full' or 'cov', see build_payloads
+        keyframe_interval: Number of publish intervals between full payloads in the 'cov' publish mode
+        modbus_slave_ids: the payloads are published only for these devices, for all devices by default
     Returns:
         Time of next payload publishing
     """
-    for device, device_details in udmi_handler.devices.items():
-        logger.info(f"Publishing payload for device '{device_details['device_id']}' on topic 'state'")
-        payload = udmi_handler.get_state_payload(device)
-        
-        logger.debug(f"State payload: {payload}")
-        google_iot_core_publisher.publish(device_details["device_id"], payload)
-
-        logger.info(f"Publishing payload for device '{device_details['device_id']}' on topic 'events/pointset'")
-        payload = udmi_handler.get_event_point_payload(device)
-        
-        logger.debug(f"Pointset payload: {payload}")
-        google_iot_core_publisher.publish(device_details["device_id"], payload, topic="events/pointset")
+    for device_id, payload, topic, partial_update in build_payloads(logger, udmi_handler, publish_mode,
+                                                                    keyframe_interval,
+                                                                    modbus_slave_ids=modbus_slave_ids):
+        # the points of a partial update are published only once, it must not be superseded by the next one
+        google_iot_core_publisher.publish(device_id, payload, topic=topic, supersede=not partial_update)
 
     logger.info("Payloads published")
 
@@ -233,6 +579,282 @@ def publish_payloads(logger, google_iot_core_publisher, udmi_handler, sample_rat
     return next_payload_publish_time
 
 
+def store_payloads(logger, store_and_forward, udmi_handler, sample_rate_set, publish_mode="full",
+                   keyframe_interval=10, modbus_slave_ids=None):
+    """
+    Spool the 'events/pointset' payloads while the Google Cloud is not reachable, they are replayed once
+    the connection is back. The 'state' payloads are not spooled, the current state is published instead.
+    Args:
+        logger: Logger
+        store_and_forward: StoreAndForward spool
+        udmi_handler: Gets the devices current state
+        sample_rate_set: Time in seconds to the next payload publishing
+        publish_mode: 'full' or 'cov', see build_payloads
+        keyframe_interval: Number of publish intervals between full payloads in the 'cov' publish mode
+        modbus_slave_ids: the payloads are stored only for these devices, for all devices by default
+    Returns:
+        Time of next payload publishing
+    """
+    stored = 0
+    for device_id, payload, _, _ in build_payloads(logger, udmi_handler, publish_mode, keyframe_interval,
+                                                   include_state=False, modbus_slave_ids=modbus_slave_ids):
+        store_and_forward.store(device_id, payload)
+        stored += 1
+    store_and_forward.flush()
+
+    logger.info(f"Google Cloud not reachable, {stored} payloads stored: {store_and_forward.get_counters()}")
+
+    next_payload_publish_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=sample_rate_set)
+    return next_payload_publish_time
+
+
+def replay_payloads(google_iot_core_publisher, store_and_forward, max_queued_publishes):
+    """
+    Replay the spooled payloads at the replay rate, while the publish queue has room for them.
+    Args:
+        google_iot_core_publisher: Google IoT Core client
+        store_and_forward: StoreAndForward spool
+        max_queued_publishes: Number of payloads in the publish queue above which nothing is replayed
+    Returns:
+        Number of replayed payloads
+    """
+    if not store_and_forward.has_backlog():
+        return 0
+
+    def publish(device_id, payload):
+        google_iot_core_publisher.publish(device_id, payload, topic="events/pointset", supersede=False)
+
+    return store_and_forward.replay(publish, max_queued_publishes - google_iot_core_publisher.queued_publishes)
+
+
+def get_gateway_state_payload(udmi_handler):
+    """
+    Returns:
+        State payload of the gateway itself, with a snapshot of the metrics in its system block
+    """
+    return json.dumps({
+        "version": 1,
+        "timestamp": udmi_handler.get_timestamp(),
+        "system": {
+            "operational": True,
+            "metrics": metrics.get_snapshot(),
+        },
+    })
+
+
+def publish_gateway_state(logger, google_iot_core_publisher, udmi_handler, gateway_id, state_interval):
+    """
+    Publish the metrics snapshot on the 'state' topic of the gateway
+    Args:
+        logger: Logger
+        google_iot_core_publisher: Google IoT Core client
+        udmi_handler: Gets the current timestamp
+        gateway_id: ID of the gateway
+        state_interval: Time in seconds to the next gateway state publishing
+    Returns:
+        Time of next gateway state publishing
+    """
+    google_iot_core_publisher.publish(gateway_id, get_gateway_state_payload(udmi_handler), topic="state")
+    logger.debug("Gateway '%s' state published", gateway_id)
+
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=state_interval)
+
+
+def setup_metrics(logger, config):
+    """
+    Enable the metrics and start their HTTP endpoint if configured.
+    Args:
+        logger: logger
+        config: Configuration
+    Returns:
+        Started MetricsServer, None if the metrics or their endpoint are disabled
+    """
+    if not config.metrics__enabled:
+        return None
+
+    metrics.enable()
+    if not config.metrics__http_port:
+        return None
+
+    metrics_server = MetricsServer(logger, metrics, config.metrics__http_host, config.metrics__http_port)
+    metrics_server.start()
+    return metrics_server
+
+
+def add_metrics_collectors(google_iot_core_queue, get_publishers, decode_pool=None, store_and_forward=None):
+    """
+    Report the counters kept by the components of the gateway in the metrics.
+    Args:
+        google_iot_core_queue: Messages queue
+        get_publishers: function returning {gateway_id: Google IoT Core client} of the connected publishers
+        decode_pool: DecodeWorkerPool, if the decode workers are enabled
+        store_and_forward: StoreAndForward spool, if store-and-forward is enabled
+    """
+    def collect():
+        samples = [(GAUGE, "queue_depth", (("queue", "frames"),), google_iot_core_queue.qsize())]
+        for outcome, value in google_iot_core_queue.get_counters().items():
+            samples.append((COUNTER, "internal_broker_messages_total", (("outcome", outcome),), value))
+
+        for gateway_id, publisher in get_publishers().items():
+            gateway = ("gateway", gateway_id)
+            stats = publisher.get_publish_stats()
+            samples.append((GAUGE, "queue_depth", (("queue", "publish"), gateway), stats.pop("queued")))
+            samples.append((GAUGE, "publish_in_flight", (gateway,), stats.pop("in_flight")))
+            for outcome, value in stats.items():
+                if not isinstance(value, dict):
+                    samples.append((COUNTER, "publishes_total", (gateway, ("outcome", outcome)), value))
+            histograms = publisher.get_publish_histograms()
+            samples.append((HISTOGRAM, "stage_seconds", (("stage", "publish_to_puback"), gateway),
+                            histograms["latency"]))
+            samples.append((HISTOGRAM, "stage_seconds", (("stage", "send_to_puback"), gateway),
+                            histograms["ack_time"]))
+
+        # the frames are looked up in the frame caches of the decode workers when they are enabled
+        if frame_cache.enabled and decode_pool is None:
+            counters = frame_cache.get_counters()
+            samples.append((GAUGE, "frame_cache_blocks", (), counters.pop("blocks")))
+            for name, value in counters.items():
+                samples.append((COUNTER, f"frame_cache_{name}_total", (), value))
+
+        if decode_pool is not None:
+            counters = decode_pool.get_counters()
+            samples.append((GAUGE, "decode_in_flight_batches", (), counters.pop("in_flight_batches")))
+            for name, value in counters.items():
+                samples.append((COUNTER, f"decode_pool_{name}_total", (), value))
+
+        if store_and_forward is not None:
+            counters = store_and_forward.get_counters()
+            samples.append((GAUGE, "spool_size_bytes", (), counters.pop("size_bytes")))
+            for name, value in counters.items():
+                samples.append((COUNTER, f"spool_{name}_total", (), value))
+        return samples
+
+    metrics.add_collector(collect)
+
+
+def get_store_and_forward(logger, config):
+    """
+    Set up the store-and-forward spool.
+    Args:
+        logger: logger
+        config: Configuration
+    Returns:
+        StoreAndForward, None if store-and-forward is not enabled
+    """
+    if not config.store_and_forward__enabled:
+        return None
+
+    return StoreAndForward(logger, config.store_and_forward__directory,
+                           segment_size=int(config.store_and_forward__segment_size_mb * MEGABYTE),
+                           max_size=int(config.store_and_forward__max_size_mb * MEGABYTE),
+                           retention=config.store_and_forward__retention_hours * 3600,
+                           replay_rate=config.store_and_forward__replay_rate)
+
+
+def get_internal_broker_subscriber(logger, config):
+    """
+    Set up the internal broker subscriber and the queue of the received messages.
+    Args:
+        logger: logger
+        config: Configuration
+    Returns:
+        Internal broker subscriber, queue of the received messages
+    """
+    frames_queue = create_frames_queue(config.processing__queue_type, config.processing__queue_size)
+    google_iot_core_queue = FrameHandoff(logger, frames_queue, config.processing__overflow_policy)
+    int_broker_subscriber = MosquittoMQTTSubscriber(logger, google_iot_core_queue,
+                                                    config.internal_broker__mqtt_bridge_hostname,
+                                                    config.internal_broker__mqtt_bridge_port,
+                                                    config.internal_broker__trusted_root_ca,
+                                                    config.internal_broker__x509_certificate,
+                                                    config.internal_broker__private_key,
+                                                    config.internal_broker__tls_insecure_set,
+                                                    config.internal_broker__enable_tls,
+                                                    config.internal_broker__capture_file
+                                                    )
+    return int_broker_subscriber, google_iot_core_queue
+
+
+def run_sharded_google_iot_core_gateway(logger, config):
+    """
+    Main loop of the gateway sharding the proxy devices across the gateways of sharding.gateway_ids.
+
+    The messages are decoded by one pipeline, each gateway publishes the payloads of its devices on its own
+    schedule. The payloads of the devices whose gateway is offline are spooled if store-and-forward is enabled.
+    Args:
+        logger: Logger
+        config: Configuration
+    """
+    int_broker_subscriber, google_iot_core_queue = get_internal_broker_subscriber(logger, config)
+    int_broker_subscriber.run()
+
+    udmi_handler = _get_udmi_handler(logger, config)
+    payload_encoder = get_payload_encoder(logger, config, udmi_handler)
+    store_and_forward = get_store_and_forward(logger, config)
+    setup_frame_decoding(logger, config)
+    decode_pool = get_decode_pool(logger, config)
+
+    # a missing private key stops the gateway here rather than in the thread of a shard
+    for gateway_id in config.sharding__gateway_ids:
+        get_gateway_private_key(logger, config.udmi_site_model_path, gateway_id)
+
+    def create_publisher(gateway_id, devices):
+        return _get_google_iot_core_publisher(logger, config, payload_encoder, gateway_id, devices)
+
+    shards = GatewayShards(logger, config.sharding__gateway_ids, config.site_details__devices, create_publisher,
+                           config.google_cloud__sample_rate_set, config.sharding__failover_timeout)
+    shards.start()
+
+    setup_metrics(logger, config)
+    if metrics.enabled:
+        add_metrics_collectors(google_iot_core_queue,
+                               lambda: {shard.gateway_id: shard.publisher for shard in shards.shards
+                                        if shard.publisher is not None},
+                               decode_pool, store_and_forward)
+    next_state_publish_time = datetime.datetime.utcnow()
+
+    # Main loop start
+    while True:
+        timeout = (shards.get_next_publish_time() - datetime.datetime.utcnow()).total_seconds()
+        timeout = min(max(timeout, 0.0), MAX_QUEUE_WAIT_TIME)
+
+        process_received_payloads(logger, google_iot_core_queue, udmi_handler, decode_pool, timeout, config)
+
+        shards.rebalance()
+
+        if store_and_forward is not None:
+            shards.replay(store_and_forward, config.google_cloud__max_queued_publishes)
+
+        due_shards = shards.get_due_shards()
+        for shard in due_shards:
+            online_device_ids = shard.get_online_device_ids()
+            if online_device_ids:
+                publish_payloads(logger, shard.publisher, udmi_handler, config.google_cloud__sample_rate_set,
+                                 config.google_cloud__publish_mode, config.google_cloud__keyframe_interval,
+                                 shards.get_modbus_slave_ids(online_device_ids))
+
+            offline_device_ids = shard.assigned - online_device_ids
+            if offline_device_ids and store_and_forward is not None:
+                store_payloads(logger, store_and_forward, udmi_handler, config.google_cloud__sample_rate_set,
+                               config.google_cloud__publish_mode, config.google_cloud__keyframe_interval,
+                               shards.get_modbus_slave_ids(offline_device_ids))
+
+            logger.info(f"Gateway '{shard.gateway_id}': {len(online_device_ids)} devices published, "
+                        f"{len(offline_device_ids)} offline")
+
+        if due_shards:
+            logger.info(f"Internal broker messages: {google_iot_core_queue.get_counters()}")
+            logger.info(f"Google Cloud gateways: {shards.get_stats()}")
+
+        if metrics.enabled and config.metrics__state_interval and \
+                next_state_publish_time < datetime.datetime.utcnow():
+            # every gateway reports the metrics of the whole pipeline
+            for shard in shards.shards:
+                if shard.is_online():
+                    next_state_publish_time = publish_gateway_state(logger, shard.publisher, udmi_handler,
+                                                                    shard.gateway_id, config.metrics__state_interval)
+
+
 def start_google_iot_core_gateway(logger, args, root_dir=None):
     """
         Main function responsible for setting up environment, parsing configs, establishing connections
@@ -244,39 +866,70 @@ def start_google_iot_core_gateway(logger, args, root_dir=None):
         """
     config = ConfigHandler(logger, args, root_dir)
     #update_logger_verbose_level(logger, config.verbose_level)
-    
-    max_queue_size = 50    
-    google_iot_core_queue = Queue(maxsize=max_queue_size)
-    int_broker_subscriber = MosquittoMQTTSubscriber(logger, google_iot_core_queue,
-                                                    config.internal_broker__mqtt_bridge_hostname,
-                                                    config.internal_broker__mqtt_bridge_port,
-                                                    config.internal_broker__trusted_root_ca,
-                                                    config.internal_broker__x509_certificate,
-                                                    config.internal_broker__private_key,
-                                                    config.internal_broker__tls_insecure_set,
-                                                    config.internal_broker__enable_tls
-                                                    )
+
+    if len(config.sharding__gateway_ids) > 1:
+        if config.processing__runtime == "asyncio":
+            logger.warning("Sharded gateways run on the threaded runtime, 'processing.runtime' is ignored")
+        run_sharded_google_iot_core_gateway(logger, config)
+        return
+
+    if config.processing__runtime == "asyncio":
+        # imported here, the asyncio runtime reuses the building blocks of this module
+        from google_iot_core_gateway.gcp_async_handler import run_google_iot_core_gateway_async
+        asyncio.run(run_google_iot_core_gateway_async(logger, config))
+        return
+
+    int_broker_subscriber, google_iot_core_queue = get_internal_broker_subscriber(logger, config)
     int_broker_subscriber.run()
 
     google_iot_core_publisher, udmi_handler = prepare_google_cloud_environment(logger, config)
+    store_and_forward = get_store_and_forward(logger, config)
+    setup_frame_decoding(logger, config)
+    decode_pool = get_decode_pool(logger, config)
+
+    setup_metrics(logger, config)
+    if metrics.enabled:
+        add_metrics_collectors(google_iot_core_queue,
+                               lambda: {config.site_details__gateway_id: google_iot_core_publisher},
+                               decode_pool, store_and_forward)
+
+    start_connection_supervisor(logger, google_iot_core_publisher)
 
     # Loop variables setup
     sample_rate_set = config.google_cloud__sample_rate_set
     next_payload_publish_time = datetime.datetime.utcnow()
+    next_state_publish_time = datetime.datetime.utcnow()
 
     # Main loop start
     while True:
-        time.sleep(1)
+        # Wait for messages until the next payload publishing, but at least once a second check the connection
+        timeout = (next_payload_publish_time - datetime.datetime.utcnow()).total_seconds()
+        timeout = min(max(timeout, 0.0), MAX_QUEUE_WAIT_TIME)
 
-        process_payloads(logger, google_iot_core_queue, udmi_handler)
+        process_received_payloads(logger, google_iot_core_queue, udmi_handler, decode_pool, timeout, config)
 
-        is_connected = google_iot_core_publisher.is_connection_open()
-        if not is_connected:
+        if not google_iot_core_publisher.is_publishing:
+            if store_and_forward is not None and next_payload_publish_time < datetime.datetime.utcnow():
+                next_payload_publish_time = store_payloads(logger, store_and_forward, udmi_handler, sample_rate_set,
+                                                           config.google_cloud__publish_mode,
+                                                           config.google_cloud__keyframe_interval)
             continue
 
+        if store_and_forward is not None:
+            replay_payloads(google_iot_core_publisher, store_and_forward, config.google_cloud__max_queued_publishes)
+
         if next_payload_publish_time < datetime.datetime.utcnow():
             next_payload_publish_time = publish_payloads(logger, google_iot_core_publisher, udmi_handler,
-                                                         sample_rate_set)
+                                                         sample_rate_set, config.google_cloud__publish_mode,
+                                                         config.google_cloud__keyframe_interval)
+            logger.info(f"Internal broker messages: {google_iot_core_queue.get_counters()}")
+            logger.info(f"Google Cloud publishes: {google_iot_core_publisher.get_publish_stats()}")
+
+        if metrics.enabled and config.metrics__state_interval and \
+                next_state_publish_time < datetime.datetime.utcnow():
+            next_state_publish_time = publish_gateway_state(logger, google_iot_core_publisher, udmi_handler,
+                                                            config.site_details__gateway_id,
+                                                            config.metrics__state_interval)
 
 
 def start_standalone_google_iot_core_gateway(assigned_args=None, logger=None):
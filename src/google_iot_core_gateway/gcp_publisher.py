@@ -1,10 +1,13 @@
 import datetime
+import logging
 import random
 import ssl
 import time
 import socket
+import threading
 import paho.mqtt.client as mqtt
 
+from google_iot_core_gateway.publish_pipeline import PublishPipeline
 from google_iot_core_gateway.utils.jwt_handler import create_jwt
 
 # Change Log 2024 August 06
@@ -20,11 +23,26 @@ Removed loop_stop() under on_disconnect callback
 Handle socket.timeout exception paho mqtt client.connect() method
 Added keep alive in client.connect() method to prevent timeout 
 """
+# Change Log 2026 October 17
+"""
+Replaced time.sleep(5) after client.connect() by waiting for on_connect with a timeout
+Attach messages of all devices are pipelined and their PUBACKs awaited instead of time.sleep(2) per device
+Added proactive JWT rotation reconnecting the same client with a pre-signed JWT while buffering publishes
+Publishes go through a PublishPipeline bounding the messages waiting for PUBACK and superseding queued payloads
+Payloads can be encoded per topic (zlib/gzip/CBOR) by a PayloadEncoder before they are published
+Devices can be attached and detached while connected, for the gateways sharing the proxy devices
+paho log callback only set when DEBUG is enabled, paho formats its messages of every packet for it
+Publish latency histograms exposed for the metrics endpoint
+Devices attached by is_connection_open when the CONNACK came after the connect timeout or paho reconnected
+"""
 
 class GoogleIoTCoreMQTTPublisher:
 
     def __init__(self, logger, connected_devices, project_id, cloud_region, registry_id, gateway_id, private_key_file,
-                 ca_cert, mqtt_bridge_hostname, mqtt_bridge_port, jwt_signing_algorithm="RS256"):
+                 ca_cert, mqtt_bridge_hostname, mqtt_bridge_port, jwt_signing_algorithm="RS256", connect_timeout=10,
+                 attach_timeout=10, max_inflight_attach=10, jwt_rotation="proactive", jwt_lifetime=20,
+                 jwt_refresh_lead_time=60, max_inflight_publishes=20, max_queued_publishes=1000,
+                 publish_ack_timeout=30, payload_encoder=None):
         self.logger = logger
         self._connected_devices = connected_devices
         self._project_id = project_id
@@ -42,13 +60,71 @@ class GoogleIoTCoreMQTTPublisher:
         
         self._protocol_version = mqtt.MQTTv311
 
+        # Time in seconds to wait for CONNACK and for the PUBACKs of the attach messages
+        self._connect_timeout = connect_timeout
+        self._attach_timeout = attach_timeout
+        # Maximum number of attach messages waiting for PUBACK
+        self._max_inflight_attach = max_inflight_attach
+
+        # 'proactive': the next JWT is signed in the background and the same client reconnects with it while
+        #              the publishes are buffered. 'recreate': the client is torn down and a new one is created.
+        self._jwt_rotation = jwt_rotation
+        # JWT lifetime in minutes and time in seconds before its expiry when it is replaced
+        self._jwt_lifetime = jwt_lifetime
+        self._jwt_refresh_lead_time = jwt_refresh_lead_time
+        self._rotation_thread = None
+        self._rotating = False
+
+        # Encoding of the payloads per topic, JSON payloads are sent as they are if not set
+        self._payload_encoder = payload_encoder
+
+        # The payloads are queued while the client is disconnected or the JWT is rotated
+        self._max_inflight_publishes = max_inflight_publishes
+        self._max_queued_publishes = max_queued_publishes
+        self._publish_pipeline = PublishPipeline(logger, self._publish, self._can_publish,
+                                                 max_inflight=max_inflight_publishes,
+                                                 max_queued=max_queued_publishes,
+                                                 ack_timeout=publish_ack_timeout)
+
         self._is_connected = False
+        self._connected_event = threading.Event()
+        # Number of successful connections, and the connection on which all the devices were attached
+        self._session = 0
+        self._attached_session = None
+
+        # mids of the attach messages waiting for PUBACK, and PUBACKs received before their mid was recorded
+        self._attach_acks = threading.Condition()
+        self._attach_pending = set()
+        self._attach_early_acks = set()
+        self._attach_in_progress = False
 
         self.client, self._jwt_exp = self._get_client()
 
         self._attach_devices_to_gateway()
         
 
+    @property
+    def _devices_attached(self):
+        """
+        True if all the devices were attached since the client last connected.
+        """
+        return self._attached_session == self._session
+
+    @property
+    def is_connected(self):
+        """
+        Connection state as reported by the paho callbacks, without validating the JWT or reconnecting.
+        """
+        return self._is_connected
+
+    @property
+    def is_publishing(self):
+        """
+        True if the payloads published now are sent, once the devices are attached or the JWT is rotated.
+        Unlike is_connection_open, it neither validates the JWT nor reconnects, so it never blocks.
+        """
+        return self._is_connected or self._rotating
+
     def error_str(self, rc):
         """
         Convert a Paho error to a human readable string.
@@ -59,6 +135,11 @@ class GoogleIoTCoreMQTTPublisher:
         """
         Callback for when a device connects.
         """
+        if rc != 0:
+            self.logger.error(f"on_connect: {mqtt.connack_string(rc)}")
+            self._connected_event.set()
+            return
+
         self.logger.info("*************************************************************")
         self.logger.info("Connected successfully to Google Cloud IoT Core")
         self.logger.info("*************************************************************")
@@ -66,7 +147,10 @@ class GoogleIoTCoreMQTTPublisher:
         # After a successful connect, reset backoff time and stop backing off.
         self._minimum_backoff_time = 1
 
+        # The devices are attached again on every new connection
+        self._session += 1
         self._is_connected = True
+        self._connected_event.set()
 
     def on_disconnect(self, client, user_data, rc):
         """
@@ -81,12 +165,28 @@ class GoogleIoTCoreMQTTPublisher:
         # exponential backoff.
         self._is_connected = False
 
+        # Stop waiting for CONNACK and PUBACKs which will not come any more
+        self._connected_event.set()
+        with self._attach_acks:
+            self._attach_acks.notify_all()
+        self._publish_pipeline.on_disconnect()
+
     def on_publish(self, client, user_data, mid):
         """
         Paho callback when a message is sent to the broker.
         """
         self.logger.debug(f"on_publish - mid: {mid}")
 
+        with self._attach_acks:
+            if mid in self._attach_pending:
+                self._attach_pending.discard(mid)
+                self._attach_acks.notify_all()
+                return
+            elif self._attach_in_progress:
+                self._attach_early_acks.add(mid)
+
+        self._publish_pipeline.on_publish(mid)
+
     def on_message(self, client, user_data, message):
         """
         Callback when the device receives a message on a subscription.
@@ -115,14 +215,6 @@ class GoogleIoTCoreMQTTPublisher:
 
         client = mqtt.Client(client_id=client_id, protocol=self._protocol_version)
 
-        # With Google Cloud IoT Core, the username field is ignored, and the
-        # password field is used to transmit a JWT to authorize the device.
-        jwt, jwt_exp = create_jwt(self.logger, self._project_id, self._private_key_file, self._jwt_signing_algorithm)
-        client.username_pw_set(
-            username="unused",
-            password=jwt
-        )
-
         # Enable SSL/TLS support.
         client.tls_set(ca_certs=self._ca_cert, tls_version=ssl.PROTOCOL_TLSv1_2)
 
@@ -134,14 +226,47 @@ class GoogleIoTCoreMQTTPublisher:
         client.on_publish = self.on_publish
         client.on_message = self.on_message
         client.on_subscribe = self.on_subscribe
-        client.on_log = self.on_log
+        # paho formats its log messages of every packet only when on_log is set
+        if self.logger.isEnabledFor(logging.DEBUG):
+            client.on_log = self.on_log
+
+        # paho queues the messages beyond its in-flight window without limit, the pipeline keeps it empty
+        client.max_inflight_messages_set(max(self._max_inflight_publishes, self._max_inflight_attach))
+        client.max_queued_messages_set(self._max_queued_publishes)
+
+        jwt_exp = self._connect_client(client)
+
+        return client, jwt_exp
+
+    def _create_jwt(self):
+        return create_jwt(self.logger, self._project_id, self._private_key_file, self._jwt_signing_algorithm,
+                          self._jwt_lifetime)
+
+    def _connect_client(self, client, jwt=None, jwt_exp=None):
+        """
+        Connect the client to the Google MQTT bridge, subscribe to the gateway topics and start the network loop.
+        Args:
+            client: paho client
+            jwt: JWT used as password, a new one is created if not given
+            jwt_exp: expiry of the given JWT
+        Returns:
+            Expiry of the JWT used to connect
+        """
+        # With Google Cloud IoT Core, the username field is ignored, and the
+        # password field is used to transmit a JWT to authorize the device.
+        if jwt is None:
+            jwt, jwt_exp = self._create_jwt()
+        client.username_pw_set(
+            username="unused",
+            password=jwt
+        )
 
         # Connect to the Google MQTT bridge.
         self.logger.debug("Connecting to the Google IoT Cloud")
         
+        self._connected_event.clear()
         try:
             client.connect(host=self._mqtt_bridge_hostname, port=self._mqtt_bridge_port, keepalive=self._keep_alive_sec)
-            time.sleep(5)
         except socket.timeout:
             self.logger.error("Connection attempt timed out!")
         except socket.error as e:
@@ -163,13 +288,96 @@ class GoogleIoTCoreMQTTPublisher:
 
         client.loop_start()
 
-        return client, jwt_exp
+        # Wait for CONNACK instead of a fixed delay
+        if not self._connected_event.wait(self._connect_timeout):
+            self.logger.error(f"No CONNACK received from the Google Cloud within {self._connect_timeout}s")
+
+        return jwt_exp
+
+    def _attach_devices_to_gateway(self, device_ids=None):
+        """
+        Attach the devices to the gateway and subscribe to their topics.
+
+        The attach messages are pipelined, up to max_inflight_attach of them wait for PUBACK at the same time.
+        The devices are subscribed to once their attach messages are acknowledged or the attach timeout expires.
+        If the client is not connected, e.g. the CONNACK came after the connect timeout, all the devices are
+        attached by is_connection_open once it is.
+        Args:
+            device_ids: devices to attach, all the connected devices by default
+        """
+        all_devices = device_ids is None
+        if all_devices:
+            device_ids = list(self._connected_devices)
+
+        if not self._is_connected:
+            self.logger.error("Not connected to the Google Cloud, devices are attached once connected")
+            return
 
-    def _attach_devices_to_gateway(self):
-        for device_id, device_details in self._connected_devices.items():
-            self.attach_device_to_gateway(device_id)
+        session = self._session
+        deadline = time.monotonic() + self._attach_timeout
+        with self._attach_acks:
+            self._attach_pending.clear()
+            self._attach_early_acks.clear()
+            self._attach_in_progress = True
+
+        try:
+            for device_id in device_ids:
+                with self._attach_acks:
+                    while len(self._attach_pending) >= self._max_inflight_attach:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or not self._is_connected:
+                            break
+                        self._attach_acks.wait(remaining)
+
+                message_info = self.attach_device_to_gateway(device_id)
+
+                with self._attach_acks:
+                    if message_info.mid in self._attach_early_acks:
+                        self._attach_early_acks.discard(message_info.mid)
+                    elif message_info.rc == mqtt.MQTT_ERR_SUCCESS:
+                        self._attach_pending.add(message_info.mid)
+                    else:
+                        self.logger.error(f"Attaching device '{device_id}' failed: {self.error_str(message_info.rc)}")
+
+            with self._attach_acks:
+                while self._attach_pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._is_connected:
+                        break
+                    self._attach_acks.wait(remaining)
+                if self._attach_pending:
+                    self.logger.error(f"{len(self._attach_pending)} attach messages not acknowledged within "
+                                      f"{self._attach_timeout}s")
+        finally:
+            with self._attach_acks:
+                self._attach_in_progress = False
+                self._attach_pending.clear()
+                self._attach_early_acks.clear()
+
+        for device_id in device_ids:
             self.subscribe_to_device_topics(device_id)
-            time.sleep(2)
+
+        if all_devices and self._is_connected and session == self._session:
+            self._attached_session = session
+
+    def attach_devices(self, devices):
+        """
+        Add the devices to the gateway, they are attached now if connected, otherwise once the client reconnects.
+        Args:
+            devices: {device_id: device details}
+        """
+        self._connected_devices.update(devices)
+        if self._is_connected:
+            self._attach_devices_to_gateway(list(devices))
+
+    def detach_devices(self, device_ids):
+        """
+        Remove the devices from the gateway, e.g. when they are moved to another gateway.
+        """
+        for device_id in device_ids:
+            self._connected_devices.pop(device_id, None)
+            if self._is_connected:
+                self._publish(device_id, "{}", topic="detach", qos=1)
 
     def _reconnect(self):
         self.logger.info("*************************************************************")
@@ -186,23 +394,70 @@ class GoogleIoTCoreMQTTPublisher:
         self.client.disconnect()
         self.client, self._jwt_exp = self._get_client()
         self._attach_devices_to_gateway()
+        self._publish_pipeline.pump()
+
+    def _rotate_jwt_token(self):
+        """
+        Replace the JWT without losing publishes, runs in the rotation thread.
+
+        The next JWT is signed while the current session keeps publishing. The same client then reconnects
+        with the new JWT and re-attaches the devices, the publishes made in the meantime are queued
+        in the publish pipeline and sent once the devices are attached again.
+        """
+        try:
+            jwt, jwt_exp = self._create_jwt()
+
+            self._rotating = True
 
-    def _validate_jwt_token(self):
-        seconds_till_token_expires = (self._jwt_exp - datetime.datetime.utcnow()).total_seconds()
-        if seconds_till_token_expires < 60:
-            self.logger.info("*************************************************************")
-            self.logger.info("Refreshing JWT token")
-            self.logger.info("*************************************************************")
             self.client.loop_stop()
             self.client.disconnect()
-            self.client, self._jwt_exp = self._get_client()
+            self._jwt_exp = self._connect_client(self.client, jwt, jwt_exp)
             self._attach_devices_to_gateway()
+        except Exception as ex:
+            self.logger.error(f"JWT rotation failed: {ex}")
+        finally:
+            self._rotating = False
+
+        self._publish_pipeline.pump()
+
+    def _validate_jwt_token(self):
+        seconds_till_token_expires = (self._jwt_exp - datetime.datetime.utcnow()).total_seconds()
+        if seconds_till_token_expires >= self._jwt_refresh_lead_time:
+            return
+
+        if self._jwt_rotation == "proactive":
+            if self._rotation_thread is None or not self._rotation_thread.is_alive():
+                self.logger.info("*************************************************************")
+                self.logger.info("Rotating JWT token")
+                self.logger.info("*************************************************************")
+                self._rotation_thread = threading.Thread(target=self._rotate_jwt_token, name="jwt-rotation",
+                                                         daemon=True)
+                self._rotation_thread.start()
+            return
+
+        self.logger.info("*************************************************************")
+        self.logger.info("Refreshing JWT token")
+        self.logger.info("*************************************************************")
+        self.client.loop_stop()
+        self.client.disconnect()
+        self.client, self._jwt_exp = self._get_client()
+        self._attach_devices_to_gateway()
+        self._publish_pipeline.pump()
 
     def is_connection_open(self):
         self._validate_jwt_token()
 
+        # While the JWT is rotated the publishes are buffered, the connection is reported as open
+        if self._rotating:
+            return True
+
         if self._is_connected:
             self.logger.debug("Connection to Google Cloud is active!")
+            if not self._devices_attached:
+                # connected after the connect timeout, or reconnected by paho
+                self.logger.info("Devices not attached since the client connected, attaching them")
+                self._attach_devices_to_gateway()
+                self._publish_pipeline.pump()
             return True
         else:
             self._reconnect()
@@ -214,11 +469,48 @@ class GoogleIoTCoreMQTTPublisher:
         device_config_topic = "/devices/{}/config".format(device_id)
         self.client.subscribe(device_config_topic, qos=1)
 
-    def publish(self, device_id, payload, topic="state", qos=1):
+    def _can_publish(self):
+        return self._is_connected and self._devices_attached and not self._rotating
+
+    def publish(self, device_id, payload, topic="state", qos=1, supersede=True):
+        """
+        Queue the payload in the publish pipeline, it is sent as soon as the in-flight window allows.
+        A queued payload not sent yet is superseded by a newer payload of the same device and topic,
+        unless supersede is False.
+        """
+        if self._payload_encoder is not None:
+            payload = self._payload_encoder.encode(topic, payload)
+        self._publish_pipeline.submit(device_id, payload, topic, qos, supersede)
+
+    @property
+    def queued_publishes(self):
+        """
+        Number of payloads waiting in the publish pipeline to be sent.
+        """
+        return self._publish_pipeline.qsize()
+
+    def get_publish_stats(self):
+        """
+        Returns:
+            Counters and latency histograms of the publish pipeline
+        """
+        return dict(self._publish_pipeline.get_counters(), **self._publish_pipeline.get_histograms())
+
+    def get_publish_histograms(self):
+        """
+        Returns:
+            {'latency': submit to PUBACK Histogram, 'ack_time': send to PUBACK Histogram}
+        """
+        return {
+            "latency": self._publish_pipeline.latency,
+            "ack_time": self._publish_pipeline.ack_time,
+        }
+
+    def _publish(self, device_id, payload, topic="state", qos=1):
         # self.client.loop()
         device_topic = "/devices/{}/{}".format(device_id, topic)
-        self.client.publish(device_topic, payload, qos=qos)
+        return self.client.publish(device_topic, payload, qos=qos)
 
     def attach_device_to_gateway(self, device_id, auth=""):
         attach_payload = '{{"authorization" : "{}"}}'.format(auth)
-        self.publish(device_id, attach_payload, topic="attach", qos=1)
+        return self._publish(device_id, attach_payload, topic="attach", qos=1)
@@ -0,0 +1,136 @@
+import os
+import zlib
+import gzip
+import time
+import struct
+import threading
+
+# First bytes of a capture file
+CAPTURE_MAGIC = b"MXCAP1\n"
+# Record header: time.time() when the message was received, length of the message
+RECORD_HEADER = struct.Struct(">dI")
+# The messages of a site compress well, they are hex strings of the same register blocks
+CAPTURE_COMPRESS_LEVEL = 6
+# Errors of a gzip stream which was cut, e.g. by a kill before the end of its last member was written
+TRUNCATED_GZIP_ERRORS = (EOFError, zlib.error, gzip.BadGzipFile)
+
+
+def is_capture_complete(path):
+    """
+    Args:
+        path: path of the capture file
+    Returns:
+        True if the file is a capture whose gzip stream ends cleanly, i.e. a new gzip member can be appended to it
+    """
+    try:
+        with gzip.open(path, "rb") as capture_file:
+            if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                return False
+            while capture_file.read(1024 * 1024):
+                pass
+    except TRUNCATED_GZIP_ERRORS:
+        return False
+    return True
+
+
+def get_rotated_path(path):
+    """
+    Returns:
+        First path not taken of the form '<name>.<n><extension>', e.g. 'capture.1.gz' for 'capture.gz'
+    """
+    name, extension = os.path.splitext(path)
+    n = 1
+    while os.path.exists(f"{name}.{n}{extension}"):
+        n += 1
+    return f"{name}.{n}{extension}"
+
+
+class CaptureWriter:
+    """
+    Append-only capture of the raw internal broker messages with their receive time.
+
+    The records are written into a gzip stream, flushed at least every flush_interval seconds, so a capture
+    cut by a power loss or a kill is readable up to the last flush. Writing to an existing capture appends a
+    new gzip member, which the reader reads as one stream. A gzip member appended after a cut one could not be
+    read, so an existing file which does not end cleanly is renamed, see get_rotated_path, and a new capture
+    is started.
+
+    Args:
+        logger: logger
+        path: path of the capture file
+        flush_interval: maximum time in seconds the records are buffered
+    """
+
+    def __init__(self, logger, path, flush_interval=1.0):
+        self.logger = logger
+        self.path = path
+        self.flush_interval = flush_interval
+
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not is_new and not is_capture_complete(path):
+            rotated_path = get_rotated_path(path)
+            os.rename(path, rotated_path)
+            self.logger.warning(f"Capture '{path}' was not closed, renamed to '{rotated_path}'")
+            is_new = True
+        self._file = gzip.open(path, "ab", compresslevel=CAPTURE_COMPRESS_LEVEL)
+        if is_new:
+            self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self._next_flush_time = time.monotonic() + flush_interval
+
+        self.records = 0
+        self.logger.info(f"Capturing the internal broker messages into '{path}'")
+
+    def write(self, payload, received_at):
+        """
+        Args:
+            payload: raw message
+            received_at: time.time() when the message was received
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(RECORD_HEADER.pack(received_at, len(payload)))
+            self._file.write(payload)
+            self.records += 1
+
+            now = time.monotonic()
+            if now >= self._next_flush_time:
+                self._file.flush()
+                self._next_flush_time = now + self.flush_interval
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        self.logger.info(f"{self.records} internal broker messages captured into '{self.path}'")
+
+
+def read_capture(path):
+    """
+    Read the records of a capture, up to the last complete record if the capture was cut.
+    Args:
+        path: path of the capture file
+    Returns:
+        Generator of (received_at, payload)
+    Raises:
+        ValueError if the file is not a capture
+    """
+    with gzip.open(path, "rb") as capture_file:
+        try:
+            if capture_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError(f"'{path}' is not a capture of the internal broker messages")
+            while True:
+                header = capture_file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                received_at, length = RECORD_HEADER.unpack(header)
+                payload = capture_file.read(length)
+                if len(payload) < length:
+                    return
+                yield received_at, payload
+        except TRUNCATED_GZIP_ERRORS:
+            # the end of the gzip stream was not written, the capture was not closed
+            return
@@ -0,0 +1,229 @@
+import json
+import time
+import threading
+import multiprocessing
+from collections import deque
+from queue import Empty, Full
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+COALESCE = "coalesce"
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+RING_BUFFER = "ring-buffer"
+MULTIPROCESSING = "multiprocessing"
+
+QUEUE_TYPES = (RING_BUFFER, MULTIPROCESSING)
+
+
+class FrameRingBuffer:
+    """
+    Bounded in-process FIFO of the messages received from the internal broker.
+
+    The producer (paho network thread) and the consumer (main loop) run in the same process, so the messages
+    are handed over as they are, without pickling them and pushing them through a pipe like multiprocessing.Queue
+    does. The interface is the subset of queue.Queue used by FrameHandoff and the main loop.
+
+    Args:
+        maxsize: maximum number of messages in the buffer
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+        self._waiting = 0
+
+    def put_nowait(self, item):
+        with self._not_empty:
+            if len(self._items) >= self.maxsize:
+                raise Full
+            self._items.append(item)
+            if self._waiting:
+                self._not_empty.notify()
+
+    def put(self, item, block=False, timeout=None):
+        # the producer never waits for room in the buffer, see FrameHandoff overflow policies
+        self.put_nowait(item)
+
+    def get_nowait(self):
+        try:
+            return self._items.popleft()
+        except IndexError:
+            raise Empty from None
+
+    def get(self, block=True, timeout=None):
+        try:
+            return self._items.popleft()
+        except IndexError:
+            if not block:
+                raise Empty from None
+
+        with self._not_empty:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            self._waiting += 1
+            try:
+                while not self._items:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise Empty
+                    self._not_empty.wait(remaining)
+                return self._items.popleft()
+            finally:
+                self._waiting -= 1
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    def full(self):
+        return len(self._items) >= self.maxsize
+
+
+def create_frames_queue(queue_type, maxsize):
+    """
+    Create the queue of the messages received from the internal broker.
+
+    Args:
+        queue_type: 'ring-buffer' when the subscriber and the processing run in the same process,
+                    'multiprocessing' for a multi-process topology
+        maxsize: maximum number of queued messages
+    Returns:
+        FrameRingBuffer or multiprocessing.Queue
+    """
+    if queue_type == RING_BUFFER:
+        return FrameRingBuffer(maxsize)
+    if queue_type == MULTIPROCESSING:
+        return multiprocessing.Queue(maxsize=maxsize)
+    raise ValueError(f"Unknown queue type '{queue_type}'. Expected one of {QUEUE_TYPES}")
+
+
+def get_frame_key(payload):
+    """
+    Get the register block of the message received from the internal broker.
+
+    Sample payload:
+    b'{"rtu_request": "01030bb70004...", "rtu_response": "..."}'
+
+    Returns:
+        (slave_id, starting_address) of the RTU request, None if the payload can't be parsed
+    """
+    try:
+        rtu_request = bytes.fromhex(json.loads(payload)["rtu_request"])
+        return rtu_request[0], int.from_bytes(rtu_request[2:4], "big")
+    except (ValueError, KeyError, TypeError, IndexError):
+        return None
+
+
+class FrameHandoff:
+    """
+    Hand off of the messages received from the internal broker to the processing pipeline.
+
+    put() never blocks the paho network thread. When the queue is full the overflow policy decides which
+    message is lost:
+        drop-oldest: the oldest queued message is dropped to make room for the new one
+        drop-newest: the new message is dropped
+        coalesce: a queued message is replaced by a newer message of the same (slave_id, starting address)
+                  register block, UDMIHandler keeps only the latest value of a point anyway. New register
+                  blocks are dropped when the queue is full.
+
+    The consumer side has the same get() / get_nowait() / qsize() interface as the queue. The items are
+    (received_at, payload) tuples, received_at being the time.time() when the message was received or None.
+
+    Args:
+        logger: logger
+        frames_queue: bounded queue the messages are handed off to
+        overflow_policy: one of OVERFLOW_POLICIES
+    """
+
+    def __init__(self, logger, frames_queue, overflow_policy=DROP_OLDEST):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{overflow_policy}'. Expected one of {OVERFLOW_POLICIES}")
+
+        self.logger = logger
+        self.overflow_policy = overflow_policy
+        self._queue = frames_queue
+        self._lock = threading.Lock()
+
+        # Latest message of each queued register block, the queue holds the register block keys
+        self._pending = {}
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def put(self, payload, received_at=None):
+        item = (received_at, payload)
+        if self.overflow_policy == COALESCE:
+            key = get_frame_key(payload)
+            if key is not None:
+                self._put_coalesced(key, item)
+                return
+            item = (None, item)
+
+        with self._lock:
+            try:
+                self._queue.put_nowait(item)
+                self.enqueued += 1
+                return
+            except Full:
+                pass
+
+            if self.overflow_policy == DROP_OLDEST:
+                try:
+                    self._queue.get_nowait()
+                    self._queue.put_nowait(item)
+                    self.enqueued += 1
+                except (Empty, Full):
+                    pass
+            self.dropped += 1
+            self.logger.debug("Internal queue full, message dropped (%s)", self.overflow_policy)
+
+    def _put_coalesced(self, key, item):
+        with self._lock:
+            if key in self._pending:
+                self._pending[key] = item
+                self.coalesced += 1
+                return
+
+            self._pending[key] = item
+            try:
+                self._queue.put_nowait((key, None))
+                self.enqueued += 1
+            except Full:
+                del self._pending[key]
+                self.dropped += 1
+                self.logger.debug("Internal queue full, message of register block %s dropped", key)
+
+    def _unwrap(self, item):
+        if self.overflow_policy != COALESCE:
+            return item
+
+        key, queued_item = item
+        if key is None:
+            return queued_item
+        with self._lock:
+            return self._pending.pop(key)
+
+    def get(self, block=True, timeout=None):
+        return self._unwrap(self._queue.get(block, timeout))
+
+    def get_nowait(self):
+        return self._unwrap(self._queue.get_nowait())
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def get_counters(self):
+        """
+        Returns:
+            Number of enqueued, dropped and coalesced messages since the start
+        """
+        return {
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
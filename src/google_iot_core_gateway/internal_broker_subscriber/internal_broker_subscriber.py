@@ -1,9 +1,13 @@
 import ssl
+import time
+import atexit
 import logging
-from multiprocessing import Queue
 
 import paho.mqtt.client as mqtt
 
+from google_iot_core_gateway.internal_broker_subscriber.frame_handoff import FrameHandoff, FrameRingBuffer
+from google_iot_core_gateway.internal_broker_subscriber.capture import CaptureWriter
+
 
 class MosquittoMQTTSubscriber:
 
@@ -13,11 +17,18 @@ class MosquittoMQTTSubscriber:
                 certfile=None,
                 keyfile=None,
                 disable_tls_cert_verification=False,
-                enable_tls=False):
+                enable_tls=False,
+                capture_file=None):
 
         self.logger = logger
         self.google_iot_core_queue = google_iot_core_queue
 
+        # Capture of the received messages, to be replayed by benchmarks/replay_capture.py
+        self.capture = None
+        if capture_file:
+            self.capture = CaptureWriter(logger, capture_file)
+            atexit.register(self.capture.close)
+
         self._broker_url = host
         self._port = port
         self._trusted_root_ca = ca_certs
@@ -33,7 +44,9 @@ class MosquittoMQTTSubscriber:
         self.client.on_publish = self._on_publish
         self.client.on_subscribe = self._on_subscribe
         self.client.on_message = self._on_message
-        self.client.on_log = self._on_log
+        # paho formats its log messages of every packet only when on_log is set
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.client.on_log = self._on_log
         
         if self._enable_tls:
            self.client.tls_set(ca_certs=self._trusted_root_ca,
@@ -79,12 +92,14 @@ class MosquittoMQTTSubscriber:
         self.logger.debug("on_subscribed: " + str(mid) + " " + str(granted_qos))
 
     def _on_message(self, client, user_data, message):
-        payload = str(message.payload.decode("utf-8"))
-        self.logger.info("Received message '{}' on topic '{}' with Qos {}".format(
-            payload, message.topic, str(message.qos)
-        ))
+        self.logger.debug("Received message '%s' on topic '%s' with Qos %s", message.payload, message.topic,
+                          message.qos)
 
-        self.google_iot_core_queue.put(payload)
+        # The raw bytes are queued, they are decoded only once by json.loads when processed
+        received_at = time.time()
+        if self.capture is not None:
+            self.capture.write(message.payload, received_at)
+        self.google_iot_core_queue.put(message.payload, received_at)
 
     def _on_log(self, client, user_data, level, buf):
         self.logger.debug("on_log: (%s) - %s ", level, buf)
@@ -95,7 +110,7 @@ class MosquittoMQTTSubscriber:
 
 def main():
     logger = logging.getLogger(__name__)
-    messages_queue = Queue()
+    messages_queue = FrameHandoff(logger, FrameRingBuffer(maxsize=50))
 
     int_broker_subscriber = MosquittoMQTTSubscriber(logger, messages_queue)
     int_broker_subscriber.run()
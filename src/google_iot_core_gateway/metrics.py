@@ -0,0 +1,222 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google_iot_core_gateway.utils.histogram import Histogram
+
+# Prefix of the metric names exposed in the Prometheus text format
+METRICS_PREFIX = "modbus_gateway_"
+# Quantiles of the histograms exposed as Prometheus summaries
+QUANTILES = (50, 90, 99)
+# Durations recorded in the first bucket of the histograms, the frames are decoded in microseconds
+HISTOGRAM_LOWEST = 0.000001
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+def format_labels(labels):
+    """
+    Args:
+        labels: ((name, value), ...)
+    Returns:
+        Labels in the Prometheus text format, e.g. '{stage="decode",meter_type="PM5561"}', '' if there are none
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of the gateway pipeline.
+
+    The metrics are identified by a name and a tuple of (label, value) pairs, e.g.
+    metrics.observe("stage_seconds", 0.0002, (("stage", "decode"), ("meter_type", "PM5561"))).
+    Collectors registered with add_collector report the counters the other components already keep
+    (queue, publish pipeline, decode workers...), they are only called when the metrics are read.
+
+    The metrics are disabled until enable() is called. The instrumented code checks metrics.enabled before
+    taking any time or building any label, so disabled metrics cost one attribute lookup per call site.
+    The metrics are recorded by the thread processing the frames without a lock, the readers (HTTP endpoint,
+    gateway state) copy the dictionaries, which does not release the GIL.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started_at = time.time()
+
+        # (name, labels) -> value or Histogram
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self.started_at = time.time()
+
+    def increment(self, name, labels=(), value=1):
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=()):
+        self._gauges[(name, labels)] = value
+
+    def get_gauge(self, name, labels=()):
+        """
+        Returns:
+            Value of the gauge, None if it was never set
+        """
+        return self._gauges.get((name, labels))
+
+    def observe(self, name, value, labels=()):
+        """
+        Record the value, in seconds, into the histogram of the name and labels.
+        """
+        histogram = self._histograms.get((name, labels))
+        if histogram is None:
+            histogram = self._histograms[(name, labels)] = Histogram(lowest=HISTOGRAM_LOWEST)
+        histogram.record(value)
+
+    def add_collector(self, collector):
+        """
+        Args:
+            collector: function returning [(COUNTER, GAUGE or HISTOGRAM, name, labels, value or Histogram)],
+                       called each time the metrics are read
+        """
+        self._collectors.append(collector)
+
+    def _get_samples(self):
+        """
+        Returns:
+            {kind: {name: {labels: value or Histogram}}} of the recorded and collected metrics
+        """
+        samples = {COUNTER: {}, GAUGE: {}, HISTOGRAM: {}}
+        for kind, recorded in ((COUNTER, self._counters), (GAUGE, self._gauges), (HISTOGRAM, self._histograms)):
+            for (name, labels), value in dict(recorded).items():
+                samples[kind].setdefault(name, {})[labels] = value
+
+        for collector in list(self._collectors):
+            for kind, name, labels, value in collector():
+                samples[kind].setdefault(name, {})[labels] = value
+        samples[GAUGE]["uptime_seconds"] = {(): time.time() - self.started_at}
+        return samples
+
+    def render_prometheus(self):
+        """
+        Returns:
+            The metrics in the Prometheus text exposition format, the histograms as summaries
+        """
+        samples = self._get_samples()
+        lines = []
+        for kind in (COUNTER, GAUGE):
+            for name, values in sorted(samples[kind].items()):
+                name = METRICS_PREFIX + name
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in values.items():
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for name, values in sorted(samples[HISTOGRAM].items()):
+            name = METRICS_PREFIX + name
+            lines.append(f"# TYPE {name} summary")
+            for labels, histogram in values.items():
+                for percent in QUANTILES:
+                    value = histogram.percentile(percent)
+                    quantile_labels = labels + (("quantile", percent / 100),)
+                    lines.append(f"{name}{format_labels(quantile_labels)} {'NaN' if value is None else value}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def get_snapshot(self, excluded_labels=("device",)):
+        """
+        Compact snapshot of the metrics, e.g. for the state of the gateway.
+        Args:
+            excluded_labels: metrics with one of these labels are left out, the per device metrics by default,
+                             which would not fit into a state message on a large site
+        Returns:
+            {"counters": {name{labels}: value}, "gauges": {...}, "histograms": {name{labels}: {count, p50...}}}
+        """
+        samples = self._get_samples()
+
+        def is_included(labels):
+            return not any(label in excluded_labels for label, _ in labels)
+
+        snapshot = {}
+        for kind, key in ((COUNTER, "counters"), (GAUGE, "gauges")):
+            snapshot[key] = {name + format_labels(labels): value
+                             for name, values in sorted(samples[kind].items())
+                             for labels, value in values.items() if is_included(labels)}
+        snapshot["histograms"] = {
+            name + format_labels(labels): {
+                "count": histogram.count,
+                **{f"p{percent}": histogram.percentile(percent) for percent in QUANTILES},
+            }
+            for name, values in sorted(samples[HISTOGRAM].items())
+            for labels, histogram in values.items() if is_included(labels)
+        }
+        return snapshot
+
+
+class MetricsServer:
+    """
+    HTTP endpoint serving the metrics in the Prometheus text format on /metrics, from its own thread.
+
+    Args:
+        logger: logger
+        metrics: Metrics to serve
+        host: address to listen on, the loopback interface by default so the metrics stay local
+        port: port to listen on
+    """
+
+    def __init__(self, logger, metrics, host="127.0.0.1", port=9108):
+        self.logger = logger
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = metrics.render_prometheus().encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logger.debug("Metrics endpoint: " + format, *args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread.start()
+        self.logger.info("Metrics served on http://{}:{}/metrics".format(*self.address))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Metrics of the process, enabled by the gateway configuration
+metrics = Metrics()
@@ -0,0 +1,374 @@
+
+# This software is licensed under GNU GENERAL PUBLIC LICENSE Version 3, 29 June 2007
+
+"""Compiled register decode plans for the Modbus to JSON decoder.
+
+Decoding an FC3/FC4 response needs the meter type of the slave (from config-google-gateway.json)
+and the meter definition file of that type (resources/modbus_dbo_maps/<type>.json). Both files are
+read once and every (meter type, starting address, quantity) register block seen on the bus is compiled
+into a DecodePlan holding the byte offsets, struct formats and DBO names of the points in that block.
+
+The files are re-read only when their modification time changes. The modification times are checked
+at most every `check_interval` seconds, so decoding a frame costs a dictionary lookup and no file I/O.
+"""
+
+import os
+import json
+import time
+import struct
+import logging
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+# struct format characters of the DBO map formats which can be decoded
+STRUCT_FORMATS = {
+    "float32": "f",
+    "int64": "q",
+    "int32u": "I",
+    "int16u": "H",
+}
+
+# slave id, function code and byte count precede the register data in the RTU response
+RTU_RESPONSE_HEADER_LENGTH = 3
+
+
+def is_even(number):
+    return number % 2 == 0
+
+
+def get_nested_key_value_pairs(data, parent_key=''):
+    items = []
+    if isinstance(data, dict):
+        for key, value in data.items():
+            full_key = f"{key}" if parent_key else key
+            if isinstance(value, dict):
+                items.append((full_key, value))
+                items.extend(get_nested_key_value_pairs(value, full_key))
+            elif isinstance(value, list):
+                items.extend(get_nested_key_value_pairs(value, full_key))
+    elif isinstance(data, list):
+        for index, value in enumerate(data):
+            full_key = f"{parent_key}[{index}]"
+            if isinstance(value, dict):
+                items.append((full_key, value))
+                items.extend(get_nested_key_value_pairs(value, full_key))
+            elif isinstance(value, list):
+                items.extend(get_nested_key_value_pairs(value, full_key))
+    return items
+
+
+def get_register_offset(register_address, starting_address, total_bytes):
+    """
+    Example from PM5111
+    "3000": {
+        "dbo_name": "line1_current_sensor",
+        "number_of_registers": 2,
+        "format": "float32",
+        "units": "Amperes"
+
+    Example: register address = 3000 (address from the meter definition definition file example PM5111)
+             starting address = 2999 (address recieved from incoming RTU Request)
+             start_index = (3000 - 2999) => 1 * 2
+             total_bytes = n * 2     (multiply by 2 in order to get total num of bytes, since each register
+                                      in RTU response is paired with 2 bytes)
+                                     (where n is total number of register given the meter definition file example PM5111)
+             end_index = 2 * total_bytes
+    """
+    start_index = ((register_address - starting_address) * 2) - 2
+    end_index = start_index + total_bytes
+    return start_index, end_index
+
+
+def resolve_ext_config_path(root_dir, directory, filename):
+    """
+    Configuration
+    ROOT_DIR = /home/moxa/moxa-gcloud-udmi
+    resources_path = /home/moxa-gcloud-udmi/resources/modbus_dbo_maps
+    """
+    resources_path = os.path.join(root_dir, directory)
+    if os.path.isdir(resources_path):
+        return os.path.join(resources_path, filename)
+    return os.path.join(root_dir, filename)
+
+
+def read_json_file(config_file):
+    try:
+        with open(config_file) as json_data_file:
+            return json.load(json_data_file)
+    except (FileNotFoundError, IOError) as e:
+        logger.error(f"Invalid path to the config file: {config_file}")
+        logger.error(e)
+        return None
+
+
+def map_modbus_slave_to_type(ext_conf):
+    """
+    The new dictionary, transformed_dict, uses the modbus_slave_id as the key and the type as the value.
+    RETURN: transformed_dict: {1: 'PM5561', 2: 'PM5111'}
+    """
+    try:
+        site_details_devices = ext_conf["site_details"]["proxy_ids"]
+    except (KeyError, TypeError):
+        return {}
+
+    transformed_dict = {}
+    for device, details in (site_details_devices or {}).items():
+        transformed_dict[details['modbus_slave_id']] = details['type']
+    logger.debug("site_details_devices: {}".format(transformed_dict))
+    return transformed_dict
+
+
+class DecodePoint:
+    """
+    A single point of a compiled register block.
+
+    Attributes:
+        register_address: register address of the point as per meter definition file
+        dbo_name: DBO name of the point
+        data_format: format of the point as per meter definition file, e.g. 'float32'
+        start_index: offset of the first byte of the point in the register data of the RTU response
+        end_index: offset after the last byte of the point in the register data of the RTU response
+        error: error reported instead of the value when the block doesn't hold all bytes of the point
+    """
+    __slots__ = ("register_address", "dbo_name", "data_format", "start_index", "end_index", "error")
+
+    def __init__(self, register_address, dbo_name, data_format, start_index, end_index, error=None):
+        self.register_address = register_address
+        self.dbo_name = dbo_name
+        self.data_format = data_format
+        self.start_index = start_index
+        self.end_index = end_index
+        self.error = error
+
+
+class DecodeSegment:
+    """
+    Contiguous run of non-overlapping points decoded with a single precompiled struct.
+    The gaps between the points are skipped with pad bytes.
+    """
+    __slots__ = ("points", "offset", "unpacker", "keys", "float_indexes", "get_floats")
+
+    def __init__(self, points):
+        self.points = points
+        self.offset = RTU_RESPONSE_HEADER_LENGTH + points[0].start_index
+        self.keys = tuple(point.register_address for point in points)
+
+        struct_format = ">"
+        cursor = points[0].start_index
+        for point in points:
+            if point.start_index > cursor:
+                struct_format += f"{point.start_index - cursor}x"
+            struct_format += STRUCT_FORMATS[point.data_format]
+            cursor = point.end_index
+        self.unpacker = struct.Struct(struct_format)
+
+        self.float_indexes = tuple(index for index, point in enumerate(points) if point.data_format == "float32")
+        # The indexes are listed twice, so that itemgetter returns a tuple even for a single float
+        self.get_floats = itemgetter(*self.float_indexes, *self.float_indexes) if self.float_indexes else None
+
+
+class DecodePlan:
+    """
+    Decode plan of a register block, i.e. the points found in (starting address, quantity) of a meter type.
+    """
+
+    def __init__(self, meter_type, starting_address, quantity_of_registers, points):
+        self.meter_type = meter_type
+        self.starting_address = starting_address
+        self.quantity_of_registers = quantity_of_registers
+        self.points = points
+
+        self.errors = {point.register_address: point.error for point in points if point.error is not None}
+        self.segments = []
+        segment_points = []
+        for point in points:
+            if point.error is not None:
+                continue
+            if segment_points and point.start_index < segment_points[-1].end_index:
+                self.segments.append(DecodeSegment(segment_points))
+                segment_points = []
+            segment_points.append(point)
+        if segment_points:
+            self.segments.append(DecodeSegment(segment_points))
+
+    def decode(self, rtu_response):
+        """
+        Decode all points of the register block from a validated RTU response.
+
+        The values are unpacked with one struct call per segment (normally one per plan) directly
+        from the response buffer, the register data is not copied.
+        Args:
+            rtu_response: RTU response (slave id, function code, byte count, register data, CRC)
+        Returns:
+            {register address: value}. NaN float32 values are reported as 'N/A(<hex>)'.
+        """
+        buffer = memoryview(rtu_response)
+        data = {}
+        for segment in self.segments:
+            values = segment.unpacker.unpack_from(buffer, segment.offset)
+            if segment.get_floats is not None:
+                floats_sum = sum(segment.get_floats(values))
+                # NaN propagates through the sum, only then the values are checked one by one
+                if floats_sum != floats_sum:
+                    values = list(values)
+                    for index in segment.float_indexes:
+                        if values[index] != values[index]:
+                            point = segment.points[index]
+                            start = RTU_RESPONSE_HEADER_LENGTH + point.start_index
+                            hex_value = buffer[start:start + point.end_index - point.start_index].hex()
+                            logger.debug("The value of register %s is Not Applicable because it is not a number",
+                                         point.register_address)
+                            values[index] = "N/A(" + hex_value + ")"
+            data.update(zip(segment.keys, values))
+        if self.errors:
+            data.update(self.errors)
+        return data
+
+    @classmethod
+    def compile(cls, meter_type, dbo_map, starting_address, quantity_of_registers):
+        """
+        Compile the decode plan of a register block.
+
+        The register addresses of the block are walked starting from the starting address of the RTU request.
+        Points at even register addresses are decoded from their own offset. Odd 'int16u' points
+        (e.g. firmware version 1637 requested from 1636) are decoded from the preceding register.
+        Args:
+            meter_type: Type of a power meter e.g. 'PM5111'
+            dbo_map: flattened meter definition file, register address (str) -> DBO properties
+            starting_address: starting address of the RTU request
+            quantity_of_registers: quantity of registers of the RTU request
+        Returns:
+            DecodePlan
+        """
+        response_length = quantity_of_registers * 2
+        points = []
+        for register_address in range(starting_address, starting_address + quantity_of_registers):
+            if str(register_address) in dbo_map and is_even(register_address):
+                dbo_properties = dbo_map[str(register_address)]
+                data_format = dbo_properties['format']
+                if data_format not in ("float32", "int64", "int32u"):
+                    continue
+                total_bytes = dbo_properties['number_of_registers'] * 2
+                start_index, end_index = get_register_offset(register_address, starting_address, total_bytes)
+                byte_length = len(range(response_length)[start_index:end_index])
+                error = None
+                if byte_length != total_bytes:
+                    error = "[ERROR]. Received ({}) bytes not equal to expected bytes length ({}) as per meter definition file".format(
+                        byte_length, total_bytes)
+                    logger.error(f"{meter_type} register {register_address}: {error}")
+                points.append(DecodePoint(register_address, dbo_properties.get('dbo_name'), data_format,
+                                          start_index, end_index, error))
+
+            elif str(register_address + 1) in dbo_map:
+                dbo_properties = dbo_map[str(register_address + 1)]
+                total_bytes = dbo_properties['number_of_registers'] * 2
+                if dbo_properties['format'] == "int16u" and total_bytes == 2:
+                    start_index, end_index = get_register_offset(register_address + 1, starting_address, total_bytes)
+                    points.append(DecodePoint(register_address + 1, dbo_properties.get('dbo_name'), "int16u",
+                                              start_index, end_index))
+
+        return cls(meter_type, starting_address, quantity_of_registers, points)
+
+
+class DecodePlanCache:
+    """
+    Cache of the slave to meter type map, the meter definition files and the compiled decode plans.
+
+    Args:
+        root_dir: top level repo directory, where 'resources' directory is located
+        check_interval: minimum time in seconds between two checks of the files modification time
+    """
+
+    def __init__(self, root_dir, check_interval=10.0):
+        self._check_interval = check_interval
+        self._next_check = 0.0
+
+        self._site_devices = None
+        self._dbo_maps = {}
+        self._plans = {}
+        self._mtimes = {}
+        # incremented each time the decode plans are invalidated, see FrameCache
+        self.generation = 0
+        self.set_root_dir(root_dir)
+
+    def set_root_dir(self, root_dir):
+        """
+        Read the configuration and the meter definition files from another directory, e.g. in a decode worker.
+        """
+        self._root_dir = root_dir
+        self._config_file = resolve_ext_config_path(root_dir, 'resources', "config-google-gateway.json")
+        self.invalidate()
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load(self, path):
+        self._mtimes[path] = self._get_mtime(path)
+        return read_json_file(path)
+
+    def _check_for_changes(self):
+        """
+        Drop everything loaded from the files whose modification time changed.
+        """
+        for path, mtime in list(self._mtimes.items()):
+            if self._get_mtime(path) != mtime:
+                logger.info(f"'{path}' changed, invalidating Modbus decode plans")
+                self.invalidate()
+                return
+
+    def invalidate(self):
+        self.generation += 1
+        self._site_devices = None
+        self._dbo_maps.clear()
+        self._plans.clear()
+        self._mtimes.clear()
+
+    def _get_dbo_map(self, meter_type):
+        dbo_map = self._dbo_maps.get(meter_type)
+        if dbo_map is None:
+            path = resolve_ext_config_path(self._root_dir, 'resources/modbus_dbo_maps', meter_type + '.json')
+            dbo_map = dict(get_nested_key_value_pairs(self._load(path)))
+            self._dbo_maps[meter_type] = dbo_map
+        return dbo_map
+
+    def get_meter_type(self, slave_id):
+        """
+        Returns:
+            Meter type of the slave as per config-google-gateway.json, None if the slave is not configured
+        """
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self._check_interval
+            self._check_for_changes()
+
+        if self._site_devices is None:
+            self._site_devices = map_modbus_slave_to_type(self._load(self._config_file))
+        return self._site_devices.get(slave_id)
+
+    def preload(self):
+        """
+        Load the slave to meter type map and the meter definition files of all configured meter types,
+        e.g. before a decode worker takes its first frame.
+        """
+        self.get_meter_type(None)
+        for meter_type in set(self._site_devices.values()):
+            self._get_dbo_map(meter_type)
+
+    def get_plan(self, meter_type, starting_address, quantity_of_registers):
+        """
+        Returns:
+            DecodePlan of the register block, compiled on the first use
+        """
+        key = (meter_type, starting_address, quantity_of_registers)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = DecodePlan.compile(meter_type, self._get_dbo_map(meter_type), starting_address,
+                                      quantity_of_registers)
+            self._plans[key] = plan
+            logger.debug(f"Compiled decode plan {key}: {len(plan.points)} points")
+        return plan
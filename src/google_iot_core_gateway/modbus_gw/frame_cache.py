@@ -0,0 +1,94 @@
+RTU_REQUEST_FIELD = b'"rtu_request"'
+# Hex digits of the slave ID, function code, starting address and quantity of registers of an FC3/FC4 request
+BLOCK_HEX_DIGITS = 12
+
+
+def get_block_hex(payload):
+    """
+    Get the register block of the message received from the internal broker, without parsing the JSON message.
+
+    Sample payload:
+    b'{"rtu_request": "01030bb70004...", "rtu_response": "..."}'
+
+    Returns:
+        Slave ID, function code, starting address and quantity of registers of the RTU request as hex digits,
+        e.g. b'01030bb70004', None if the message is malformed
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    start = payload.find(RTU_REQUEST_FIELD)
+    if start < 0:
+        return None
+    start = payload.find(b'"', start + len(RTU_REQUEST_FIELD)) + 1
+    if not start:
+        return None
+    return payload[start:start + BLOCK_HEX_DIGITS]
+
+
+class FrameCache:
+    """
+    Last message of each register block, to skip the decoding of the frames that did not change.
+
+    Many register blocks, the system blocks and the slowly changing energy counters, are received byte-identical
+    poll after poll. A message identical to the last decoded message of its (slave_id, fc, starting address,
+    quantity of registers) register block decodes into the same values, only the liveness of the device and of
+    the points of the block is refreshed, see UDMIHandler.refresh_block. The raw messages are compared, so the
+    unchanged frames are neither parsed nor decoded.
+
+    Only the messages decoded without error are kept. They are dropped when the decode plans are invalidated,
+    i.e. when the meter definition files or the site configuration changed.
+
+    The cache is disabled until enable() is called.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+        # block hex digits -> (message, block key)
+        self._messages = {}
+        self._generation = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self._messages.clear()
+
+    def get_unchanged_block(self, payload, generation):
+        """
+        Args:
+            payload: message received from the internal broker
+            generation: generation of the decode plans, see DecodePlanCache.generation
+        Returns:
+            (slave_id, fc, starting address, quantity of registers) of the message if it is identical to the last
+            decoded message of its register block, None otherwise
+        """
+        if generation != self._generation:
+            self._messages.clear()
+            self._generation = generation
+
+        entry = self._messages.get(get_block_hex(payload))
+        if entry is not None and entry[0] == payload:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def store(self, payload, block_key):
+        """
+        Args:
+            payload: message decoded without error
+            block_key: (slave_id, fc, starting address, quantity of registers) of the message
+        """
+        self._messages[get_block_hex(payload)] = (payload, block_key)
+
+    def get_counters(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "blocks": len(self._messages),
+        }
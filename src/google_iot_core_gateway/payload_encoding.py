@@ -0,0 +1,143 @@
+import gzip
+import json
+import math
+import zlib
+import struct
+
+JSON = "json"
+ZLIB = "zlib"
+GZIP = "gzip"
+CBOR = "cbor"
+CBOR_ZLIB = "cbor+zlib"
+
+ENCODINGS = (JSON, ZLIB, GZIP, CBOR, CBOR_ZLIB)
+
+# zlib only looks back 32 KiB, the end of the preset dictionary is the most useful part
+MAX_ZLIB_DICTIONARY_SIZE = 32768
+
+FLOAT32 = struct.Struct(">f")
+FLOAT64 = struct.Struct(">d")
+
+
+def _encode_cbor_head(major_type, value):
+    major_type <<= 5
+    if value < 24:
+        return bytes((major_type | value,))
+    if value < 0x100:
+        return bytes((major_type | 24, value))
+    if value < 0x10000:
+        return bytes((major_type | 25,)) + value.to_bytes(2, "big")
+    if value < 0x100000000:
+        return bytes((major_type | 26,)) + value.to_bytes(4, "big")
+    return bytes((major_type | 27,)) + value.to_bytes(8, "big")
+
+
+def encode_cbor(value):
+    """
+    Encode the value as CBOR (RFC 8949).
+
+    Only the types of the UDMI payloads are supported: dict, list, str, int, float, bool and None.
+    Floats are encoded with 4 bytes when it doesn't lose precision, e.g. the float32 meter registers.
+    """
+    if value is None:
+        return b"\xf6"
+    if value is True:
+        return b"\xf5"
+    if value is False:
+        return b"\xf4"
+    if isinstance(value, int):
+        if value >= 0:
+            return _encode_cbor_head(0, value)
+        return _encode_cbor_head(1, -1 - value)
+    if isinstance(value, float):
+        try:
+            if math.isnan(value) or FLOAT32.unpack(FLOAT32.pack(value))[0] == value:
+                return b"\xfa" + FLOAT32.pack(value)
+        except OverflowError:
+            pass
+        return b"\xfb" + FLOAT64.pack(value)
+    if isinstance(value, str):
+        encoded = value.encode()
+        return _encode_cbor_head(3, len(encoded)) + encoded
+    if isinstance(value, dict):
+        return _encode_cbor_head(5, len(value)) + b"".join(
+            encode_cbor(key) + encode_cbor(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return _encode_cbor_head(4, len(value)) + b"".join(encode_cbor(item) for item in value)
+    raise TypeError(f"Type {type(value).__name__} can't be encoded as CBOR")
+
+
+def build_json_zlib_dictionary(point_names):
+    """
+    Preset zlib dictionary of the JSON UDMI payloads: the payload skeleton and the point names.
+    The backend decompresses the payloads with the same dictionary, built from the same sorted point names.
+    """
+    fragments = ['{"version": 1, "timestamp": "', '"partial_update": true', '", "points": {']
+    fragments.extend(f'"{name}": {{"present_value": ' for name in sorted(point_names))
+    return "".join(fragments).encode()[-MAX_ZLIB_DICTIONARY_SIZE:]
+
+
+def build_cbor_zlib_dictionary(point_names):
+    """
+    Preset zlib dictionary of the CBOR UDMI payloads, see build_json_zlib_dictionary.
+    """
+    fragments = [encode_cbor("version"), encode_cbor("timestamp"), encode_cbor("partial_update"),
+                 encode_cbor("points")]
+    fragments.extend(encode_cbor(name) + b"\xa1" + encode_cbor("present_value") for name in sorted(point_names))
+    return b"".join(fragments)[-MAX_ZLIB_DICTIONARY_SIZE:]
+
+
+class PayloadEncoder:
+    """
+    Encoding of the payloads before they are published, selected per topic.
+
+        json      - the payload as it is
+        zlib      - JSON compressed by zlib with a preset dictionary of the point names of the site
+        gzip      - JSON compressed by gzip, for backends without the preset dictionary
+        cbor      - CBOR, binary encoding of the JSON data model
+        cbor+zlib - CBOR compressed by zlib with a preset dictionary of the point names of the site
+
+    MQTT 3.1.1 has no content type, the backend has to know the encoding configured for the topic.
+
+    Args:
+        logger: logger
+        encodings: {topic: encoding}, the topics not listed are sent as JSON
+        point_names: DBO names of the points of the site, used for the preset dictionaries
+        compression_level: zlib/gzip compression level
+    """
+
+    def __init__(self, logger, encodings, point_names, compression_level=9):
+        for topic, encoding in encodings.items():
+            if encoding not in ENCODINGS:
+                raise ValueError(f"Unknown encoding '{encoding}' of topic '{topic}'. Expected one of {ENCODINGS}")
+
+        self.logger = logger
+        self.encodings = encodings
+        self.compression_level = compression_level
+        self.json_zlib_dictionary = build_json_zlib_dictionary(point_names)
+        self.cbor_zlib_dictionary = build_cbor_zlib_dictionary(point_names)
+
+    def _compress(self, data, dictionary):
+        compressor = zlib.compressobj(self.compression_level, zdict=dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def encode(self, topic, payload):
+        """
+        Args:
+            topic: topic of the payload, e.g. 'events/pointset'
+            payload: JSON payload
+        Returns:
+            Encoded payload, str for JSON, bytes otherwise
+        """
+        encoding = self.encodings.get(topic, JSON)
+        if encoding == JSON:
+            return payload
+        if encoding == ZLIB:
+            return self._compress(payload.encode(), self.json_zlib_dictionary)
+        if encoding == GZIP:
+            return gzip.compress(payload.encode(), self.compression_level, mtime=0)
+
+        encoded = encode_cbor(json.loads(payload))
+        if encoding == CBOR_ZLIB:
+            return self._compress(encoded, self.cbor_zlib_dictionary)
+        return encoded
@@ -0,0 +1,217 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+import paho.mqtt.client as mqtt
+
+from google_iot_core_gateway.utils.histogram import Histogram
+
+
+class PublishPipeline:
+    """
+    Bounded pipeline of the publishes to the Google Cloud.
+
+    The payloads are queued per (device_id, topic): a payload that is not sent yet is superseded by a newer
+    payload of the same device and topic, so the queue never holds more than one payload per device and topic.
+    The payloads submitted with supersede=False, the partial updates and the replayed payloads, are all kept.
+    A superseding payload is moved behind them, so that it is not sent before older payloads of its topic.
+    At most max_inflight messages are sent and wait for their PUBACK, the next queued payloads are sent as the
+    PUBACKs come in. While the client is disconnected nothing is handed to paho, whose own queue is unbounded.
+
+    paho calls on_publish while holding its message lock, and client.publish() takes the same lock. So the
+    acknowledgements are only recorded by on_publish and processed by whichever thread pumps the pipeline,
+    on_publish never waits for the pipeline lock.
+
+    Args:
+        logger: logger
+        publish: function(device_id, payload, topic, qos) sending a message, returns paho MQTTMessageInfo
+        is_connected: function returning True if messages can be sent
+        max_inflight: maximum number of messages waiting for PUBACK
+        max_queued: maximum number of queued payloads, the oldest one is dropped when the queue is full
+        ack_timeout: time in seconds after which a message waiting for PUBACK no longer takes up the window
+    """
+
+    def __init__(self, logger, publish, is_connected, max_inflight=20, max_queued=1000, ack_timeout=30):
+        self.logger = logger
+        self._publish = publish
+        self._is_connected = is_connected
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.ack_timeout = ack_timeout
+
+        self._lock = threading.Lock()
+        # (device_id, topic) or (device_id, topic, sequence) -> (payload, qos, submit time)
+        self._queue = OrderedDict()
+        self._sequence = 0
+        # (device_id, topic) -> number of queued payloads submitted with supersede=False
+        self._unsuperseded = {}
+        # mid -> (submit time, send time)
+        self._inflight = {}
+        # (mid, ack time) recorded by on_publish
+        self._acks = deque()
+        self._disconnected = False
+
+        # Time from submit to PUBACK, and from sending to PUBACK
+        self.latency = Histogram()
+        self.ack_time = Histogram()
+
+        self.submitted = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.sent = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.expired = 0
+
+    def submit(self, device_id, payload, topic="state", qos=1, supersede=True):
+        """
+        Queue the payload and send as much of the queue as the window allows.
+        Args:
+            supersede: if False the payload is neither superseded by nor supersedes the payloads of the
+                       same device and topic, e.g. for the replay of the stored payloads
+        """
+        with self._lock:
+            if supersede:
+                key = (device_id, topic)
+            else:
+                self._sequence += 1
+                key = (device_id, topic, self._sequence)
+                self._unsuperseded[device_id, topic] = self._unsuperseded.get((device_id, topic), 0) + 1
+
+            self.submitted += 1
+            if key in self._queue:
+                # keep the position of the superseded payload in the queue, unless it is ahead of payloads
+                # of the same device and topic which are not superseded
+                self.superseded += 1
+                self._queue[key] = (payload, qos, time.monotonic())
+                if (device_id, topic) in self._unsuperseded:
+                    self._queue.move_to_end(key)
+            else:
+                if len(self._queue) >= self.max_queued:
+                    self._dequeue()
+                    self.dropped += 1
+                self._queue[key] = (payload, qos, time.monotonic())
+
+        self.pump()
+
+    def on_publish(self, mid):
+        """
+        Record the acknowledgement of the message, to be called from the paho on_publish callback.
+        """
+        self._acks.append((mid, time.monotonic()))
+        self.pump(blocking=False)
+
+    def on_disconnect(self):
+        """
+        The messages in flight are no longer waited for, to be called from the paho on_disconnect callback.
+        """
+        self._disconnected = True
+
+    def pump(self, blocking=True):
+        """
+        Process the acknowledgements and send queued payloads while there is room in the window.
+        Args:
+            blocking: if False nothing is done when another thread is pumping the pipeline
+        """
+        while True:
+            if not self._lock.acquire(blocking):
+                return
+            try:
+                self._process_acks()
+                self._send()
+                # acknowledgements of messages sent just now
+                self._process_acks()
+            finally:
+                self._lock.release()
+
+            # acknowledgements recorded while the lock was held by another thread
+            if not self._acks:
+                return
+            blocking = False
+
+    def _process_acks(self):
+        now = time.monotonic()
+        if self._disconnected:
+            self._disconnected = False
+            if self._inflight:
+                self.logger.debug(f"{len(self._inflight)} publishes not acknowledged before the disconnection")
+                self.expired += len(self._inflight)
+                self._inflight.clear()
+
+        while self._acks:
+            mid, acked_at = self._acks.popleft()
+            # PUBACKs of the attach messages are not tracked here
+            times = self._inflight.pop(mid, None)
+            if times is None:
+                continue
+            submitted_at, sent_at = times
+            self.acknowledged += 1
+            self.latency.record(acked_at - submitted_at)
+            self.ack_time.record(acked_at - sent_at)
+
+        if len(self._inflight) >= self.max_inflight:
+            expired = [mid for mid, (_, sent_at) in self._inflight.items() if now - sent_at > self.ack_timeout]
+            for mid in expired:
+                del self._inflight[mid]
+            if expired:
+                self.expired += len(expired)
+                self.logger.warning(f"{len(expired)} publishes not acknowledged within {self.ack_timeout}s")
+
+    def _send(self):
+        while self._queue and len(self._inflight) < self.max_inflight and self._is_connected():
+            device_id, topic, payload, qos, submitted_at = self._dequeue()
+
+            message_info = self._publish(device_id, payload, topic, qos)
+            # paho keeps a QoS 1 message published while disconnected and sends it once the client reconnects
+            kept_by_paho = message_info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0
+            if message_info.rc != mqtt.MQTT_ERR_SUCCESS and not kept_by_paho:
+                self.failed += 1
+                self.logger.error(f"Publishing to '{topic}' of device '{device_id}' failed: "
+                                  f"{mqtt.error_string(message_info.rc)}")
+                continue
+
+            self.sent += 1
+            if qos > 0:
+                self._inflight[message_info.mid] = (submitted_at, time.monotonic())
+
+    def _dequeue(self):
+        """
+        Returns:
+            (device_id, topic, payload, qos, submit time) of the oldest queued payload, removed from the queue
+        """
+        (device_id, topic, *sequence), (payload, qos, submitted_at) = self._queue.popitem(last=False)
+        if sequence:
+            count = self._unsuperseded.pop((device_id, topic)) - 1
+            if count:
+                self._unsuperseded[device_id, topic] = count
+        return device_id, topic, payload, qos, submitted_at
+
+    def qsize(self):
+        return len(self._queue)
+
+    def get_counters(self):
+        """
+        Returns:
+            Number of publishes per outcome since the start, and the current queue and window occupancy
+        """
+        return {
+            "submitted": self.submitted,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "sent": self.sent,
+            "acknowledged": self.acknowledged,
+            "failed": self.failed,
+            "expired": self.expired,
+            "queued": len(self._queue),
+            "in_flight": len(self._inflight),
+        }
+
+    def get_histograms(self):
+        """
+        Returns:
+            Latency (submit to PUBACK) and ack time (send to PUBACK) histograms, in seconds
+        """
+        return {
+            "latency": self.latency.as_dict(),
+            "ack_time": self.ack_time.as_dict(),
+        }
@@ -0,0 +1,340 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+
+# Record header: payload length, CRC32 of the payload, time.time() when the record was appended
+RECORD_HEADER = struct.Struct(">IId")
+# Read position: segment number, offset in the segment
+CURSOR = struct.Struct(">QI")
+
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE_NAME = "cursor"
+
+MEGABYTE = 1024 * 1024
+
+
+class SegmentLog:
+    """
+    Append-only log of records in memory-mapped segment files.
+
+    Each segment is a file of segment_size bytes, preallocated with zeros, the records are written one after
+    the other with a RECORD_HEADER. A zero length marks the end of the written records, a record whose CRC
+    doesn't match was torn by a power loss, the records are read up to it. The read position is saved in the
+    cursor file, a segment is deleted once the read position after all its records is saved, so the records
+    read but not handed over yet are read again after a crash.
+
+    The oldest segments are deleted when the segments take up more than max_size bytes, and when they were last
+    written more than retention seconds ago.
+
+    Args:
+        logger: logger
+        directory: directory of the segment files, created if it doesn't exist
+        segment_size: size of a segment file in bytes
+        max_size: maximum size of all the segment files in bytes
+        retention: time in seconds after which the records are discarded
+    """
+
+    def __init__(self, logger, directory, segment_size=4 * MEGABYTE, max_size=256 * MEGABYTE, retention=72 * 3600):
+        self.logger = logger
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(max_size // segment_size, 2)
+        self.retention = retention
+
+        self.dropped_segments = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                if name.endswith(SEGMENT_SUFFIX))
+
+        self._write_file = None
+        self._write_map = None
+        self._write_segment = None
+        self._write_offset = 0
+        if self._segments:
+            self._open_write_segment(self._segments[-1])
+            self._write_offset = self._read_records(self._write_map, 0, self.segment_size)[1]
+        else:
+            self._segments.append(0)
+            self._open_write_segment(0)
+
+        self._read_map = None
+        self._read_map_segment = None
+        self._read_segment, self._read_offset = self._load_cursor()
+        self._delete_read_segments()
+        self.enforce_limits()
+
+    def _get_segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _open_write_segment(self, segment):
+        path = self._get_segment_path(segment)
+        self._write_file = open(path, "a+b")
+        if os.path.getsize(path) < self.segment_size:
+            self._write_file.truncate(self.segment_size)
+        self._write_map = mmap.mmap(self._write_file.fileno(), self.segment_size)
+        self._write_segment = segment
+        self._write_offset = 0
+
+    def _close_write_segment(self):
+        self._write_map.flush()
+        self._write_map.close()
+        self._write_file.close()
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE_NAME), "rb") as cursor_file:
+                segment, offset = CURSOR.unpack(cursor_file.read(CURSOR.size))
+        except (FileNotFoundError, struct.error):
+            return self._segments[0], 0
+
+        if segment not in self._segments:
+            return self._segments[0], 0
+        return segment, offset
+
+    def save_cursor(self):
+        """
+        Persist the read position, the file is replaced atomically.
+        """
+        path = os.path.join(self.directory, CURSOR_FILE_NAME)
+        with open(path + ".tmp", "wb") as cursor_file:
+            cursor_file.write(CURSOR.pack(self._read_segment, self._read_offset))
+        os.replace(path + ".tmp", path)
+        self._delete_read_segments()
+
+    def _delete_read_segments(self):
+        """
+        Delete the segments before the saved read position, all their records were read.
+        """
+        while self._segments[0] < self._read_segment:
+            self._delete_segment(self._segments[0])
+
+    @staticmethod
+    def _read_records(buffer, offset, end, max_records=None):
+        """
+        Returns:
+            [(appended_at, payload)] of the valid records from the offset, offset after the last valid record
+        """
+        records = []
+        while max_records is None or len(records) < max_records:
+            if offset + RECORD_HEADER.size > end:
+                break
+            length, crc, appended_at = RECORD_HEADER.unpack_from(buffer, offset)
+            record_end = offset + RECORD_HEADER.size + length
+            if length == 0 or record_end > end:
+                break
+            payload = bytes(buffer[offset + RECORD_HEADER.size:record_end])
+            if zlib.crc32(payload) != crc:
+                break
+            records.append((appended_at, payload))
+            offset = record_end
+        return records, offset
+
+    def append(self, payload):
+        """
+        Args:
+            payload: bytes of the record
+        """
+        record_size = RECORD_HEADER.size + len(payload)
+        if record_size > self.segment_size:
+            raise ValueError(f"Record of {record_size} bytes doesn't fit in a segment of {self.segment_size} bytes")
+
+        if self._write_offset + record_size > self.segment_size:
+            self._roll()
+
+        offset = self._write_offset
+        # the payload is written before the header, a torn record is recognised by its CRC
+        self._write_map[offset + RECORD_HEADER.size:offset + record_size] = payload
+        RECORD_HEADER.pack_into(self._write_map, offset, len(payload), zlib.crc32(payload), time.time())
+        self._write_offset += record_size
+
+    def flush(self):
+        self._write_map.flush()
+
+    def _roll(self):
+        self._close_write_segment()
+        segment = self._write_segment + 1
+        self._segments.append(segment)
+        self._open_write_segment(segment)
+        self.enforce_limits()
+
+    def _delete_segment(self, segment):
+        if self._read_map_segment == segment:
+            self._read_map.close()
+            self._read_map = None
+            self._read_map_segment = None
+        try:
+            os.remove(self._get_segment_path(segment))
+        except FileNotFoundError:
+            pass
+        self._segments.remove(segment)
+
+        if self._read_segment == segment:
+            self._read_segment = self._segments[0]
+            self._read_offset = 0
+
+    def enforce_limits(self):
+        """
+        Delete the oldest segments beyond the size cap and the retention, the segment being written is kept.
+        """
+        oldest_allowed = time.time() - self.retention
+        while len(self._segments) > 1:
+            segment = self._segments[0]
+            if len(self._segments) <= self.max_segments and \
+                    os.path.getmtime(self._get_segment_path(segment)) >= oldest_allowed:
+                break
+            self.logger.warning(f"Store-and-forward segment {segment} dropped, size cap or retention reached")
+            self._delete_segment(segment)
+            self.dropped_segments += 1
+
+    def _get_read_map(self):
+        if self._read_segment == self._write_segment:
+            return self._write_map
+        if self._read_map_segment != self._read_segment:
+            if self._read_map is not None:
+                self._read_map.close()
+            with open(self._get_segment_path(self._read_segment), "rb") as segment_file:
+                self._read_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._read_map_segment = self._read_segment
+        return self._read_map
+
+    def read(self, max_records):
+        """
+        Read the next records and move the read position after them, the read position is only persisted and
+        the segments read are only deleted by save_cursor.
+        Args:
+            max_records: maximum number of records read
+        Returns:
+            [(appended_at, payload)]
+        """
+        records = []
+        while len(records) < max_records:
+            is_write_segment = self._read_segment == self._write_segment
+            end = self._write_offset if is_write_segment else self.segment_size
+            segment_records, self._read_offset = self._read_records(self._get_read_map(), self._read_offset, end,
+                                                                    max_records - len(records))
+            records.extend(segment_records)
+            if is_write_segment or len(records) == max_records:
+                break
+            # all records of the segment were read, it is deleted once the read position is saved
+            self._read_segment = self._segments[self._segments.index(self._read_segment) + 1]
+            self._read_offset = 0
+        return records
+
+    def is_empty(self):
+        return self._read_segment == self._write_segment and self._read_offset >= self._write_offset
+
+    def get_size(self):
+        """
+        Returns:
+            Size of the segment files in bytes
+        """
+        return len(self._segments) * self.segment_size
+
+    def close(self):
+        self.save_cursor()
+        if self._read_map is not None:
+            self._read_map.close()
+        self._close_write_segment()
+
+
+class StoreAndForward:
+    """
+    Store-and-forward of the 'events/pointset' payloads built while the Google Cloud is not reachable.
+
+    The payloads are spooled on disk in a SegmentLog, and replayed once the connection is back at replay_rate
+    payloads per second. The payloads are sent as they were built, with their original timestamp. The read
+    position is saved once the replayed payloads are handed to the publisher.
+
+    Args:
+        logger: logger
+        directory: directory of the spool
+        segment_size: size of a segment file in bytes
+        max_size: maximum size of the spool in bytes
+        retention: time in seconds after which spooled payloads are discarded
+        replay_rate: number of payloads replayed per second
+    """
+
+    def __init__(self, logger, directory, segment_size=4 * MEGABYTE, max_size=256 * MEGABYTE, retention=72 * 3600,
+                 replay_rate=10):
+        self.logger = logger
+        self.retention = retention
+        self.replay_rate = replay_rate
+        self.log = SegmentLog(logger, directory, segment_size, max_size, retention)
+
+        self._replay_allowance = 0.0
+        self._last_replay = time.monotonic()
+
+        self.stored = 0
+        self.replayed = 0
+        self.expired = 0
+
+    def store(self, device_id, payload):
+        """
+        Spool the payload of the device, flush() makes the spooled payloads durable.
+        """
+        self.log.append(device_id.encode() + b"\0" + payload.encode())
+        self.stored += 1
+
+    def flush(self):
+        self.log.flush()
+
+    def has_backlog(self):
+        return not self.log.is_empty()
+
+    def replay(self, publish, max_records=None):
+        """
+        Replay the spooled payloads, as many as allowed by the replay rate since the last call.
+        Args:
+            publish: function(device_id, payload) sending the payload to the 'events/pointset' topic
+            max_records: maximum number of payloads replayed by this call, e.g. the room in the publish queue
+        Returns:
+            Number of replayed payloads
+        """
+        now = time.monotonic()
+        # bursts are limited to one second of the replay rate
+        self._replay_allowance = min(self._replay_allowance + (now - self._last_replay) * self.replay_rate,
+                                     self.replay_rate)
+        self._last_replay = now
+
+        count = int(self._replay_allowance)
+        if max_records is not None:
+            count = min(count, max_records)
+        if count <= 0:
+            return 0
+
+        oldest_allowed = time.time() - self.retention
+        records = self.log.read(count)
+        replayed = 0
+        for appended_at, record in records:
+            if appended_at < oldest_allowed:
+                self.expired += 1
+                continue
+            device_id, payload = record.split(b"\0", 1)
+            publish(device_id.decode(), payload.decode())
+            replayed += 1
+        self.log.save_cursor()
+
+        self._replay_allowance -= len(records)
+        self.replayed += replayed
+        if replayed and not self.has_backlog():
+            self.logger.info(f"Store-and-forward replay finished, {self.replayed} payloads replayed so far")
+        return replayed
+
+    def get_counters(self):
+        """
+        Returns:
+            Number of stored, replayed and expired payloads since the start, dropped segments and spool size
+        """
+        return {
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "expired": self.expired,
+            "dropped_segments": self.log.dropped_segments,
+            "size_bytes": self.log.get_size(),
+        }
+
+    def close(self):
+        self.log.close()
@@ -0,0 +1,121 @@
+import json
+
+
+class PointRecord:
+    """
+    Latest value and status of a single UDMI point.
+
+    The serialized JSON fragments of the point for the 'events/pointset' and the 'state' payloads are cached,
+    and encoded again only after the value or the status of the point changed.
+    """
+    __slots__ = ("name", "present_value", "message", "category", "timestamp", "level",
+                 "_key", "_value_fragment", "_status_fragment")
+
+    def __init__(self, name):
+        self.name = name
+        self.present_value = ""
+        self.message = ""
+        self.category = ""
+        self.timestamp = ""
+        self.level = ""
+
+        self._key = json.dumps(name)
+        self._value_fragment = None
+        self._status_fragment = None
+
+    def update(self, value, timestamp):
+        # 1 == 1.0 == True, but they are serialized differently
+        if value != self.present_value or type(value) is not type(self.present_value):
+            self.present_value = value
+            self._value_fragment = None
+        if timestamp != self.timestamp or self.message != "Updated":
+            self.message = "Updated"
+            self.category = ""
+            self.timestamp = timestamp
+            self.level = ""
+            self._status_fragment = None
+
+    def refresh(self, timestamp):
+        """
+        Refresh the status of the point, its value was received again unchanged.
+        """
+        if timestamp != self.timestamp or self.message != "Updated":
+            self.message = "Updated"
+            self.category = ""
+            self.timestamp = timestamp
+            self.level = ""
+            self._status_fragment = None
+
+    @property
+    def status(self):
+        return {
+            "message": self.message,
+            "category": self.category,
+            "timestamp": self.timestamp,
+            "level": self.level
+        }
+
+    @property
+    def value_fragment(self):
+        """
+        "<name>": {"present_value": <value>}
+        """
+        if self._value_fragment is None:
+            self._value_fragment = f'{self._key}: {{"present_value": {json.dumps(self.present_value)}}}'
+        return self._value_fragment
+
+    @property
+    def status_fragment(self):
+        """
+        "<name>": {"status": {"message": ..., "category": ..., "timestamp": ..., "level": ...}}
+        """
+        if self._status_fragment is None:
+            self._status_fragment = f'{self._key}: {{"status": {json.dumps(self.status)}}}'
+        return self._status_fragment
+
+
+class DevicePoints:
+    """
+    Points of a device, in the order of the UDMI Site Model metadata.
+
+    Each point has a fixed index, so the points can be addressed either by DBO name or by index.
+    The 'points' objects of the payloads are joined from the cached fragments of the points.
+
+    Args:
+        point_names: DBO names of the points
+    """
+
+    def __init__(self, point_names):
+        self.records = [PointRecord(name) for name in point_names]
+        self.index = {record.name: index for index, record in enumerate(self.records)}
+
+    def __getitem__(self, name):
+        return self.records[self.index[name]]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.records)
+
+    def items(self):
+        return ((record.name, record) for record in self.records)
+
+    def get_points_json(self, records=None):
+        """
+        Returns:
+            {"<name>": {"present_value": <value>}, ...} of the given records (all by default) as JSON
+        """
+        if records is None:
+            records = self.records
+        return "{" + ", ".join([record.value_fragment for record in records]) + "}"
+
+    def get_statuses_json(self):
+        """
+        Returns:
+            {"<name>": {"status": {...}}, ...} of all points as JSON
+        """
+        return "{" + ", ".join([record.status_fragment for record in self.records]) + "}"
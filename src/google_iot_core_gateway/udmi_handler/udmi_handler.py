@@ -1,21 +1,72 @@
 import os
 import json
-import datetime
 
 from google_iot_core_gateway.udmi_handler.modbus_to_dbo import ModbusToDBO
+from google_iot_core_gateway.udmi_handler.point_store import DevicePoints
+from google_iot_core_gateway.utils.timestamp_cache import timestamp_cache
+
+POINT_TIMESTAMP_UPDATE = "update"
+POINT_TIMESTAMP_RECEIVE = "receive"
 
 
 class UDMIHandler:
-    def __init__(self, logger, resources_path, udmi_site_model_path):
+    def __init__(self, logger, resources_path, udmi_site_model_path, point_timestamp=POINT_TIMESTAMP_UPDATE):
         self.logger = logger
         self.udmi_site_model_path = udmi_site_model_path
         self.devices = {}
 
+        # 'update': points are stamped with the time they are updated,
+        # 'receive': with the time the message was received from the internal broker, when it is known
+        self.point_timestamp = point_timestamp
+
         self._modbus_dbo_map = ModbusToDBO(logger, resources_path).map
+        self._deadbands = self._get_deadbands(self._modbus_dbo_map)
+
+        # Change-of-value publishing: last published point values, state and number of publish intervals per device
+        self._published_values = {}
+        self._published_state = {}
+        self._publish_intervals = {}
+
+        # Routing index of each device: register -> point or system block setter, see _get_routes
+        self._routes = {}
+        # Points of each register block applied with its block key, see refresh_block
+        self._block_points = {}
+
+    @staticmethod
+    def _get_deadbands(modbus_dbo_map):
+        """
+        Collect the change-of-value deadbands of the points from the Modbus-To-DBO maps.
+        A point can define an absolute 'deadband' and/or a 'deadband_percent' next to its 'units', e.g.
+            "3028": {"dbo_name": "line1_neutral_voltage_sensor", ..., "units": "Volts", "deadband_percent": 0.5}
+        Returns:
+            {device_type: {dbo_name: (deadband, deadband_percent)}}
+        """
+        deadbands = {}
+        for device_type, dbo_map in modbus_dbo_map.items():
+            deadbands[device_type] = {}
+            for registry_number, dbo_properties in dbo_map.items():
+                if registry_number == "system":
+                    continue
+                deadband = dbo_properties.get("deadband")
+                deadband_percent = dbo_properties.get("deadband_percent")
+                if deadband is not None or deadband_percent is not None:
+                    deadbands[device_type][dbo_properties["dbo_name"]] = (deadband, deadband_percent)
+        return deadbands
 
     @staticmethod
     def get_timestamp():
-        return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        return timestamp_cache.now()
+
+    def get_point_timestamp(self, received_at=None):
+        """
+        Args:
+            received_at: time.time() when the message with the point value was received, if known
+        Returns:
+            Timestamp for the status of the updated points
+        """
+        if received_at is not None and self.point_timestamp == POINT_TIMESTAMP_RECEIVE:
+            return timestamp_cache.format(received_at)
+        return self.get_timestamp()
 
     def add_device_to_dict(self, modbus_slave_id, device_id, device_type):
         """
@@ -36,19 +87,14 @@ class UDMIHandler:
                     "last_config": "",
                     "operational": ""
                 }
-                "points": {
-                    "phase_voltage_sensor_1": {
-                        "present_value": "",
-                        "status": {
-                            "message": "",
-                            "category": "",
-                            "timestamp": "",
-                            "level": ""
-                        }
-                    }
-                }
+                "points": DevicePoints(["phase_voltage_sensor_1", ...]),
+                "rejected_frames": 0
             }
         }
+
+        Each point of DevicePoints is a PointRecord with the present_value and the status
+        (message, category, timestamp, level) of the point, in the order of the UDMI Site Model metadata.
+        rejected_frames counts the frames of the device rejected because of a CRC error.
         """
         metadata_file_path = os.path.join(self.udmi_site_model_path, "devices", device_id, "metadata.json")
         if not os.path.exists(metadata_file_path):
@@ -74,109 +120,223 @@ class UDMIHandler:
         with open(metadata_file_path, "r") as metadata_file:
             metadata = json.load(metadata_file)
 
-        self.devices[modbus_slave_id]["points"] = metadata["pointset"]["points"]
-
-        for point, point_details in self.devices[modbus_slave_id]["points"].items():
-            self.devices[modbus_slave_id]["points"][point]["present_value"] = ""
-            self.devices[modbus_slave_id]["points"][point]["status"] = {}
-            self.devices[modbus_slave_id]["points"][point]["status"]["message"] = ""
-            self.devices[modbus_slave_id]["points"][point]["status"]["category"] = ""
-            self.devices[modbus_slave_id]["points"][point]["status"]["timestamp"] = ""
-            self.devices[modbus_slave_id]["points"][point]["status"]["level"] = ""
+        self.devices[modbus_slave_id]["points"] = DevicePoints(metadata["pointset"]["points"])
+        self.devices[modbus_slave_id]["rejected_frames"] = 0
+        self._routes[modbus_slave_id] = self._get_routes(modbus_slave_id, device_type)
 
         return True
 
-    def update_device_properties(self, modbus_slave_id, device_type, registry_number, value):
+    def _get_routes(self, modbus_slave_id, device_type):
         """
-        As the messages are coming in device properties inside the devices dictionary are updated with the latest data.
-        Registries '130', '1637', '70' and '50' are system information registries
+        Build the routing index of the device, built once when the device is added.
+        Registers of the Modbus-To-DBO map of the device type are routed either to the point of the device
+        or to a setter of the system block. Registers of points which are not part of the UDMI Site Model
+        of the device are not routed, their values are rejected.
         Args:
             modbus_slave_id: Modbus Slave ID which is user to identify the device in the dictionary
             device_type: Type of a power meter
-            registry_number: registry number that corresponds with DBO name for the point
-            value: Value of the registry
+        Returns:
+            {register: function(value, timestamp)}
         """
-        registry_number = str(registry_number)
-        modbus_slave_id = str(modbus_slave_id)
-
         if device_type not in self._modbus_dbo_map:
             self.logger.error(
                 f"Modbus-to-DBO map is not defined for the '{device_type}' device type. Please add the '{device_type}.json' file to the 'modbus_dbo_maps' directory")
-            return
+            return {}
 
-        if registry_number in self._modbus_dbo_map[device_type]:
-            self._update_device_points_present_value(modbus_slave_id, device_type, registry_number, value)
-        elif registry_number in self._modbus_dbo_map[device_type]["system"]:
-            self._update_system_info(modbus_slave_id, device_type, registry_number, value)
+        device = self.devices[modbus_slave_id]
+        routes = {}
+        for registry_number, dbo_properties in self._modbus_dbo_map[device_type].get("system", {}).items():
+            routes[int(registry_number)] = self._get_system_setter(device["system"], dbo_properties["dbo_name"])
+
+        not_in_site_model = []
+        for registry_number, dbo_properties in self._modbus_dbo_map[device_type].items():
+            if registry_number == "system":
+                continue
+            point = dbo_properties["dbo_name"]
+            if point in device["points"]:
+                # points take precedence over the system registers
+                routes[int(registry_number)] = device["points"][point].update
+            else:
+                not_in_site_model.append(point)
+
+        if not_in_site_model:
+            self.logger.warning(
+                f"Points {not_in_site_model} of the '{device_type}' Modbus-to-DBO map are not part of the UDMI Site Model of the '{device['device_id']}' device, their values are not reported")
+        return routes
+
+    @staticmethod
+    def _get_system_setter(system, point):
+        # TODO: Ask Adam about UDMI system points misalignment with DBO names. And which should be used.
+        # Not all DBO names are consistent with UDMI. Possible but?
+        # Change it to below?
+        # if "version" in point:
+        if point == "version":
+            firmware = system["firmware"]
 
-    def _update_system_info(self, modbus_slave_id, device_type, registry_number, value):
+            def set_firmware_version(value, timestamp):
+                firmware["version"] = value
+            return set_firmware_version
+
+        def set_system_info(value, timestamp):
+            system[point] = value
+        return set_system_info
+
+    def apply_frame(self, modbus_slave_id, data, timestamp=None, block_key=None):
         """
         As the messages are coming in device properties inside the devices dictionary are updated with the latest data.
+        Values of all the registers of a decoded frame are applied through the routing index of the device.
         Args:
             modbus_slave_id: Modbus Slave ID which is user to identify the device in the dictionary
-            registry_number: registry number that corresponds with DBO name for the point
-            value: Value of the registry
+            data: {register: value} of the decoded frame
+            timestamp: Timestamp for the point status, see get_point_timestamp. Current time if not given
+            block_key: (slave_id, fc, starting address, quantity of registers) of the frame, the points of the
+                       register block are then kept for refresh_block
+        Returns:
+            Number of the rejected values, of registers that are not routed to a point or the system block
         """
-        modbus_slave_id = str(modbus_slave_id)
+        routes = self._routes[str(modbus_slave_id)]
+        timestamp = timestamp or self.get_timestamp()
+        if block_key is not None and block_key not in self._block_points:
+            self._block_points[block_key] = self._get_block_points(str(modbus_slave_id), data)
 
-        point = self._modbus_dbo_map[device_type]["system"][registry_number]["dbo_name"]
-        try:
-            # TODO: Ask Adam about UDMI system points misalignment with DBO names. And which should be used.
-            # Not all DBO names are consistent with UDMI. Possible but?
-            # Change it to below?
-            # if "version" in point:
-            if point == "version":
-                self.devices[modbus_slave_id]["system"]["firmware"]["version"] = value
+        rejected = 0
+        for registry_number, value in data.items():
+            route = routes.get(registry_number)
+            if route is None:
+                rejected += 1
             else:
-                self.devices[modbus_slave_id]["system"][point] = value
-        except Exception as ex:
-            self.logger.debug(f"Exception caught: {ex}")
-            self.logger.error(
-                f"Error while updating point '{point}' value for the '{self.devices[modbus_slave_id]['device_id']}' device")
+                route(value, timestamp)
+        return rejected
+
+    def _get_block_points(self, modbus_slave_id, registers):
+        """
+        Returns:
+            [PointRecord] of the device the registers are routed to, the system block registers left out
+        """
+        device = self.devices[modbus_slave_id]
+        dbo_map = self._modbus_dbo_map.get(device["device_type"], {})
+        points = []
+        for registry_number in registers:
+            dbo_properties = dbo_map.get(str(registry_number))
+            if dbo_properties is not None and dbo_properties["dbo_name"] in device["points"]:
+                points.append(device["points"][dbo_properties["dbo_name"]])
+        return points
+
+    def refresh_block(self, block_key, timestamp=None):
+        """
+        A frame identical to the last frame of its register block was received: the values did not change,
+        only the status timestamp of the points of the block is refreshed.
+        Args:
+            block_key: (slave_id, fc, starting address, quantity of registers) of the frame
+            timestamp: Timestamp for the point status, see get_point_timestamp. Current time if not given
+        Returns:
+            False if no frame of the register block was applied with apply_frame yet
+        """
+        points = self._block_points.get(block_key)
+        if points is None:
+            return False
+
+        timestamp = timestamp or self.get_timestamp()
+        for point in points:
+            point.refresh(timestamp)
+        return True
 
-    def _update_device_points_present_value(self, modbus_slave_id, device_type, registry_number, value):
+    def update_device_properties(self, modbus_slave_id, device_type, registry_number, value, timestamp=None):
         """
         As the messages are coming in device properties inside the devices dictionary are updated with the latest data.
+        Registries '130', '1637', '70' and '50' are system information registries
         Args:
             modbus_slave_id: Modbus Slave ID which is user to identify the device in the dictionary
+            device_type: Type of a power meter, the routing index of the device is built for its type
             registry_number: registry number that corresponds with DBO name for the point
             value: Value of the registry
+            timestamp: Timestamp for the point status, see get_point_timestamp. Current time if not given
+        """
+        self.apply_frame(modbus_slave_id, {int(registry_number): value}, timestamp)
+
+    def _has_point_changed(self, device_type, point, value, published_value):
+        """
+        Check whether the point value moved out of the deadband around the last published value.
+        Without a deadband any change of the value is reported.
+        """
+        if value == published_value:
+            return False
+
+        deadband, deadband_percent = self._deadbands.get(device_type, {}).get(point, (None, None))
+        if (deadband is None and deadband_percent is None) or isinstance(value, (str, bool)) \
+                or not isinstance(published_value, (int, float)) or isinstance(published_value, bool):
+            return True
+
+        # the larger of the two deadbands applies
+        threshold = max(deadband or 0, abs(published_value) * (deadband_percent or 0) / 100)
+        return abs(value - published_value) > threshold
+
+    def next_publish_interval(self, modbus_slave_id, keyframe_interval):
+        """
+        Count the publish interval of the device.
+        Args:
+            modbus_slave_id: Modbus Slave ID which is user to identify the device in the dictionary
+            keyframe_interval: every keyframe_interval-th publish interval sends the full payloads
+        Returns:
+            True if full payloads (keyframe) are sent in this interval
         """
         modbus_slave_id = str(modbus_slave_id)
 
-        point = self._modbus_dbo_map[device_type][registry_number]["dbo_name"]
-        try:
-            self.devices[modbus_slave_id]["points"][point]["present_value"] = value
-            self.devices[modbus_slave_id]["points"][point]["status"]["message"] = "Updated"
-            self.devices[modbus_slave_id]["points"][point]["status"]["category"] = ""
-            self.devices[modbus_slave_id]["points"][point]["status"]["timestamp"] = self.get_timestamp()
-            self.devices[modbus_slave_id]["points"][point]["status"]["level"] = ""
-        except Exception as ex:
-            self.logger.debug(f"Exception caught: {ex}")
-            self.logger.error(
-                f"Error while updating point '{point}' value for the '{self.devices[modbus_slave_id]['device_id']}' device")
+        interval = self._publish_intervals.get(modbus_slave_id, 0)
+        self._publish_intervals[modbus_slave_id] = interval + 1
+        return interval % max(keyframe_interval, 1) == 0
 
-    def get_event_point_payload(self, modbus_slave_id):
+    def get_event_point_payload(self, modbus_slave_id, changed_only=False):
         """
         Converts device dictionary data for particular device into the UDMI payload
         Args:
             modbus_slave_id: Modbus Slave ID which is user to identify the device in the dictionary
+            changed_only: only the points whose value changed by more than their deadband since they were
+                          last published are included, as UDMI partial update
         Returns:
-            Payload that will be send to event/pointset topic
+            Payload that will be send to event/pointset topic, None if changed_only and nothing changed
         """
         modbus_slave_id = str(modbus_slave_id)
+        device_type = self.devices[modbus_slave_id]["device_type"]
+        device_points = self.devices[modbus_slave_id]["points"]
+        published_values = self._published_values.setdefault(modbus_slave_id, {})
 
-        points = {}
-        for point, point_details in self.devices[modbus_slave_id]["points"].items():
-            points[point] = {}
-            points[point]["present_value"] = point_details["present_value"]
+        records = []
+        for point, record in device_points.items():
+            value = record.present_value
+            if changed_only and point in published_values and \
+                    not self._has_point_changed(device_type, point, value, published_values[point]):
+                continue
+            records.append(record)
+            published_values[point] = value
 
-        data = {
-            "version": 1,
-            "timestamp": self.get_timestamp(),
-            "points": points
-        }
-        return json.dumps(data)
+        if changed_only and not records:
+            return None
+
+        # The points are joined from the cached JSON fragments, only the updated points are serialized again
+        payload = f'{{"version": 1, "timestamp": {json.dumps(self.get_timestamp())}, ' \
+                  f'"points": {device_points.get_points_json(records)}'
+        if changed_only:
+            payload += ', "partial_update": true'
+        return payload + "}"
+
+    def has_state_changed(self, modbus_slave_id):
+        """
+        Check whether the system block or a point status (apart from its timestamp) changed since the last call.
+        Args:
+            modbus_slave_id: Modbus Slave ID which is user to identify the device in the dictionary
+        Returns:
+            True if the state payload needs to be published
+        """
+        modbus_slave_id = str(modbus_slave_id)
+
+        statuses = {point: (record.message, record.category, record.level)
+                    for point, record in self.devices[modbus_slave_id]["points"].items()}
+        state = json.dumps([self.devices[modbus_slave_id]["system"], statuses], sort_keys=True)
+        if self._published_state.get(modbus_slave_id) == state:
+            return False
+        self._published_state[modbus_slave_id] = state
+        return True
 
     def get_state_payload(self, modbus_slave_id):
         """
@@ -188,20 +348,9 @@ class UDMIHandler:
         """
         modbus_slave_id = str(modbus_slave_id)
 
-        points = {}
-        for point, point_details in self.devices[modbus_slave_id]["points"].items():
-            points[point] = {}
-            points[point]["status"] = point_details["status"]
-
-        data = {
-            "version": 1,
-            "timestamp": self.get_timestamp(),
-            "system": self.devices[modbus_slave_id]["system"],
-            "pointset": {
-                "points": points
-            }
-        }
-        return json.dumps(data)
+        return f'{{"version": 1, "timestamp": {json.dumps(self.get_timestamp())}, ' \
+               f'"system": {json.dumps(self.devices[modbus_slave_id]["system"])}, ' \
+               f'"pointset": {{"points": {self.devices[modbus_slave_id]["points"].get_statuses_json()}}}}}'
 
 # def json_to_udmi(self):
 #     pass
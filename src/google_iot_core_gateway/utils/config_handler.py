@@ -19,12 +19,51 @@ class ConfigHandler:
         self.internal_broker__private_key = None
         self.internal_broker__tls_insecure_set = False
         self.internal_broker__enable_tls = False
+        self.internal_broker__capture_file = None
 
         self.google_cloud__cloud_region = "europe-west1"
         self.google_cloud__project_id = "moxa01-iot-core"
         self.google_cloud__sample_rate_set = 1800
         self.google_cloud__mqtt_bridge_hostname = "mqtt.googleapis.com"
         self.google_cloud__mqtt_bridge_port = 443
+        self.google_cloud__connect_timeout = 10
+        self.google_cloud__attach_timeout = 10
+        self.google_cloud__max_inflight_attach = 10
+        self.google_cloud__jwt_rotation = "proactive"
+        self.google_cloud__jwt_lifetime = 20
+        self.google_cloud__jwt_refresh_lead_time = 60
+        self.google_cloud__publish_mode = "full"
+        self.google_cloud__keyframe_interval = 10
+        self.google_cloud__max_inflight_publishes = 20
+        self.google_cloud__max_queued_publishes = 1000
+        self.google_cloud__publish_ack_timeout = 30
+        self.google_cloud__payload_encoding = {}
+
+        self.processing__runtime = "threaded"
+        self.processing__queue_type = "ring-buffer"
+        self.processing__queue_size = 50
+        self.processing__overflow_policy = "drop-oldest"
+        self.processing__max_batch_size = 100
+        self.processing__batch_time_budget = 0.5
+        self.processing__point_timestamp = "update"
+        self.processing__decode_workers = 0
+        self.processing__deduplicate_frames = True
+        self.processing__verify_crc = True
+
+        self.store_and_forward__enabled = False
+        self.store_and_forward__directory = "/home/moxa/google_iot_core_spool"
+        self.store_and_forward__segment_size_mb = 4
+        self.store_and_forward__max_size_mb = 256
+        self.store_and_forward__retention_hours = 72
+        self.store_and_forward__replay_rate = 10
+
+        self.sharding__gateway_ids = []
+        self.sharding__failover_timeout = 120
+
+        self.metrics__enabled = False
+        self.metrics__http_host = "127.0.0.1"
+        self.metrics__http_port = 0
+        self.metrics__state_interval = 60
 
         self.site_details__name = "KGX-1"
         self.site_details__registry_id = "KGX-1"
@@ -125,6 +164,8 @@ class ConfigHandler:
 
             if ext_conf["internal_broker"]["enable_tls"]:
                 self.internal_broker__enable_tls = ext_conf["internal_broker"]["enable_tls"]
+            if ext_conf["internal_broker"].get("capture_file"):
+                self.internal_broker__capture_file = ext_conf["internal_broker"]["capture_file"]
 
             if ext_conf["google_cloud"]["project_id"]:
                 self.google_cloud__project_id = ext_conf["google_cloud"]["project_id"]
@@ -134,6 +175,86 @@ class ConfigHandler:
                 self.google_cloud__mqtt_bridge_hostname = ext_conf["google_cloud"]["mqtt_bridge_hostname"]
             if ext_conf["google_cloud"]["mqtt_bridge_port"]:
                 self.google_cloud__mqtt_bridge_port = ext_conf["google_cloud"]["mqtt_bridge_port"]
+            if ext_conf["google_cloud"].get("connect_timeout"):
+                self.google_cloud__connect_timeout = ext_conf["google_cloud"]["connect_timeout"]
+            if ext_conf["google_cloud"].get("attach_timeout"):
+                self.google_cloud__attach_timeout = ext_conf["google_cloud"]["attach_timeout"]
+            if ext_conf["google_cloud"].get("max_inflight_attach"):
+                self.google_cloud__max_inflight_attach = ext_conf["google_cloud"]["max_inflight_attach"]
+            if ext_conf["google_cloud"].get("jwt_rotation"):
+                self.google_cloud__jwt_rotation = ext_conf["google_cloud"]["jwt_rotation"]
+            if ext_conf["google_cloud"].get("jwt_lifetime"):
+                self.google_cloud__jwt_lifetime = ext_conf["google_cloud"]["jwt_lifetime"]
+            if ext_conf["google_cloud"].get("jwt_refresh_lead_time"):
+                self.google_cloud__jwt_refresh_lead_time = ext_conf["google_cloud"]["jwt_refresh_lead_time"]
+            if ext_conf["google_cloud"].get("publish_mode"):
+                self.google_cloud__publish_mode = ext_conf["google_cloud"]["publish_mode"]
+            if ext_conf["google_cloud"].get("keyframe_interval"):
+                self.google_cloud__keyframe_interval = ext_conf["google_cloud"]["keyframe_interval"]
+            if ext_conf["google_cloud"].get("max_inflight_publishes"):
+                self.google_cloud__max_inflight_publishes = ext_conf["google_cloud"]["max_inflight_publishes"]
+            if ext_conf["google_cloud"].get("max_queued_publishes"):
+                self.google_cloud__max_queued_publishes = ext_conf["google_cloud"]["max_queued_publishes"]
+            if ext_conf["google_cloud"].get("publish_ack_timeout"):
+                self.google_cloud__publish_ack_timeout = ext_conf["google_cloud"]["publish_ack_timeout"]
+            if ext_conf["google_cloud"].get("payload_encoding"):
+                self.google_cloud__payload_encoding = ext_conf["google_cloud"]["payload_encoding"]
+
+            # Optional section, tuning of the processing of the messages received from the internal broker
+            processing = ext_conf.get("processing", {})
+            if processing.get("runtime"):
+                self.processing__runtime = processing["runtime"]
+            if processing.get("queue_type"):
+                self.processing__queue_type = processing["queue_type"]
+            if processing.get("queue_size"):
+                self.processing__queue_size = processing["queue_size"]
+            if processing.get("overflow_policy"):
+                self.processing__overflow_policy = processing["overflow_policy"]
+            if processing.get("max_batch_size"):
+                self.processing__max_batch_size = processing["max_batch_size"]
+            if processing.get("batch_time_budget"):
+                self.processing__batch_time_budget = processing["batch_time_budget"]
+            if processing.get("point_timestamp"):
+                self.processing__point_timestamp = processing["point_timestamp"]
+            if processing.get("decode_workers"):
+                self.processing__decode_workers = processing["decode_workers"]
+            if processing.get("deduplicate_frames") is not None:
+                self.processing__deduplicate_frames = processing["deduplicate_frames"]
+            if processing.get("verify_crc") is not None:
+                self.processing__verify_crc = processing["verify_crc"]
+
+            # Optional section, spooling of the pointset payloads while the Google Cloud is not reachable
+            store_and_forward = ext_conf.get("store_and_forward", {})
+            if store_and_forward.get("enabled"):
+                self.store_and_forward__enabled = store_and_forward["enabled"]
+            if store_and_forward.get("directory"):
+                self.store_and_forward__directory = store_and_forward["directory"]
+            if store_and_forward.get("segment_size_mb"):
+                self.store_and_forward__segment_size_mb = store_and_forward["segment_size_mb"]
+            if store_and_forward.get("max_size_mb"):
+                self.store_and_forward__max_size_mb = store_and_forward["max_size_mb"]
+            if store_and_forward.get("retention_hours"):
+                self.store_and_forward__retention_hours = store_and_forward["retention_hours"]
+            if store_and_forward.get("replay_rate"):
+                self.store_and_forward__replay_rate = store_and_forward["replay_rate"]
+
+            # Optional section, proxy devices sharded across several gateway identities
+            sharding = ext_conf.get("sharding", {})
+            if sharding.get("gateway_ids"):
+                self.sharding__gateway_ids = sharding["gateway_ids"]
+            if sharding.get("failover_timeout"):
+                self.sharding__failover_timeout = sharding["failover_timeout"]
+
+            # Optional section, pipeline metrics on a local HTTP endpoint and in the state of the gateway
+            metrics = ext_conf.get("metrics", {})
+            if metrics.get("enabled"):
+                self.metrics__enabled = metrics["enabled"]
+            if metrics.get("http_host"):
+                self.metrics__http_host = metrics["http_host"]
+            if metrics.get("http_port"):
+                self.metrics__http_port = metrics["http_port"]
+            if metrics.get("state_interval") is not None:
+                self.metrics__state_interval = metrics["state_interval"]
 
             if ext_conf["site_details"]["gateway_id"]:
                 self.site_details__gateway_id = ext_conf["site_details"]["gateway_id"]
@@ -157,6 +278,8 @@ class ConfigHandler:
                 self.internal_broker__mqtt_bridge_hostname = args.internal_broker__mqtt_bridge_hostname
             if args.internal_broker__mqtt_bridge_port is not None:
                 self.internal_broker__mqtt_bridge_port = args.internal_broker__mqtt_bridge_port
+            if getattr(args, "internal_broker__capture_file", None) is not None:
+                self.internal_broker__capture_file = args.internal_broker__capture_file
 
             if args.google_cloud__cloud_region is not None:
                 self.google_cloud__cloud_region = args.google_cloud__cloud_region
@@ -185,12 +308,51 @@ class ConfigHandler:
         self.logger.info("  internal_broker__x509_certificate: {}".format(self.internal_broker__x509_certificate))
         self.logger.info("  internal_broker__private_key: {}".format(self.internal_broker__private_key))
         self.logger.info("  internal_broker__enable_tls: {}".format(self.internal_broker__enable_tls))
+        self.logger.info("  internal_broker__capture_file: {}".format(self.internal_broker__capture_file))
 
         self.logger.info("  google_cloud__cloud_region: {}".format(self.google_cloud__cloud_region))
         self.logger.info("  google_cloud__project_id: {}".format(self.google_cloud__project_id))
         self.logger.info(
             "  google_cloud__mqtt_bridge_hostname: {}".format(self.google_cloud__mqtt_bridge_hostname))
         self.logger.info("  google_cloud__mqtt_bridge_port: {}".format(self.google_cloud__mqtt_bridge_port))
+        self.logger.info("  google_cloud__connect_timeout: {}".format(self.google_cloud__connect_timeout))
+        self.logger.info("  google_cloud__attach_timeout: {}".format(self.google_cloud__attach_timeout))
+        self.logger.info("  google_cloud__max_inflight_attach: {}".format(self.google_cloud__max_inflight_attach))
+        self.logger.info("  google_cloud__jwt_rotation: {}".format(self.google_cloud__jwt_rotation))
+        self.logger.info("  google_cloud__jwt_lifetime: {}".format(self.google_cloud__jwt_lifetime))
+        self.logger.info("  google_cloud__jwt_refresh_lead_time: {}".format(self.google_cloud__jwt_refresh_lead_time))
+        self.logger.info("  google_cloud__publish_mode: {}".format(self.google_cloud__publish_mode))
+        self.logger.info("  google_cloud__keyframe_interval: {}".format(self.google_cloud__keyframe_interval))
+        self.logger.info("  google_cloud__max_inflight_publishes: {}".format(self.google_cloud__max_inflight_publishes))
+        self.logger.info("  google_cloud__max_queued_publishes: {}".format(self.google_cloud__max_queued_publishes))
+        self.logger.info("  google_cloud__publish_ack_timeout: {}".format(self.google_cloud__publish_ack_timeout))
+        self.logger.info("  google_cloud__payload_encoding: {}".format(self.google_cloud__payload_encoding))
+
+        self.logger.info("  processing__runtime: {}".format(self.processing__runtime))
+        self.logger.info("  processing__queue_type: {}".format(self.processing__queue_type))
+        self.logger.info("  processing__queue_size: {}".format(self.processing__queue_size))
+        self.logger.info("  processing__overflow_policy: {}".format(self.processing__overflow_policy))
+        self.logger.info("  processing__max_batch_size: {}".format(self.processing__max_batch_size))
+        self.logger.info("  processing__batch_time_budget: {}".format(self.processing__batch_time_budget))
+        self.logger.info("  processing__point_timestamp: {}".format(self.processing__point_timestamp))
+        self.logger.info("  processing__decode_workers: {}".format(self.processing__decode_workers))
+        self.logger.info("  processing__deduplicate_frames: {}".format(self.processing__deduplicate_frames))
+        self.logger.info("  processing__verify_crc: {}".format(self.processing__verify_crc))
+
+        self.logger.info("  store_and_forward__enabled: {}".format(self.store_and_forward__enabled))
+        self.logger.info("  store_and_forward__directory: {}".format(self.store_and_forward__directory))
+        self.logger.info("  store_and_forward__segment_size_mb: {}".format(self.store_and_forward__segment_size_mb))
+        self.logger.info("  store_and_forward__max_size_mb: {}".format(self.store_and_forward__max_size_mb))
+        self.logger.info("  store_and_forward__retention_hours: {}".format(self.store_and_forward__retention_hours))
+        self.logger.info("  store_and_forward__replay_rate: {}".format(self.store_and_forward__replay_rate))
+
+        self.logger.info("  sharding__gateway_ids: {}".format(self.sharding__gateway_ids))
+        self.logger.info("  sharding__failover_timeout: {}".format(self.sharding__failover_timeout))
+
+        self.logger.info("  metrics__enabled: {}".format(self.metrics__enabled))
+        self.logger.info("  metrics__http_host: {}".format(self.metrics__http_host))
+        self.logger.info("  metrics__http_port: {}".format(self.metrics__http_port))
+        self.logger.info("  metrics__state_interval: {}".format(self.metrics__state_interval))
 
         self.logger.info("  site_details__name: {}".format(self.site_details__name))
         self.logger.info("  site_details__registry_id: {}".format(self.site_details__registry_id))
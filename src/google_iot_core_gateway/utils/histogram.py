@@ -0,0 +1,83 @@
+import math
+
+
+class Histogram:
+    """
+    Histogram of durations with logarithmic buckets, in the spirit of HdrHistogram.
+
+    Each bucket is (1 + precision) times wider than the previous one, so any recorded value is reported
+    with a relative error below the precision, with a fixed memory footprint whatever the number of values.
+
+    Args:
+        lowest: values up to this one (in seconds) fall into the first bucket
+        highest: values above this one (in seconds) fall into the last bucket
+        precision: relative width of the buckets
+    """
+
+    def __init__(self, lowest=0.0001, highest=3600.0, precision=0.05):
+        self.lowest = lowest
+        self._scale = 1 / math.log1p(precision)
+        self._log_lowest = math.log(lowest)
+        self._counts = [0] * (self._get_index(highest) + 1)
+        self._last_index = len(self._counts) - 1
+
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _get_index(self, value):
+        if value <= self.lowest:
+            return 0
+        return int(math.log(value / self.lowest) * self._scale) + 1
+
+    def _get_value(self, index):
+        # upper bound of the bucket
+        return self.lowest * math.exp(index / self._scale)
+
+    def record(self, value):
+        # _get_index inlined, the histograms record every frame when the metrics are enabled
+        if value <= self.lowest:
+            index = 0
+        else:
+            index = int((math.log(value) - self._log_lowest) * self._scale) + 1
+            if index > self._last_index:
+                index = self._last_index
+        self._counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.count == 1:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """
+        Args:
+            percent: 0 - 100
+        Returns:
+            Value below which the given percentage of the recorded values fall, None if nothing was recorded
+        """
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= threshold:
+                return min(self._get_value(index), self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
@@ -1,8 +1,70 @@
+import os
+import time
+import threading
+
 import jwt
 import datetime
+from jwt.algorithms import get_default_algorithms
+
+
+class PrivateKeyCache:
+    """
+    Parsed private keys, loaded once per file and algorithm.
+
+    Parsing an RSA/EC PEM key is slow on the gateway CPUs. The parsed key object is passed to jwt.encode,
+    which then uses it as it is. A key is loaded again only when the modification time of its file changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+
+    def get(self, private_key_file, algorithm):
+        mtime = os.stat(private_key_file).st_mtime_ns
+        key = (private_key_file, algorithm)
+        with self._lock:
+            cached = self._keys.get(key)
+            if cached is not None and cached[0] == mtime:
+                return cached[1]
 
+            # Read the private key file.
+            with open(private_key_file, "r") as f:
+                private_key = get_default_algorithms()[algorithm].prepare_key(f.read())
+            self._keys[key] = (mtime, private_key)
+            return private_key
 
-def create_jwt(logger, project_id, private_key_file, algorithm):
+
+class JWTCreationMetrics:
+    """
+    Timing of the JWT creation, in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.last = duration
+        self.max = max(self.max, duration)
+        self.total += duration
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "last_seconds": self.last,
+            "max_seconds": self.max,
+            "average_seconds": self.total / self.count if self.count else 0.0,
+        }
+
+
+private_key_cache = PrivateKeyCache()
+jwt_creation_metrics = JWTCreationMetrics()
+
+
+def create_jwt(logger, project_id, private_key_file, algorithm, lifetime=20):
     """
     Creates a JWT (https://jwt.io) to establish an MQTT connection.
     Args:
@@ -11,18 +73,20 @@ def create_jwt(logger, project_id, private_key_file, algorithm):
         private_key_file: A path to a file containing either an RSA256 or
              ES256 private key.
         algorithm: The encryption algorithm to use. Either 'RS256' or 'ES256'
+        lifetime: Lifetime of the JWT in minutes
     Returns:
         A JWT generated from the given project_id and private key, which
-        expires in 20 minutes. After 20 minutes, your client will be
+        expires after its lifetime (20 minutes by default). After that, your client will be
         disconnected, and a new JWT will have to be generated.
     Raises:
         ValueError: If the private_key_file does not contain a known key.
     """
+    start = time.perf_counter()
 
     # The time that the token was issued at
     jwt_iat = datetime.datetime.utcnow()
     # The time the token expires.
-    jwt_exp = jwt_iat + datetime.timedelta(minutes=20)
+    jwt_exp = jwt_iat + datetime.timedelta(minutes=lifetime)
 
     token = {
         "iat": jwt_iat,
@@ -31,12 +95,15 @@ def create_jwt(logger, project_id, private_key_file, algorithm):
         "aud": project_id,
     }
 
-    # Read the private key file.
-    with open(private_key_file, "r") as f:
-        private_key = f.read()
+    # The parsed private key, loaded again only if the file changed.
+    private_key = private_key_cache.get(private_key_file, algorithm)
+
+    encoded_token = jwt.encode(token, private_key, algorithm=algorithm)
 
-    logger.debug("Creating JWT using {} from private key file {}".format(
-        algorithm, private_key_file
+    duration = time.perf_counter() - start
+    jwt_creation_metrics.add(duration)
+    logger.debug("Created JWT using {} from private key file {} in {:.1f} ms".format(
+        algorithm, private_key_file, duration * 1000
     ))
 
-    return jwt.encode(token, private_key, algorithm=algorithm), jwt_exp
+    return encoded_token, jwt_exp
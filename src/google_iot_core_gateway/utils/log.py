@@ -1,4 +1,8 @@
+import queue
+import atexit
 import logging
+import threading
+import logging.handlers
 from colorlog import ColoredFormatter
 
 """
@@ -7,17 +11,100 @@ from colorlog import ColoredFormatter
 Date: 02 Dec 2021: 
     - Disabled colored log Feature
     - Disabled logging into logfile to avoid disk space full problem 
+
+Date: 17 Oct 2026:
+    - The records are written to the console by a QueueListener thread, logging never waits for stdout
+    - Records are rate limited per call site
+    - The root logger level is INFO instead of DEBUG, DEBUG is enabled by the verbose level
 """
 
-def setup_logger():
+# Maximum number of records waiting to be written, further records are dropped instead of blocking the caller
+LOG_QUEUE_SIZE = 10000
+# Records per second and burst of records allowed per call site (file and line)
+LOG_RATE_LIMIT = 10
+LOG_RATE_BURST = 20
+
+
+class CallSiteRateLimiter(logging.Filter):
+    """
+    Rate limit of the log records per call site, with a token bucket per (file, line).
+
+    A message logged for every frame or every device floods the output and costs CPU at every level,
+    so the records of all levels are limited. The number of records suppressed since the last record of
+    the call site is appended to the message of the next record that passes.
+
+    Args:
+        rate: records per second allowed per call site
+        burst: records allowed at once per call site
+    """
+
+    def __init__(self, rate=LOG_RATE_LIMIT, burst=LOG_RATE_BURST):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.suppressed = 0
+
+        # (pathname, lineno) -> [tokens, time of the last record, records suppressed since the last passed one]
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, record.created, 0]
+
+            tokens = min(self.burst, bucket[0] + (record.created - bucket[1]) * self.rate)
+            bucket[1] = record.created
+            if tokens < 1:
+                bucket[0] = tokens
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+
+            bucket[0] = tokens - 1
+            suppressed = bucket[2]
+            bucket[2] = 0
+
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler dropping the records when the queue is full, so the caller, e.g. a paho network thread,
+    never waits for the console.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logger(level=logging.INFO, rate_limit=LOG_RATE_LIMIT, rate_burst=LOG_RATE_BURST):
     """
         Set ups logger for this module.
+
+        The records are handed to a QueueListener thread writing them to the console, the logging calls only
+        format the message of the records that pass the level and the rate limit.
+        Args:
+            level: level of the root logger
+            rate_limit: records per second allowed per call site, None to disable the rate limit
+            rate_burst: records allowed at once per call site
         Returns:
             Logger with established formatter.
         """
 
     log_format = '%(asctime)s: %(levelname)s - %(module)s - %(message)s'
-    formatter = logging.Formatter(log_format)
+    formatter = logging.Formatter(log_format, datefmt="[%Y-%m-%d %H:%M:%S]")
 
     color_format = ColoredFormatter(
         "%(asctime)s: %(log_color)s %(levelname) - 2s%(reset)s - %(module)s - %(message)s",
@@ -33,9 +120,24 @@ def setup_logger():
     # Save full log
     #logging.basicConfig(level=logging.DEBUG, datefmt="[%Y-%m-%d %H:%M:%S]", format=log_format, filename='main.log',
     #                    filemode="w")
-    logging.basicConfig(level=logging.DEBUG, datefmt="[%Y-%m-%d %H:%M:%S]", format=log_format)              
 
     logger = logging.getLogger()
+    logger.setLevel(level)
+    if any(isinstance(handler, NonBlockingQueueHandler) for handler in logger.handlers):
+        return logger
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    if rate_limit:
+        queue_handler.addFilter(CallSiteRateLimiter(rate_limit, rate_burst))
+    logger.addHandler(queue_handler)
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    # the records still queued are written at exit
+    atexit.register(listener.stop)
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
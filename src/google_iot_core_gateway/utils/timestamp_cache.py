@@ -0,0 +1,46 @@
+import time
+
+UDMI_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class TimestampCache:
+    """
+    UDMI timestamps with one second resolution, formatted once per second.
+
+    All the points of a frame and the payloads built in the same second get the same timestamp, so the
+    formatted string is cached and strftime is only called when the second changes. The second and its
+    string are stored as one tuple, so the cache can be shared between threads without a lock.
+
+    Args:
+        timestamp_format: strftime format of the timestamps (UTC)
+    """
+
+    def __init__(self, timestamp_format=UDMI_TIMESTAMP_FORMAT):
+        self.timestamp_format = timestamp_format
+        self._cached = (None, "")
+
+    def format(self, epoch_time):
+        """
+        Args:
+            epoch_time: seconds since the epoch, e.g. time.time() when a message was received
+        Returns:
+            UDMI timestamp of the given time
+        """
+        second = int(epoch_time)
+        cached = self._cached
+        if cached[0] == second:
+            return cached[1]
+
+        timestamp = time.strftime(self.timestamp_format, time.gmtime(second))
+        self._cached = (second, timestamp)
+        return timestamp
+
+    def now(self):
+        """
+        Returns:
+            UDMI timestamp of the current time
+        """
+        return self.format(time.time())
+
+
+timestamp_cache = TimestampCache()
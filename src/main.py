@@ -7,6 +7,7 @@
 
 import argparse
 import asyncio
+import multiprocessing
 import queue
 import threading
 
@@ -34,6 +35,9 @@ def get_internal_broker_cmd_line_parser() -> argparse.ArgumentParser:
     group.add_argument("-internal-broker-port", dest="internal_broker__mqtt_bridge_port", type=int,
                        metavar="PORT",
                        help="Overwrite Internal Broker Port. Default[1883]")
+    group.add_argument("-internal-broker-capture-file", dest="internal_broker__capture_file", type=str,
+                       metavar="PATH",
+                       help="Capture the internal broker messages into this file, see benchmarks/replay_capture.py")
     return parser
 
 def parse_main_cmd_line_args(args: list[str] = None,
@@ -64,6 +68,8 @@ def parse_main_cmd_line_args(args: list[str] = None,
 
 
 if __name__ == "__main__":
+    # the decode workers are spawned, a PyInstaller bundle has to run them instead of the gateway
+    multiprocessing.freeze_support()
 
     # parse the main command line parameters
     args = parse_main_cmd_line_args(parents=[
@@ -0,0 +1,89 @@
+import struct
+
+import pytest
+
+from google_iot_core_gateway import ROOT_DIR
+from google_iot_core_gateway.modbus_gw.crc import get_crc16, is_crc_valid
+from google_iot_core_gateway.modbus_gw.modbus_to_json import decode_fc3_fc4, decode_plan_cache, set_crc_verification
+
+# Read holding registers request of slave 1, 10 registers from address 0, with its CRC
+READ_REQUEST = bytes.fromhex("01030000000ac5cd")
+
+
+def test_crc16_modbus_check_value():
+    assert get_crc16(b"123456789") == 0x4B37
+
+
+def test_crc16_of_a_frame_in_several_parts():
+    assert get_crc16(b"56789", get_crc16(b"1234")) == get_crc16(b"123456789")
+
+
+
+def get_crc16_bit_by_bit(frame, crc=0xFFFF):
+    for byte in frame:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+@pytest.mark.parametrize("length", range(0, 40))
+def test_crc16_of_odd_and_even_lengths(length):
+    frame = bytes((index * 37 + length) & 0xFF for index in range(length))
+    assert get_crc16(frame) == get_crc16_bit_by_bit(frame)
+    assert get_crc16(memoryview(frame)[1:], 0x1234) == get_crc16_bit_by_bit(frame[1:], 0x1234)
+
+
+@pytest.mark.parametrize("frame_type", (bytes, bytearray, memoryview))
+def test_valid_frame_is_accepted(frame_type):
+    assert is_crc_valid(frame_type(READ_REQUEST))
+
+
+def test_response_with_its_crc_appended_is_accepted():
+    # 2 registers holding the float32 1.0
+    response = bytes.fromhex("0103043f800000")
+    assert is_crc_valid(response + get_crc16(response).to_bytes(2, "little"))
+
+
+def test_every_single_bit_error_is_rejected():
+    for index in range(len(READ_REQUEST)):
+        for bit in range(8):
+            corrupted = bytearray(READ_REQUEST)
+            corrupted[index] ^= 1 << bit
+            assert not is_crc_valid(corrupted)
+
+
+def test_crc_bytes_swapped_is_rejected():
+    assert not is_crc_valid(READ_REQUEST[:-2] + READ_REQUEST[-1:] + READ_REQUEST[-2:-1])
+
+
+@pytest.mark.parametrize("frame", (b"", b"\xff", b"\xff\xff"))
+def test_frame_without_data_is_rejected(frame):
+    assert not is_crc_valid(frame)
+
+
+def test_decoder_rejects_the_response_with_a_crc_error():
+    decode_plan_cache.set_root_dir(ROOT_DIR)
+    rtu_request = struct.pack(">BBHH", 2, 3, 3027, 2)
+    rtu_response = bytes((2, 3, 4)) + struct.pack(">f", 230.5)
+    rtu_response += get_crc16(rtu_response).to_bytes(2, "little")
+    assert decode_fc3_fc4(rtu_request, rtu_response).data == {3028: 230.5}
+
+    corrupted = bytearray(rtu_response)
+    corrupted[4] ^= 0x10
+    frame = decode_fc3_fc4(rtu_request, bytes(corrupted))
+    assert frame.crc_error
+    assert frame.data is None
+    assert frame.block_key == (2, 3, 3027, 2)
+
+
+def test_crc_verification_can_be_disabled():
+    decode_plan_cache.set_root_dir(ROOT_DIR)
+    rtu_request = struct.pack(">BBHH", 2, 3, 3027, 2)
+    rtu_response = bytes((2, 3, 4)) + struct.pack(">f", 230.5) + b"\0\0"
+    set_crc_verification(False)
+    try:
+        assert decode_fc3_fc4(rtu_request, rtu_response).data == {3028: 230.5}
+    finally:
+        set_crc_verification(True)
+    assert decode_fc3_fc4(rtu_request, rtu_response).crc_error
@@ -0,0 +1,144 @@
+import math
+import random
+import struct
+
+import pytest
+
+from google_iot_core_gateway import ROOT_DIR
+from google_iot_core_gateway.modbus_gw.crc import get_crc16
+from google_iot_core_gateway.modbus_gw.decode_plan import (DecodePlan, get_nested_key_value_pairs,
+                                                           get_register_offset, is_even,
+                                                           map_modbus_slave_to_type, read_json_file)
+from google_iot_core_gateway.modbus_gw.modbus_to_json import decode_fc3_fc4, decode_plan_cache
+
+# float32 NaN as sent by the meters for the points that are not applicable
+NAN_REGISTERS = bytes.fromhex("ffc00000")
+
+
+def get_site_devices():
+    return map_modbus_slave_to_type(read_json_file(str(ROOT_DIR / "resources" / "config-google-gateway.json")))
+
+
+def get_dbo_map(meter_type):
+    path = ROOT_DIR / "resources" / "modbus_dbo_maps" / (meter_type + ".json")
+    return dict(get_nested_key_value_pairs(read_json_file(str(path))))
+
+
+def decode_baseline(dbo_map, starting_address, quantity_of_registers, rtu_response):
+    """
+    Register by register decoding of the RTU response, as done before the decode plans.
+    Returns:
+        {register address: value}
+    """
+    registers = struct.unpack('>' + 'H' * quantity_of_registers, rtu_response[3:3 + quantity_of_registers * 2])
+    rtu_response_bytes = rtu_response[3:-2]
+
+    data = {}
+    for register_address, register_value in enumerate(registers, starting_address):
+        if str(register_address) in dbo_map and is_even(register_address):
+            properties = dbo_map[str(register_address)]
+            total_bytes = properties['number_of_registers'] * 2
+            data_format = properties['format']
+            start_index, end_index = get_register_offset(register_address, starting_address, total_bytes)
+            byte_value = rtu_response_bytes[start_index:end_index]
+            if data_format not in ("float32", "int64", "int32u"):
+                continue
+            if total_bytes != len(byte_value):
+                data[register_address] = "[ERROR]. Received ({}) bytes not equal to expected bytes length ({}) " \
+                                         "as per meter definition file".format(len(byte_value), total_bytes)
+            elif data_format == "float32":
+                value = struct.unpack('>f', byte_value)[0]
+                data[register_address] = "N/A(" + byte_value.hex() + ")" if math.isnan(value) else value
+            elif data_format == "int64":
+                data[register_address] = struct.unpack('>q', byte_value)[0]
+            else:
+                data[register_address] = struct.unpack('>I', byte_value)[0]
+        elif str(register_address + 1) in dbo_map:
+            properties = dbo_map[str(register_address + 1)]
+            total_bytes = properties['number_of_registers'] * 2
+            start_index, end_index = get_register_offset(register_address + 1, starting_address, total_bytes)
+            if properties['format'] == "int16u" and total_bytes == len(rtu_response_bytes[start_index:end_index]):
+                data[register_address + 1] = register_value
+    return data
+
+
+def get_register_blocks(dbo_map, rng):
+    """
+    Register blocks of the points of the meter definition file as a Modbus master would poll them, one
+    register before the points, and blocks at random addresses cutting points at both ends.
+    """
+    addresses = sorted(int(address) for address in dbo_map if address.isdigit())
+    blocks = [(address - 1, dbo_map[str(address)]["number_of_registers"]) for address in addresses]
+    blocks += [(address, dbo_map[str(address)]["number_of_registers"]) for address in addresses]
+    blocks += [(129, 2), (1636, 1), (2999, 125), (3027, 60), (3203, 40)]
+    for _ in range(50):
+        blocks.append((rng.choice(addresses) + rng.randint(-3, 3), rng.randint(1, 125)))
+    return blocks
+
+
+def build_response(slave_id, function_code, quantity_of_registers, rng):
+    data = bytearray(rng.getrandbits(8) for _ in range(quantity_of_registers * 2))
+    # not applicable float32 points
+    for _ in range(quantity_of_registers // 8):
+        offset = rng.randrange(0, len(data) - 1, 2)
+        data[offset:offset + 4] = NAN_REGISTERS[:len(data) - offset]
+    response = bytes((slave_id, function_code, len(data))) + data
+    return response + get_crc16(response).to_bytes(2, "little")
+
+
+def get_frames(seed=1):
+    rng = random.Random(seed)
+    for slave_id, meter_type in sorted(get_site_devices().items()):
+        dbo_map = get_dbo_map(meter_type)
+        for starting_address, quantity_of_registers in get_register_blocks(dbo_map, rng):
+            function_code = rng.choice((3, 4))
+            rtu_request = struct.pack(">BBHH", slave_id, function_code, starting_address, quantity_of_registers)
+            rtu_response = build_response(slave_id, function_code, quantity_of_registers, rng)
+            yield dbo_map, starting_address, quantity_of_registers, rtu_request, rtu_response
+
+
+@pytest.fixture(autouse=True)
+def repo_decode_plans():
+    decode_plan_cache.set_root_dir(ROOT_DIR)
+    yield
+    decode_plan_cache.set_root_dir(ROOT_DIR)
+
+
+def test_decode_plans_decode_as_the_baseline_decoder():
+    frames = list(get_frames())
+    assert len(frames) > 300
+    for dbo_map, starting_address, quantity_of_registers, rtu_request, rtu_response in frames:
+        frame = decode_fc3_fc4(rtu_request, rtu_response)
+        expected = decode_baseline(dbo_map, starting_address, quantity_of_registers, rtu_response)
+        assert frame.data == expected, f"request {rtu_request.hex()}"
+        assert frame.error is None
+        assert not frame.crc_error
+
+
+def test_compiled_plan_decodes_the_register_data():
+    dbo_map = get_dbo_map("PM5111")
+    # line1_neutral_voltage_sensor (3028) and the next point (3030), requested from the register before
+    plan = DecodePlan.compile("PM5111", dbo_map, 3027, 4)
+    assert [point.register_address for point in plan.points] == [3028, 3030]
+    rtu_response = bytes((2, 3, 8)) + struct.pack(">ff", 230.5, 231.25) + b"\0\0"
+    assert plan.decode(rtu_response) == {3028: 230.5, 3030: 231.25}
+
+
+def test_point_cut_by_the_end_of_the_block_reports_an_error():
+    dbo_map = get_dbo_map("PM5111")
+    # total_energy_accumulator (3216) is an int64 of 4 registers
+    plan = DecodePlan.compile("PM5111", dbo_map, 3215, 2)
+    assert plan.decode(bytes((2, 3, 4)) + bytes(4) + b"\0\0") == {
+        3216: "[ERROR]. Received (4) bytes not equal to expected bytes length (8) as per meter definition file"}
+
+
+def test_register_offset():
+    # register 3000 requested from 2999 is the first register of the response
+    assert get_register_offset(3000, 2999, 4) == (0, 4)
+    assert get_register_offset(3004, 2999, 8) == (8, 16)
+
+
+def test_invalid_response_is_not_decoded():
+    rtu_request = struct.pack(">BBHH", 1, 3, 2999, 4)
+    rtu_response = bytes((1, 3, 6)) + bytes(6)
+    assert decode_fc3_fc4(rtu_request, rtu_response + get_crc16(rtu_response).to_bytes(2, "little")) is None
@@ -0,0 +1,71 @@
+import json
+import struct
+
+import pytest
+
+from google_iot_core_gateway import ROOT_DIR
+from google_iot_core_gateway.modbus_gw.crc import get_crc16
+from google_iot_core_gateway.modbus_gw.frame_cache import FrameCache, get_block_hex
+from google_iot_core_gateway.modbus_gw.modbus_to_json import decode_payload, decode_plan_cache, frame_cache
+
+
+def get_payload(value, slave_id=2, starting_address=3027):
+    # line1_neutral_voltage_sensor (3028) of the PM5111 meter EM-2
+    rtu_request = struct.pack(">BBHH", slave_id, 3, starting_address, 2)
+    rtu_response = bytes((slave_id, 3, 4)) + struct.pack(">f", value)
+    rtu_response += get_crc16(rtu_response).to_bytes(2, "little")
+    return json.dumps({"rtu_request": rtu_request.hex(), "rtu_response": rtu_response.hex()}).encode()
+
+
+@pytest.fixture
+def enabled_frame_cache():
+    decode_plan_cache.set_root_dir(ROOT_DIR)
+    frame_cache.enable()
+    yield frame_cache
+    frame_cache.disable()
+
+
+def test_block_hex_is_found_without_parsing_the_message():
+    assert get_block_hex(get_payload(1.0)) == b"02030bd30002"
+    assert get_block_hex(get_payload(1.0).decode()) == b"02030bd30002"
+    assert get_block_hex(b'{"rtu_response": "0203"}') is None
+
+
+def test_only_identical_messages_of_a_block_are_hits():
+    cache = FrameCache()
+    block_key = (2, 3, 3027, 2)
+    assert cache.get_unchanged_block(get_payload(1.0), 1) is None
+    cache.store(get_payload(1.0), block_key)
+
+    assert cache.get_unchanged_block(get_payload(1.0), 1) == block_key
+    assert cache.get_unchanged_block(get_payload(2.0), 1) is None
+    assert cache.get_unchanged_block(get_payload(1.0, starting_address=3029), 1) is None
+    assert cache.get_counters() == {"hits": 1, "misses": 3, "blocks": 1}
+
+
+def test_cache_is_dropped_with_the_decode_plans():
+    cache = FrameCache()
+    cache.store(get_payload(1.0), (2, 3, 3027, 2))
+    assert cache.get_unchanged_block(get_payload(1.0), 2) is None
+    assert cache.get_counters()["blocks"] == 0
+
+
+def test_unchanged_frame_is_not_decoded_again(enabled_frame_cache):
+    decoded = decode_payload(get_payload(230.5))
+    unchanged = decode_payload(get_payload(230.5))
+    assert decoded.data == {3028: 230.5}
+    assert not decoded.unchanged
+    assert unchanged.unchanged
+    assert unchanged.data is None
+    assert unchanged.block_key == decoded.block_key == (2, 3, 3027, 2)
+
+    assert decode_payload(get_payload(231.0)).data == {3028: 231.0}
+
+    decode_plan_cache.invalidate()
+    assert not decode_payload(get_payload(231.0)).unchanged
+
+
+def test_invalid_frames_are_not_cached(enabled_frame_cache):
+    payload = json.dumps({"rtu_request": "02030bd30002", "rtu_response": "0203040000"}).encode()
+    decode_payload(payload)
+    assert enabled_frame_cache.get_counters()["blocks"] == 0
@@ -0,0 +1,109 @@
+import json
+import time
+import logging
+import threading
+from queue import Empty, Full
+
+import pytest
+
+from google_iot_core_gateway.internal_broker_subscriber.frame_handoff import (COALESCE, DROP_NEWEST, DROP_OLDEST,
+                                                                              RING_BUFFER, FrameHandoff,
+                                                                              FrameRingBuffer, create_frames_queue)
+
+logger = logging.getLogger(__name__)
+
+
+def get_payload(slave_id, starting_address, value):
+    rtu_request = bytes((slave_id, 3)) + starting_address.to_bytes(2, "big") + (2).to_bytes(2, "big")
+    return json.dumps({"rtu_request": rtu_request.hex(), "rtu_response": value})
+
+
+def get_handoff(overflow_policy, maxsize=2):
+    return FrameHandoff(logger, create_frames_queue(RING_BUFFER, maxsize), overflow_policy)
+
+
+def get_all(frames_queue):
+    items = []
+    while frames_queue.qsize():
+        items.append(frames_queue.get_nowait())
+    return items
+
+
+def test_drop_oldest_keeps_the_newest_messages():
+    handoff = get_handoff(DROP_OLDEST)
+    for received_at, payload in enumerate(("a", "b", "c")):
+        handoff.put(payload, received_at)
+
+    assert get_all(handoff) == [(1, "b"), (2, "c")]
+    assert handoff.get_counters() == {"enqueued": 3, "dropped": 1, "coalesced": 0}
+
+
+def test_drop_newest_keeps_the_oldest_messages():
+    handoff = get_handoff(DROP_NEWEST)
+    for received_at, payload in enumerate(("a", "b", "c")):
+        handoff.put(payload, received_at)
+
+    assert get_all(handoff) == [(0, "a"), (1, "b")]
+    assert handoff.get_counters() == {"enqueued": 2, "dropped": 1, "coalesced": 0}
+
+
+def test_coalesce_replaces_the_queued_message_of_the_same_register_block():
+    handoff = get_handoff(COALESCE)
+    first_block_old = get_payload(1, 3000, "old")
+    second_block = get_payload(1, 3110, "second")
+    first_block_new = get_payload(1, 3000, "new")
+    third_block = get_payload(2, 3000, "third")
+    for received_at, payload in enumerate((first_block_old, second_block, first_block_new, third_block)):
+        handoff.put(payload, received_at)
+
+    # the newest message of a block keeps the place of the first one, a new block is dropped when full
+    assert get_all(handoff) == [(2, first_block_new), (1, second_block)]
+    assert handoff.get_counters() == {"enqueued": 2, "dropped": 1, "coalesced": 1}
+
+    handoff.put(first_block_old, 4)
+    assert get_all(handoff) == [(4, first_block_old)]
+
+
+def test_coalesce_queues_unparsable_messages_as_they_are():
+    handoff = get_handoff(COALESCE)
+    handoff.put("not json", 0)
+    handoff.put(get_payload(1, 3000, "value"), 1)
+    handoff.put("not json either", 2)
+
+    assert get_all(handoff) == [(0, "not json"), (1, get_payload(1, 3000, "value"))]
+    assert handoff.get_counters()["dropped"] == 1
+
+
+def test_unknown_overflow_policy_and_queue_type_are_rejected():
+    with pytest.raises(ValueError):
+        get_handoff("drop-random")
+    with pytest.raises(ValueError):
+        create_frames_queue("unbounded", 10)
+
+
+def test_ring_buffer_is_bounded_and_fifo():
+    ring_buffer = FrameRingBuffer(2)
+    ring_buffer.put_nowait(1)
+    ring_buffer.put_nowait(2)
+    assert ring_buffer.full()
+    with pytest.raises(Full):
+        ring_buffer.put_nowait(3)
+
+    assert [ring_buffer.get_nowait(), ring_buffer.get(timeout=0)] == [1, 2]
+    assert ring_buffer.empty()
+    with pytest.raises(Empty):
+        ring_buffer.get_nowait()
+
+
+def test_ring_buffer_get_times_out():
+    ring_buffer = FrameRingBuffer(2)
+    started = time.monotonic()
+    with pytest.raises(Empty):
+        ring_buffer.get(timeout=0.05)
+    assert time.monotonic() - started >= 0.05
+
+
+def test_ring_buffer_get_is_woken_up_by_put():
+    ring_buffer = FrameRingBuffer(2)
+    threading.Timer(0.02, ring_buffer.put_nowait, ("frame",)).start()
+    assert ring_buffer.get(timeout=5) == "frame"
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import subprocess
+
+from google_iot_core_gateway.gateway_shards import assign_devices_to_shards
+
+DEVICE_IDS = [f"EM-{index}" for index in range(1, 201)]
+GATEWAY_IDS = ["CGW-1", "CGW-2", "CGW-3", "CGW-4"]
+
+
+def get_owners(assignment):
+    return {device_id: gateway_id for gateway_id, device_ids in assignment.items() for device_id in device_ids}
+
+
+def test_every_device_is_assigned_to_one_gateway():
+    assignment = assign_devices_to_shards(DEVICE_IDS, GATEWAY_IDS)
+    assert sorted(assignment) == GATEWAY_IDS
+    assert sorted(get_owners(assignment)) == sorted(DEVICE_IDS)
+    assert sum(len(device_ids) for device_ids in assignment.values()) == len(DEVICE_IDS)
+    # spread over all the gateways
+    assert all(len(device_ids) > len(DEVICE_IDS) // 8 for device_ids in assignment.values())
+
+
+def test_assignment_does_not_depend_on_the_order_of_the_ids():
+    assignment = assign_devices_to_shards(DEVICE_IDS, GATEWAY_IDS)
+    assert assign_devices_to_shards(DEVICE_IDS[::-1], GATEWAY_IDS[::-1]) == assignment
+
+
+def test_only_the_devices_of_a_removed_gateway_move():
+    owners = get_owners(assign_devices_to_shards(DEVICE_IDS, GATEWAY_IDS))
+    remaining = [gateway_id for gateway_id in GATEWAY_IDS if gateway_id != "CGW-2"]
+    new_owners = get_owners(assign_devices_to_shards(DEVICE_IDS, remaining))
+
+    moved = {device_id for device_id in DEVICE_IDS if new_owners[device_id] != owners[device_id]}
+    assert moved == {device_id for device_id in DEVICE_IDS if owners[device_id] == "CGW-2"}
+    # they are spread over the remaining gateways
+    assert len({new_owners[device_id] for device_id in moved}) > 1
+
+    # and move back when the gateway is added again
+    assert get_owners(assign_devices_to_shards(DEVICE_IDS, GATEWAY_IDS)) == owners
+
+
+def test_adding_a_device_moves_no_other_device():
+    owners = get_owners(assign_devices_to_shards(DEVICE_IDS, GATEWAY_IDS))
+    new_owners = get_owners(assign_devices_to_shards(DEVICE_IDS + ["EM-201"], GATEWAY_IDS))
+    del new_owners["EM-201"]
+    assert new_owners == owners
+
+
+def test_assignment_is_stable_across_processes():
+    # str hashes are randomized per process, the assignment must not depend on them
+    script = ("import json; from google_iot_core_gateway.gateway_shards import assign_devices_to_shards; "
+              f"print(json.dumps({{gateway_id: sorted(device_ids) for gateway_id, device_ids in "
+              f"assign_devices_to_shards({DEVICE_IDS!r}, {GATEWAY_IDS!r}).items()}}))")
+    src_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    assignments = []
+    for hash_seed in ("1", "2"):
+        output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True,
+                                env=dict(os.environ, PYTHONPATH=src_dir, PYTHONHASHSEED=hash_seed)).stdout
+        assignments.append(json.loads(output))
+    assert assignments[0] == assignments[1]
+    assert assignments[0] == {gateway_id: sorted(device_ids) for gateway_id, device_ids in
+                              assign_devices_to_shards(DEVICE_IDS, GATEWAY_IDS).items()}
+
+
+def test_no_gateway():
+    assert assign_devices_to_shards(DEVICE_IDS, []) == {}
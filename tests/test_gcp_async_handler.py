@@ -0,0 +1,146 @@
+import asyncio
+import time
+import threading
+import logging
+from types import SimpleNamespace
+
+from google_iot_core_gateway import gcp_async_handler
+from google_iot_core_gateway.gcp_async_handler import GoogleIoTCoreGatewayAsync
+from google_iot_core_gateway.internal_broker_subscriber.frame_handoff import (FrameHandoff, create_frames_queue,
+                                                                               RING_BUFFER, DROP_NEWEST)
+
+logger = logging.getLogger(__name__)
+
+
+class FakeSubscriber:
+
+    def __init__(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+
+
+class FakePublisher:
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, device_id, payload, topic="state", qos=1, supersede=True):
+        self.published.append((device_id, payload, topic, supersede))
+
+    def get_publish_stats(self):
+        return {}
+
+
+def get_gateway(google_iot_core_queue=None, outbound_size=2):
+    config = SimpleNamespace(processing__max_batch_size=10, google_cloud__sample_rate_set=60,
+                             google_cloud__publish_mode="cov", google_cloud__keyframe_interval=600,
+                             metrics__state_interval=0, site_details__gateway_id="GW-1")
+    gateway = GoogleIoTCoreGatewayAsync.__new__(GoogleIoTCoreGatewayAsync)
+    gateway.logger = logger
+    gateway.config = config
+    gateway.int_broker_subscriber = FakeSubscriber()
+    gateway.google_iot_core_queue = google_iot_core_queue
+    gateway.udmi_handler = object()
+    gateway.google_iot_core_publisher = FakePublisher()
+    gateway.store_and_forward = None
+    gateway.decode_pool = None
+    gateway.outbound = asyncio.Queue(maxsize=outbound_size)
+    gateway.cloud_connected = asyncio.Event()
+    return gateway
+
+
+async def run_until(coroutines, condition, timeout=5.0):
+    tasks = [asyncio.create_task(coroutine()) for coroutine in coroutines]
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not condition() and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def test_decode_honours_the_overflow_policy(monkeypatch):
+    decoded = []
+    monkeypatch.setattr(gcp_async_handler, "process_payload",
+                        lambda logger, payload, udmi_handler, received_at: decoded.append(payload))
+    frames = FrameHandoff(logger, create_frames_queue(RING_BUFFER, 2), overflow_policy=DROP_NEWEST)
+    for payload in (b"first", b"second", b"third"):
+        frames.put(payload, received_at=0.0)
+    gateway = get_gateway(frames)
+
+    asyncio.run(run_until([gateway.decode], lambda: len(decoded) == 2))
+
+    assert gateway.int_broker_subscriber.running
+    assert decoded == [b"first", b"second"]
+    # the frame dropped by the subscriber queue is counted, nothing else drops frames
+    assert frames.get_counters()["dropped"] == 1
+    assert not hasattr(gateway, "frames")
+
+
+def test_partial_updates_are_not_dropped_when_the_outbound_channel_is_full(monkeypatch):
+    items = [(f"DEV-{i}", {"points": i}, "events/pointset", True) for i in range(5)]
+    monkeypatch.setattr(gcp_async_handler, "build_payloads", lambda *args: iter(items))
+    gateway = get_gateway(outbound_size=1)
+    gateway.cloud_connected.set()
+    publisher = gateway.google_iot_core_publisher
+
+    asyncio.run(run_until([gateway.publisher, gateway.sender], lambda: len(publisher.published) == len(items)))
+
+    assert publisher.published == [(device_id, payload, topic, False) for device_id, payload, topic, _ in items]
+
+
+def test_sender_hands_payloads_over_while_disconnected():
+    gateway = get_gateway()
+    publisher = gateway.google_iot_core_publisher
+
+    async def send():
+        await gateway.outbound.put(("DEV-1", {"points": 1}, "events/pointset", True))
+        await run_until([gateway.sender], lambda: publisher.published)
+
+    asyncio.run(send())
+
+    # the publish pipeline queues the partial update until the connection is back
+    assert publisher.published == [("DEV-1", {"points": 1}, "events/pointset", False)]
+
+
+class BlockingDecodePool:
+    """
+    Stands in for DecodeWorkerPool when all the workers are full: submit waits for their results.
+    """
+
+    def __init__(self):
+        self.submit_threads = set()
+        self.submitted = []
+
+    def is_busy(self):
+        return False
+
+    def submit(self, items):
+        self.submit_threads.add(threading.get_ident())
+        time.sleep(0.05)
+        self.submitted.extend(items)
+
+    def collect(self, timeout=0.0):
+        return []
+
+
+def test_decode_pool_submit_runs_off_the_event_loop():
+    frames = FrameHandoff(logger, create_frames_queue(RING_BUFFER, 10))
+    frames.put(b"frame", received_at=0.0)
+    gateway = get_gateway(frames)
+    gateway.decode_pool = BlockingDecodePool()
+
+    async def decode():
+        loop_thread = threading.get_ident()
+        await run_until([gateway.decode], lambda: gateway.decode_pool.submitted)
+        return loop_thread
+
+    loop_thread = asyncio.run(decode())
+
+    assert gateway.decode_pool.submitted == [(0.0, b"frame")]
+    assert loop_thread not in gateway.decode_pool.submit_threads
@@ -0,0 +1,44 @@
+import time
+import logging
+import threading
+
+from google_iot_core_gateway import gcp_handler
+from google_iot_core_gateway.gcp_handler import start_connection_supervisor
+
+logger = logging.getLogger(__name__)
+
+
+class SlowReconnectingPublisher:
+    """
+    Stands in for GoogleIoTCoreMQTTPublisher during an outage: every connection check reconnects with backoff.
+    """
+
+    def __init__(self, backoff):
+        self.backoff = backoff
+        self.is_publishing = False
+        self.checks = 0
+        self.threads = set()
+
+    def is_connection_open(self):
+        self.checks += 1
+        self.threads.add(threading.current_thread().name)
+        time.sleep(self.backoff)
+        if self.checks == 3:
+            raise OSError("network unreachable")
+        return False
+
+
+def test_connection_is_kept_open_off_the_main_loop(monkeypatch):
+    monkeypatch.setattr(gcp_handler, "CONNECTION_CHECK_INTERVAL", 0.01)
+    publisher = SlowReconnectingPublisher(backoff=0.1)
+    started = time.monotonic()
+    thread = start_connection_supervisor(logger, publisher)
+    assert time.monotonic() - started < 0.1
+    assert thread.daemon
+
+    # the connection checks go on after a failed one
+    deadline = time.monotonic() + 10
+    while publisher.checks < 4 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert publisher.checks >= 4
+    assert publisher.threads == {"connection-supervisor"}
@@ -0,0 +1,274 @@
+import time
+import logging
+import datetime
+import itertools
+import threading
+from types import SimpleNamespace
+
+import pytest
+import paho.mqtt.client as mqtt
+
+from google_iot_core_gateway.gcp_publisher import GoogleIoTCoreMQTTPublisher
+
+logger = logging.getLogger(__name__)
+
+DEVICES = {f"DEV-{i}": {} for i in range(6)}
+
+
+class StubClient:
+    """
+    Stands in for the paho client: CONNACK and PUBACKs are delivered to the callbacks as configured.
+
+    Args:
+        connack_rc: return code of the CONNACK sent on loop_start, no CONNACK if None
+        ack: 'deferred' to acknowledge the publishes from another thread after ack_delay seconds,
+             'early' to acknowledge them before publish returns the mid, 'never' not to acknowledge them
+    """
+
+    def __init__(self, connack_rc=0, ack="deferred", ack_delay=0.01):
+        self.connack_rc = connack_rc
+        self.ack = ack
+        self.ack_delay = ack_delay
+        self.passwords = []
+        self.published = []
+        self.subscribed = []
+        self.loop_starts = 0
+        self.unacked = 0
+        self.max_unacked = 0
+        self._mids = itertools.count(1)
+        self._lock = threading.Lock()
+        # connect waits for this event when set, e.g. to publish while the JWT is rotated
+        self.connect_gate = None
+
+    def tls_set(self, ca_certs=None, tls_version=None):
+        pass
+
+    def max_inflight_messages_set(self, inflight):
+        pass
+
+    def max_queued_messages_set(self, queue_size):
+        pass
+
+    def username_pw_set(self, username, password=None):
+        self.passwords.append(password)
+
+    def connect(self, host, port=1883, keepalive=60):
+        if self.connect_gate is not None:
+            self.connect_gate.wait(5)
+
+    def subscribe(self, topic, qos=0):
+        self.subscribed.append(topic)
+
+    def loop_start(self):
+        self.loop_starts += 1
+        if self.connack_rc is not None:
+            self.on_connect(self, None, {}, self.connack_rc)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def publish(self, topic, payload, qos=0):
+        mid = next(self._mids)
+        self.published.append(topic)
+        if self.ack == "early":
+            self.on_publish(self, None, mid)
+        elif self.ack == "deferred":
+            with self._lock:
+                self.unacked += 1
+                self.max_unacked = max(self.max_unacked, self.unacked)
+            threading.Timer(self.ack_delay, self._acknowledge, (mid,)).start()
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=mid)
+
+    def _acknowledge(self, mid):
+        with self._lock:
+            self.unacked -= 1
+        self.on_publish(self, None, mid)
+
+    def send_connack(self, rc=0):
+        self.on_connect(self, None, {}, rc)
+
+
+class StubClients(list):
+    """
+    Clients created by the publisher, the StubClient options of the next ones are set in options.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.options = {}
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    """
+    Replace the paho client with StubClient and the JWT signing with a fixed token.
+    """
+    created = StubClients()
+    jwt_numbers = itertools.count(1)
+
+    def create_client(client_id=None, protocol=None):
+        client = StubClient(**created.options)
+        created.append(client)
+        return client
+
+    def create_jwt(self):
+        return f"jwt-{next(jwt_numbers)}", datetime.datetime.utcnow() + datetime.timedelta(minutes=20)
+
+    monkeypatch.setattr(mqtt, "Client", create_client)
+    monkeypatch.setattr(GoogleIoTCoreMQTTPublisher, "_create_jwt", create_jwt)
+    return created
+
+
+def get_publisher(devices=None, **kwargs):
+    kwargs.setdefault("connect_timeout", 0.2)
+    kwargs.setdefault("attach_timeout", 2)
+    return GoogleIoTCoreMQTTPublisher(logger, dict(DEVICES if devices is None else devices), "project", "region",
+                                      "registry", "GW-1", "private_key", "ca_cert", "host", 8883, **kwargs)
+
+
+def attached(client):
+    return [topic for topic in client.published if topic.endswith("/attach")]
+
+
+def test_attach_messages_are_pipelined_up_to_the_inflight_limit(clients):
+    clients.options["ack_delay"] = 0.05
+    started = time.monotonic()
+    publisher = get_publisher(max_inflight_attach=3)
+    client = clients[-1]
+
+    assert attached(client) == [f"/devices/{device_id}/attach" for device_id in DEVICES]
+    assert client.max_unacked == 3
+    # six attach messages three at a time: two ack delays, not one per device
+    assert time.monotonic() - started < 1.0
+    assert publisher._devices_attached
+    assert publisher._can_publish()
+    assert {f"/devices/{device_id}/config" for device_id in DEVICES} <= set(client.subscribed)
+
+
+def test_attach_acknowledged_before_its_mid_is_recorded(clients):
+    clients.options["ack"] = "early"
+    started = time.monotonic()
+    publisher = get_publisher(max_inflight_attach=2)
+
+    # the PUBACKs received before publish returned are not waited for until the attach timeout
+    assert time.monotonic() - started < 1.0
+    assert len(attached(clients[-1])) == len(DEVICES)
+    assert publisher._devices_attached
+
+
+def test_attach_gives_up_after_the_attach_timeout(clients):
+    clients.options["ack"] = "never"
+    started = time.monotonic()
+    publisher = get_publisher(max_inflight_attach=2, attach_timeout=0.2)
+
+    assert time.monotonic() - started < 1.0
+    # the window stays full, the remaining attach messages are sent without waiting once the timeout expired
+    assert len(attached(clients[-1])) == len(DEVICES)
+    assert publisher.is_connected
+
+
+def test_devices_are_attached_once_connected_when_the_connack_is_late(clients):
+    clients.options["connack_rc"] = None
+    publisher = get_publisher()
+    client = clients[-1]
+
+    assert not publisher.is_connected
+    assert attached(client) == []
+    publisher.publish("DEV-0", "{}", topic="events/pointset")
+    assert "/devices/DEV-0/events/pointset" not in client.published
+
+    client.send_connack()
+    assert publisher.is_connected
+    assert not publisher._can_publish()
+
+    assert publisher.is_connection_open()
+    assert len(attached(client)) == len(DEVICES)
+    assert publisher._can_publish()
+    # the payload queued before the devices were attached is sent after their attach messages
+    assert client.published[-1] == "/devices/DEV-0/events/pointset"
+    assert len(clients) == 1
+
+
+def test_devices_are_attached_again_when_paho_reconnects(clients):
+    publisher = get_publisher()
+    client = clients[-1]
+    assert publisher._devices_attached
+
+    publisher.on_disconnect(client, None, 1)
+    assert not publisher.is_publishing
+    client.send_connack()
+
+    # a new session: the devices attached on the previous connection are not attached any more
+    assert not publisher._devices_attached
+    assert not publisher._can_publish()
+    assert publisher.is_connection_open()
+    assert publisher._devices_attached
+    assert len(attached(client)) == 2 * len(DEVICES)
+
+
+def test_refused_connection_is_not_waited_for(clients):
+    clients.options["connack_rc"] = 5
+    started = time.monotonic()
+    publisher = get_publisher(connect_timeout=5)
+
+    assert time.monotonic() - started < 1.0
+    assert not publisher.is_connected
+    assert not publisher.is_publishing
+    assert attached(clients[-1]) == []
+
+
+def test_jwt_is_rotated_on_the_same_client(clients):
+    # the JWT is valid 20 minutes, it is replaced when it expires within the refresh lead time
+    publisher = get_publisher(jwt_refresh_lead_time=0)
+    client = clients[-1]
+    assert publisher.is_connection_open()
+    assert publisher._rotation_thread is None
+
+    publisher._jwt_refresh_lead_time = 30 * 60
+    assert publisher.is_connection_open()
+    publisher._rotation_thread.join(5)
+
+    assert len(clients) == 1
+    assert client.passwords == ["jwt-1", "jwt-2"]
+    assert client.loop_starts == 2
+    assert len(attached(client)) == 2 * len(DEVICES)
+    assert publisher._can_publish()
+
+
+def test_publishes_are_buffered_while_the_jwt_is_rotated(clients):
+    publisher = get_publisher(jwt_refresh_lead_time=30 * 60)
+    client = clients[-1]
+    client.connect_gate = threading.Event()
+
+    publisher.is_connection_open()
+    deadline = time.monotonic() + 5
+    while not publisher._rotating and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # the connection is reported as open and nothing is sent until the devices are attached again
+    assert publisher.is_publishing
+    assert publisher.is_connection_open()
+    publisher.publish("DEV-0", "{}", topic="events/pointset")
+    assert "/devices/DEV-0/events/pointset" not in client.published
+
+    client.connect_gate.set()
+    publisher._rotation_thread.join(5)
+
+    assert not publisher._rotating
+    assert len(attached(client)) == 2 * len(DEVICES)
+    assert client.published[-1] == "/devices/DEV-0/events/pointset"
+
+
+def test_jwt_refresh_recreates_the_client(clients):
+    publisher = get_publisher(jwt_rotation="recreate", jwt_refresh_lead_time=30 * 60)
+
+    assert publisher.is_connection_open()
+
+    assert publisher._rotation_thread is None
+    assert len(clients) == 2
+    assert publisher.client is clients[-1]
+    assert clients[-1].passwords == ["jwt-2"]
+    assert len(attached(clients[-1])) == len(DEVICES)
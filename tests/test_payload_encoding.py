@@ -0,0 +1,64 @@
+import math
+
+import pytest
+
+from google_iot_core_gateway.payload_encoding import encode_cbor
+
+
+# Examples of RFC 8949 Appendix A, the floats which fit in a float32 are encoded with 4 bytes instead of 2
+@pytest.mark.parametrize("value, encoded", (
+    (0, "00"),
+    (23, "17"),
+    (24, "1818"),
+    (100, "1864"),
+    (1000, "1903e8"),
+    (1000000, "1a000f4240"),
+    (1000000000000, "1b000000e8d4a51000"),
+    (-1, "20"),
+    (-100, "3863"),
+    (-1000, "3903e7"),
+    (1.5, "fa3fc00000"),
+    (100000.0, "fa47c35000"),
+    (3.4028234663852886e+38, "fa7f7fffff"),
+    (1.1, "fb3ff199999999999a"),
+    (1.0e+300, "fb7e37e43c8800759c"),
+    (math.inf, "fa7f800000"),
+    (-math.inf, "faff800000"),
+    (False, "f4"),
+    (True, "f5"),
+    (None, "f6"),
+    ("", "60"),
+    ("a", "6161"),
+    ("IETF", "6449455446"),
+    ("ü", "62c3bc"),
+    ([], "80"),
+    ([1, [2, 3], [4, 5]], "8301820203820405"),
+    ((1, 2, 3), "83010203"),
+    ({}, "a0"),
+    ({"a": 1, "b": [2, 3]}, "a26161016162820203"),
+))
+def test_encode_cbor(value, encoded):
+    assert encode_cbor(value).hex() == encoded
+
+
+def test_encode_cbor_nan():
+    assert encode_cbor(math.nan).hex() == "fa7fc00000"
+
+
+def test_encode_cbor_float32_register_value_keeps_4_bytes():
+    # 230.1 read from a float32 register
+    value = 230.10000610351562
+    assert encode_cbor(value) == b"\xfa" + bytes.fromhex("4366199a")
+
+
+def test_encode_cbor_long_string_and_map():
+    text = "x" * 300
+    assert encode_cbor(text) == b"\x79\x01\x2c" + text.encode()
+    points = {f"point_{index:02d}": index for index in range(24)}
+    assert encode_cbor(points)[:2] == b"\xb8\x18"
+
+
+@pytest.mark.parametrize("value", (b"bytes", {1, 2}, object()))
+def test_encode_cbor_unsupported_type(value):
+    with pytest.raises(TypeError):
+        encode_cbor(value)
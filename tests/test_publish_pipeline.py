@@ -0,0 +1,114 @@
+import time
+import logging
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+from google_iot_core_gateway.publish_pipeline import PublishPipeline
+
+logger = logging.getLogger(__name__)
+
+
+class FakeClient:
+    """
+    Records the published messages, the PUBACKs are given by the test through the pipeline.
+    """
+
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.published = []
+
+    def publish(self, device_id, payload, topic, qos):
+        self.published.append((device_id, topic, payload))
+        return SimpleNamespace(rc=mqtt.MQTT_ERR_SUCCESS, mid=len(self.published))
+
+    def is_connected(self):
+        return self.connected
+
+
+def get_pipeline(client, **kwargs):
+    return PublishPipeline(logger, client.publish, client.is_connected, **kwargs)
+
+
+def test_queued_payload_is_superseded_by_a_newer_one():
+    client = FakeClient(connected=False)
+    pipeline = get_pipeline(client)
+    pipeline.submit("EM-1", "1", "events/pointset")
+    pipeline.submit("EM-2", "2", "events/pointset")
+    pipeline.submit("EM-1", "3", "events/pointset")
+    pipeline.submit("EM-1", "4", "state")
+
+    client.connected = True
+    pipeline.pump()
+    # the newer payload takes the place of the superseded one in the queue
+    assert client.published == [("EM-1", "events/pointset", "3"), ("EM-2", "events/pointset", "2"),
+                                 ("EM-1", "state", "4")]
+    assert pipeline.get_counters()["superseded"] == 1
+
+
+def test_payloads_submitted_without_supersede_are_all_sent_in_order():
+    client = FakeClient(connected=False)
+    pipeline = get_pipeline(client)
+    pipeline.submit("EM-1", "full 1", "events/pointset")
+    pipeline.submit("EM-1", "partial 1", "events/pointset", supersede=False)
+    pipeline.submit("EM-1", "partial 2", "events/pointset", supersede=False)
+    pipeline.submit("EM-1", "full 2", "events/pointset")
+
+    client.connected = True
+    pipeline.pump()
+    # the superseding payload is not sent before the older partial updates
+    assert [payload for _, _, payload in client.published] == ["partial 1", "partial 2", "full 2"]
+    assert pipeline.get_counters()["superseded"] == 1
+
+
+def test_oldest_payload_is_dropped_when_the_queue_is_full():
+    client = FakeClient(connected=False)
+    pipeline = get_pipeline(client, max_queued=2)
+    for device_id in ("EM-1", "EM-2", "EM-3"):
+        pipeline.submit(device_id, device_id, "state")
+
+    client.connected = True
+    pipeline.pump()
+    assert [device_id for device_id, _, _ in client.published] == ["EM-2", "EM-3"]
+    assert pipeline.get_counters()["dropped"] == 1
+
+
+def test_window_is_freed_by_the_acknowledgements():
+    client = FakeClient()
+    pipeline = get_pipeline(client, max_inflight=2)
+    for device_id in ("EM-1", "EM-2", "EM-3"):
+        pipeline.submit(device_id, device_id, "state")
+    assert len(client.published) == 2
+    assert pipeline.get_counters()["in_flight"] == 2
+
+    pipeline.on_publish(1)
+    assert len(client.published) == 3
+    counters = pipeline.get_counters()
+    assert counters["acknowledged"] == 1
+    assert counters["queued"] == 0
+    assert pipeline.get_histograms()["latency"]["count"] == 1
+
+
+def test_unacknowledged_messages_expire_after_the_ack_timeout():
+    client = FakeClient()
+    pipeline = get_pipeline(client, max_inflight=1, ack_timeout=0.01)
+    pipeline.submit("EM-1", "1", "state")
+    pipeline.submit("EM-2", "2", "state")
+    assert len(client.published) == 1
+
+    time.sleep(0.02)
+    pipeline.pump()
+    assert [device_id for device_id, _, _ in client.published] == ["EM-1", "EM-2"]
+    assert pipeline.get_counters()["expired"] == 1
+
+
+def test_messages_in_flight_are_expired_on_disconnection():
+    client = FakeClient()
+    pipeline = get_pipeline(client)
+    pipeline.submit("EM-1", "1", "state")
+    pipeline.on_disconnect()
+    pipeline.pump()
+
+    counters = pipeline.get_counters()
+    assert counters["expired"] == 1
+    assert counters["in_flight"] == 0
@@ -0,0 +1,146 @@
+import os
+import time
+import logging
+
+from google_iot_core_gateway.store_and_forward import RECORD_HEADER, SEGMENT_SUFFIX, SegmentLog, StoreAndForward
+
+logger = logging.getLogger(__name__)
+
+# 4 records of RECORD_HEADER.size + 40 bytes per segment
+SEGMENT_SIZE = 256
+PAYLOAD_SIZE = 40
+
+
+def get_payload(index):
+    return f"{index:04d}".encode().ljust(PAYLOAD_SIZE, b".")
+
+
+def get_segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def test_read_records_in_append_order_across_segments(tmp_path):
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    for index in range(10):
+        log.append(get_payload(index))
+
+    assert len(get_segment_files(tmp_path)) == 3
+    assert [payload for _, payload in log.read(6)] == [get_payload(index) for index in range(6)]
+    assert [payload for _, payload in log.read(100)] == [get_payload(index) for index in range(6, 10)]
+    assert log.is_empty()
+    # the segments whose records were all read are deleted once the read position is saved
+    assert len(get_segment_files(tmp_path)) == 3
+    log.save_cursor()
+    assert len(get_segment_files(tmp_path)) == 1
+    log.close()
+
+
+def test_segments_read_are_read_again_if_the_read_position_was_not_saved(tmp_path):
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    for index in range(10):
+        log.append(get_payload(index))
+    log.read(2)
+    log.save_cursor()
+    # a crash before the records are handed over and the read position is saved
+    assert len(log.read(6)) == 6
+    log.flush()
+
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    assert len(get_segment_files(tmp_path)) == 3
+    assert [payload for _, payload in log.read(100)] == [get_payload(index) for index in range(2, 10)]
+    log.close()
+    assert len(get_segment_files(tmp_path)) == 1
+
+
+def test_torn_record_is_not_read_and_is_overwritten(tmp_path):
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    for index in range(3):
+        log.append(get_payload(index))
+    log.close()
+
+    # a power loss while the payload of the last record was written
+    path = os.path.join(tmp_path, get_segment_files(tmp_path)[0])
+    last_record = 2 * (RECORD_HEADER.size + PAYLOAD_SIZE)
+    with open(path, "r+b") as segment_file:
+        segment_file.seek(last_record + RECORD_HEADER.size + PAYLOAD_SIZE // 2)
+        segment_file.write(b"\0" * (PAYLOAD_SIZE // 2))
+
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    log.append(get_payload(3))
+    assert [payload for _, payload in log.read(10)] == [get_payload(0), get_payload(1), get_payload(3)]
+    log.close()
+
+
+def test_truncated_segment_is_read_up_to_the_cut(tmp_path):
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    for index in range(3):
+        log.append(get_payload(index))
+    log.close()
+
+    path = os.path.join(tmp_path, get_segment_files(tmp_path)[0])
+    os.truncate(path, 2 * (RECORD_HEADER.size + PAYLOAD_SIZE) + RECORD_HEADER.size + 1)
+
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    assert os.path.getsize(path) == SEGMENT_SIZE
+    assert [payload for _, payload in log.read(10)] == [get_payload(0), get_payload(1)]
+    log.close()
+
+
+def test_read_position_is_persisted(tmp_path):
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    for index in range(7):
+        log.append(get_payload(index))
+    assert [payload for _, payload in log.read(5)] == [get_payload(index) for index in range(5)]
+    log.save_cursor()
+    # not saved, read again after the restart
+    log.read(1)
+    log.flush()
+
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE)
+    assert [payload for _, payload in log.read(10)] == [get_payload(5), get_payload(6)]
+    log.close()
+
+
+def test_oldest_segments_are_dropped_beyond_the_size_cap(tmp_path):
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE, max_size=2 * SEGMENT_SIZE)
+    for index in range(20):
+        log.append(get_payload(index))
+
+    assert len(get_segment_files(tmp_path)) == 2
+    assert log.get_size() == 2 * SEGMENT_SIZE
+    assert log.dropped_segments == 3
+    # the records of the 2 newest segments are kept
+    assert [payload for _, payload in log.read(100)] == [get_payload(index) for index in range(12, 20)]
+    log.close()
+
+
+def test_segments_older_than_the_retention_are_dropped(tmp_path):
+    log = SegmentLog(logger, str(tmp_path), segment_size=SEGMENT_SIZE, retention=3600)
+    for index in range(6):
+        log.append(get_payload(index))
+    first_segment = os.path.join(tmp_path, get_segment_files(tmp_path)[0])
+    two_hours_ago = time.time() - 7200
+    os.utime(first_segment, (two_hours_ago, two_hours_ago))
+
+    log.enforce_limits()
+    assert log.dropped_segments == 1
+    assert not os.path.exists(first_segment)
+    assert [payload for _, payload in log.read(100)] == [get_payload(4), get_payload(5)]
+    log.close()
+
+
+def test_store_and_forward_replays_at_the_replay_rate(tmp_path):
+    store_and_forward = StoreAndForward(logger, str(tmp_path), segment_size=SEGMENT_SIZE, replay_rate=1000)
+    for index in range(5):
+        store_and_forward.store(f"EM-{index}", f'{{"index": {index}}}')
+    store_and_forward.flush()
+
+    published = []
+    # no time elapsed since the spool was created, nothing is allowed yet
+    store_and_forward._last_replay = time.monotonic()
+    assert store_and_forward.replay(lambda device_id, payload: published.append((device_id, payload)), 0) == 0
+    time.sleep(0.01)
+    assert store_and_forward.replay(lambda device_id, payload: published.append((device_id, payload)), 3) == 3
+    assert published == [(f"EM-{index}", f'{{"index": {index}}}') for index in range(3)]
+    assert store_and_forward.has_backlog()
+    store_and_forward.close()
@@ -0,0 +1,201 @@
+import json
+import logging
+
+import pytest
+
+from google_iot_core_gateway.gcp_handler import build_payloads
+from google_iot_core_gateway.udmi_handler.udmi_handler import UDMIHandler
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP = "2022-01-01T00:00:00Z"
+
+# Modbus-To-DBO map of the test meter type: one point per kind of deadband, and one point left out of the
+# UDMI Site Model of the device
+MODBUS_DBO_MAP = {
+    "system": {
+        "130": {"dbo_name": "serial_no", "number_of_registers": 2, "format": "int32u", "units": "No-units"},
+        "1637": {"dbo_name": "version", "number_of_registers": 1, "format": "int16u", "units": "No-units"},
+    },
+    "3000": {"dbo_name": "voltage_sensor", "number_of_registers": 2, "format": "float32", "units": "Volts",
+             "deadband": 2.0},
+    "3002": {"dbo_name": "current_sensor", "number_of_registers": 2, "format": "float32", "units": "Amperes",
+             "deadband_percent": 10},
+    "3004": {"dbo_name": "power_sensor", "number_of_registers": 2, "format": "float32", "units": "Kilowatts",
+             "deadband": 1.0, "deadband_percent": 10},
+    "3006": {"dbo_name": "energy_accumulator", "number_of_registers": 2, "format": "float32",
+             "units": "Kilowatt-Hours"},
+    "3008": {"dbo_name": "frequency_sensor", "number_of_registers": 2, "format": "float32", "units": "Hertz"},
+}
+
+SITE_MODEL_POINTS = ["voltage_sensor", "current_sensor", "power_sensor", "energy_accumulator"]
+
+
+@pytest.fixture
+def udmi_handler(tmp_path):
+    """
+    UDMIHandler of a site with the meter EM-1 (Modbus slave ID 1) of the TEST type.
+    """
+    resources_path = tmp_path / "resources"
+    (resources_path / "modbus_dbo_maps").mkdir(parents=True)
+    (resources_path / "modbus_dbo_maps" / "TEST.json").write_text(json.dumps(MODBUS_DBO_MAP))
+
+    udmi_site_model_path = tmp_path / "udmi_site_model"
+    (udmi_site_model_path / "devices" / "EM-1").mkdir(parents=True)
+    metadata = {"pointset": {"points": {point: {} for point in SITE_MODEL_POINTS}}}
+    (udmi_site_model_path / "devices" / "EM-1" / "metadata.json").write_text(json.dumps(metadata))
+
+    handler = UDMIHandler(logger, str(resources_path), str(udmi_site_model_path))
+    assert handler.add_device_to_dict(1, "EM-1", "TEST")
+    return handler
+
+
+def get_points(payload):
+    return {point: value["present_value"] for point, value in json.loads(payload)["points"].items()}
+
+
+def test_deadbands_are_read_from_the_modbus_dbo_map(udmi_handler):
+    assert udmi_handler._deadbands["TEST"] == {
+        "voltage_sensor": (2.0, None),
+        "current_sensor": (None, 10),
+        "power_sensor": (1.0, 10),
+    }
+
+
+def test_first_partial_update_carries_all_the_points(udmi_handler):
+    udmi_handler.apply_frame(1, {3000: 230.0, 3002: 10.0, 3004: 5.0, 3006: 100.0}, TIMESTAMP)
+
+    payload = json.loads(udmi_handler.get_event_point_payload(1, changed_only=True))
+
+    assert payload["partial_update"] is True
+    assert set(payload["points"]) == set(SITE_MODEL_POINTS)
+
+
+def test_changes_within_the_deadbands_are_not_published(udmi_handler):
+    udmi_handler.apply_frame(1, {3000: 230.0, 3002: 10.0, 3004: 5.0, 3006: 100.0}, TIMESTAMP)
+    udmi_handler.get_event_point_payload(1, changed_only=True)
+
+    # 2 V absolute, 10 % of 10 A, the larger of 1 kW and 10 % of 5 kW
+    udmi_handler.apply_frame(1, {3000: 231.9, 3002: 10.9, 3004: 5.9, 3006: 100.0}, TIMESTAMP)
+
+    assert udmi_handler.get_event_point_payload(1, changed_only=True) is None
+
+
+def test_changes_out_of_the_deadbands_are_published(udmi_handler):
+    udmi_handler.apply_frame(1, {3000: 230.0, 3002: 10.0, 3004: 5.0, 3006: 100.0}, TIMESTAMP)
+    udmi_handler.get_event_point_payload(1, changed_only=True)
+
+    udmi_handler.apply_frame(1, {3000: 227.9, 3002: 11.1, 3004: 5.9, 3006: 100.1}, TIMESTAMP)
+    payload = udmi_handler.get_event_point_payload(1, changed_only=True)
+
+    # without a deadband any change is published
+    assert get_points(payload) == {"voltage_sensor": 227.9, "current_sensor": 11.1, "energy_accumulator": 100.1}
+    assert json.loads(payload)["partial_update"] is True
+
+
+def test_slow_drift_is_measured_from_the_last_published_value(udmi_handler):
+    udmi_handler.apply_frame(1, {3000: 230.0}, TIMESTAMP)
+    udmi_handler.get_event_point_payload(1, changed_only=True)
+
+    for value in (231.0, 232.0):
+        udmi_handler.apply_frame(1, {3000: value}, TIMESTAMP)
+        assert udmi_handler.get_event_point_payload(1, changed_only=True) is None
+    udmi_handler.apply_frame(1, {3000: 232.5}, TIMESTAMP)
+
+    assert get_points(udmi_handler.get_event_point_payload(1, changed_only=True)) == {"voltage_sensor": 232.5}
+
+
+def test_full_payload_carries_all_the_points_and_resets_the_deadbands(udmi_handler):
+    udmi_handler.apply_frame(1, {3000: 230.0, 3002: 10.0, 3004: 5.0, 3006: 100.0}, TIMESTAMP)
+    udmi_handler.get_event_point_payload(1, changed_only=True)
+    udmi_handler.apply_frame(1, {3000: 231.5}, TIMESTAMP)
+
+    payload = json.loads(udmi_handler.get_event_point_payload(1))
+
+    assert "partial_update" not in payload
+    assert set(payload["points"]) == set(SITE_MODEL_POINTS)
+    # the keyframe value is the new reference of the deadband
+    udmi_handler.apply_frame(1, {3000: 233.0}, TIMESTAMP)
+    assert udmi_handler.get_event_point_payload(1, changed_only=True) is None
+
+
+def test_keyframe_every_keyframe_interval(udmi_handler):
+    keyframes = [udmi_handler.next_publish_interval(1, 3) for _ in range(7)]
+
+    assert keyframes == [True, False, False, True, False, False, True]
+
+
+def test_state_is_published_only_when_it_changes(udmi_handler):
+    udmi_handler.apply_frame(1, {130: 1234, 3000: 230.0}, TIMESTAMP)
+    assert udmi_handler.has_state_changed(1)
+    assert not udmi_handler.has_state_changed(1)
+
+    # a new point value and timestamp do not change the state
+    udmi_handler.apply_frame(1, {3000: 240.0}, "2022-01-01T00:00:05Z")
+    assert not udmi_handler.has_state_changed(1)
+
+    udmi_handler.apply_frame(1, {130: 5678}, TIMESTAMP)
+    assert udmi_handler.has_state_changed(1)
+
+
+def test_change_of_value_payloads_between_keyframes(udmi_handler):
+    udmi_handler.apply_frame(1, {130: 1234, 3000: 230.0, 3002: 10.0, 3004: 5.0, 3006: 100.0}, TIMESTAMP)
+
+    def get_topics():
+        return [(topic, partial_update)
+                for _, _, topic, partial_update in build_payloads(logger, udmi_handler, "cov", keyframe_interval=3)]
+
+    # keyframe, nothing changed, a point changed, keyframe
+    assert get_topics() == [("state", False), ("events/pointset", False)]
+    assert get_topics() == []
+    udmi_handler.apply_frame(1, {3006: 101.0}, TIMESTAMP)
+    assert get_topics() == [("events/pointset", True)]
+    assert get_topics() == [("state", False), ("events/pointset", False)]
+
+
+def test_registers_are_routed_to_points_and_system_block(udmi_handler):
+    rejected = udmi_handler.apply_frame(1, {130: 1234, 1637: 7, 3000: 230.0, 3006: 100.0}, TIMESTAMP)
+
+    device = udmi_handler.devices["1"]
+    assert rejected == 0
+    assert device["system"]["serial_no"] == 1234
+    assert device["system"]["firmware"]["version"] == 7
+    assert device["points"]["voltage_sensor"].present_value == 230.0
+    assert device["points"]["energy_accumulator"].present_value == 100.0
+    assert device["points"]["voltage_sensor"].timestamp == TIMESTAMP
+
+
+def test_registers_unknown_to_the_site_model_are_rejected(udmi_handler):
+    # 3008 is mapped to a point missing from the UDMI Site Model of the device, 4000 is not mapped at all
+    rejected = udmi_handler.apply_frame(1, {3000: 230.0, 3008: 50.0, 4000: 1.0}, TIMESTAMP)
+
+    assert rejected == 2
+    assert "frequency_sensor" not in udmi_handler.devices["1"]["points"]
+    assert udmi_handler.devices["1"]["points"]["voltage_sensor"].present_value == 230.0
+
+
+def test_update_device_properties_routes_a_single_register(udmi_handler):
+    udmi_handler.update_device_properties(1, "TEST", "3002", 12.5, TIMESTAMP)
+
+    assert udmi_handler.devices["1"]["points"]["current_sensor"].present_value == 12.5
+
+
+def test_refresh_block_updates_only_the_timestamps_of_its_points(udmi_handler):
+    block_key = (1, 3, 3000, 8)
+    udmi_handler.apply_frame(1, {3000: 230.0, 3002: 10.0, 130: 1234}, TIMESTAMP, block_key=block_key)
+    later = "2022-01-01T00:00:05Z"
+
+    assert udmi_handler.refresh_block(block_key, later)
+    assert not udmi_handler.refresh_block((1, 3, 3004, 4), later)
+
+    points = udmi_handler.devices["1"]["points"]
+    assert points["voltage_sensor"].timestamp == later
+    assert points["current_sensor"].timestamp == later
+    assert points["voltage_sensor"].present_value == 230.0
+    assert points["energy_accumulator"].timestamp != later
+
+
+def test_device_of_an_unknown_type_rejects_all_registers(udmi_handler):
+    udmi_handler.add_device_to_dict(2, "EM-1", "UNKNOWN")
+
+    assert udmi_handler.apply_frame(2, {3000: 230.0, 130: 1234}, TIMESTAMP) == 2